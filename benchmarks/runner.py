@@ -0,0 +1,153 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import sys
+import time
+import gevent.pool
+
+import stellr
+from .servers import FakeSolrHTTPServer, FakeSolrZMQServer
+
+def percentile(values, percent):
+    """
+    The value below which percent of the sorted values fall.
+    """
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def run(create_command, requests=1000, concurrency=10):
+    """
+    Execute requests commands created by create_command with up to
+    concurrency executing at once, returning a dict of the number of requests
+    and errors, the seconds taken, the throughput in requests per second and
+    the p50 and p99 latencies in seconds.
+    """
+    latencies = []
+    errors = []
+
+    def execute():
+        command = create_command()
+        start = time.time()
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            errors.append(e)
+        latencies.append(time.time() - start)
+
+    pool = gevent.pool.Pool(concurrency)
+    begin = time.time()
+    for i in xrange(requests):
+        pool.spawn(execute)
+    pool.join()
+    seconds = time.time() - begin
+    latencies.sort()
+    return {'requests': requests, 'errors': len(errors), 'seconds': seconds,
+            'throughput': requests / seconds if seconds else None,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99)}
+
+def select_command(host, timeout):
+    """
+    Create a function that creates a SelectCommand for the host.
+    """
+    def create():
+        command = stellr.SelectCommand(host, timeout=timeout)
+        command.add_param('q', '*:*')
+        command.add_param('rows', 10)
+        return command
+    return create
+
+def update_command(host, timeout, documents=10, doc_size=100):
+    """
+    Create a function that creates an UpdateCommand for the host adding the
+    number of documents of roughly doc_size bytes.
+    """
+    docs = [{'id': str(i), 'text': 'x' * doc_size} for i in range(documents)]
+
+    def create():
+        command = stellr.UpdateCommand(host, timeout=timeout)
+        command.add_documents(docs)
+        return command
+    return create
+
+def _split(value, type=str):
+    return [type(v) for v in value.split(',') if v]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput and latency of stellr against '
+                    'stand-in Solr servers.')
+    parser.add_argument('--transports', default='http,zmq',
+                        help='comma separated transports (default=http,zmq)')
+    parser.add_argument('--commands', default='select,update',
+                        help='comma separated commands '
+                             '(default=select,update)')
+    parser.add_argument('--concurrency', default='1,10,50',
+                        help='comma separated concurrency levels '
+                             '(default=1,10,50)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests at each level (default=1000)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the servers delay each response '
+                             '(default=0)')
+    parser.add_argument('--docs', type=int, default=10,
+                        help='docs in each select response and update '
+                             '(default=10)')
+    parser.add_argument('--doc-size', type=int, default=100,
+                        help='approximate bytes in each doc (default=100)')
+    parser.add_argument('--timeout', type=float, default=15,
+                        help='timeout of each command (default=15)')
+    parser.add_argument('--zmq-address', default='tcp://127.0.0.1:5555',
+                        help='address the ZeroMQ server binds to')
+    args = parser.parse_args(argv)
+
+    options = dict(latency=args.latency, docs=args.docs,
+                   doc_size=args.doc_size)
+    servers = {}
+    transports = _split(args.transports)
+    if 'http' in transports:
+        servers['http'] = FakeSolrHTTPServer(**options).start()
+    if 'zmq' in transports:
+        servers['zmq'] = FakeSolrZMQServer(args.zmq_address,
+                                           **options).start()
+
+    row = '%-9s %-8s %12s %12s %10s %10s %8s'
+    print row % ('transport', 'command', 'concurrency', 'requests/s',
+                 'p50 ms', 'p99 ms', 'errors')
+    try:
+        for transport in transports:
+            host = servers[transport].host
+            for name in _split(args.commands):
+                if name == 'update':
+                    create = update_command(host, args.timeout, args.docs,
+                                            args.doc_size)
+                else:
+                    create = select_command(host, args.timeout)
+                for concurrency in _split(args.concurrency, int):
+                    result = run(create, args.requests, concurrency)
+                    print row % (transport, name, concurrency,
+                                 '%.1f' % result['throughput'],
+                                 '%.2f' % (result['p50'] * 1000),
+                                 '%.2f' % (result['p99'] * 1000),
+                                 result['errors'])
+                    sys.stdout.flush()
+    finally:
+        for server in servers.values():
+            server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gevent
+import gevent.pywsgi
+from gevent_zeromq import zmq
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+from stellr.codec import json
+
+UPDATE_RESPONSE = json.dumps({'responseHeader': {'status': 0, 'QTime': 0}})
+
+def select_response(docs=10, doc_size=100):
+    """
+    Create the canned response to a select, with the number of docs each
+    padded to roughly doc_size bytes.
+    """
+    return json.dumps({
+        'responseHeader': {'status': 0, 'QTime': 0},
+        'response': {'numFound': docs, 'start': 0, 'docs': [
+            {'id': str(i), 'text': 'x' * doc_size} for i in range(docs)]}})
+
+class FakeSolr(object):
+    """
+    The canned responses of a stand-in Solr server. The FakeSolr has the
+    following initialization parameters:
+
+        latency: the number of seconds each request is delayed by before it
+            is answered, without blocking other requests (default=0)
+        docs: the number of docs in the response to a select (default=10)
+        doc_size: the approximate size in bytes of each doc (default=100)
+
+    Requests to a handler containing 'update' receive a response with only a
+    header, all others receive the select response.
+    """
+
+    def __init__(self, latency=0, docs=10, doc_size=100):
+        self.latency = latency
+        self.select = select_response(docs, doc_size)
+        self.requests = 0
+
+    def respond(self, handler):
+        """
+        Wait for the latency and return the response to the handler.
+        """
+        self.requests += 1
+        if self.latency:
+            gevent.sleep(self.latency)
+        return UPDATE_RESPONSE if 'update' in handler else self.select
+
+class FakeSolrHTTPServer(FakeSolr):
+    """
+    A stand-in Solr server answering http requests on the port, or on a free
+    port if the port is 0. The host to use in commands is available from the
+    host attribute once the server is started.
+    """
+
+    def __init__(self, port=0, **kwargs):
+        super(FakeSolrHTTPServer, self).__init__(**kwargs)
+        self.server = gevent.pywsgi.WSGIServer(('127.0.0.1', port),
+                                               self._application, log=None)
+
+    @property
+    def host(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def start(self):
+        """
+        Start answering requests in the background.
+        """
+        self.server.start()
+        return self
+
+    def stop(self):
+        """
+        Stop answering requests.
+        """
+        self.server.stop()
+
+    def _application(self, environ, start_response):
+        # read the whole body, chunked or not, before answering
+        environ['wsgi.input'].read()
+        data = self.respond(environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(data)))])
+        return [data]
+
+class FakeSolrZMQServer(FakeSolr):
+    """
+    A stand-in Solr server answering ZeroMQ requests on the address. A ROUTER
+    socket is used so that the requests of REQ and DEALER sockets are answered
+    concurrently, as a Solr server with several handler threads would.
+    """
+
+    def __init__(self, address='tcp://127.0.0.1:5555', context=None,
+                 **kwargs):
+        super(FakeSolrZMQServer, self).__init__(**kwargs)
+        self.host = address
+        self.context = context or zmq.Context()
+        self.socket = None
+        self._server = None
+        self._send_lock = Semaphore()
+
+    def start(self):
+        """
+        Start answering requests in the background.
+        """
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(self.host)
+        self._server = gevent.spawn(self._serve)
+        return self
+
+    def stop(self):
+        """
+        Stop answering requests.
+        """
+        self._server.kill()
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
+
+    def _serve(self):
+        while True:
+            frames = self.socket.recv_multipart()
+            gevent.spawn(self._answer, frames)
+
+    def _answer(self, frames):
+        # the envelope is every frame up to and including the empty delimiter,
+        # the first frame after it is the handler and any query string
+        delimiter = frames.index('')
+        envelope, request = frames[:delimiter + 1], frames[delimiter + 1:]
+        data = self.respond(request[0].split(' ', 1)[0])
+        with self._send_lock:
+            self.socket.send_multipart(envelope + [data])
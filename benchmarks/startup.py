@@ -0,0 +1,105 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Measure the time taken to import stellr and the latency of the first and
+second commands executed by a new process. Each sample is taken in a fresh
+interpreter, so nothing may import stellr before it is timed:
+
+    python -m benchmarks.startup --help
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+def measure(transport, address):
+    """
+    Import stellr and execute two selects against a stand-in server for the
+    transport, returning a dict of the seconds taken by each and whether the
+    import patched the socket module.
+    """
+    start = time.time()
+    import stellr
+    imported = time.time() - start
+    from gevent import monkey
+    patched = monkey.is_module_patched('socket')
+
+    from .runner import select_command
+    from .servers import FakeSolrHTTPServer, FakeSolrZMQServer
+    if transport == 'zmq':
+        server = FakeSolrZMQServer(address).start()
+    else:
+        server = FakeSolrHTTPServer().start()
+    try:
+        create = select_command(server.host, 15)
+        start = time.time()
+        create().execute()
+        first = time.time() - start
+        start = time.time()
+        create().execute()
+        second = time.time() - start
+    finally:
+        server.stop()
+    return {'import': imported, 'first': first, 'second': second,
+            'patched': patched}
+
+def sample(transport, address):
+    """
+    Take a measurement in a new interpreter.
+    """
+    output = subprocess.check_output([sys.executable, '-m',
+        'benchmarks.startup', '--measure', transport,
+        '--zmq-address', address])
+    return json.loads(output)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of stellr and the latency of '
+                    'the first commands of a new process.')
+    parser.add_argument('--transports', default='http,zmq',
+                        help='comma separated transports (default=http,zmq)')
+    parser.add_argument('--samples', type=int, default=10,
+                        help='processes started for each transport '
+                             '(default=10)')
+    parser.add_argument('--zmq-address', default='tcp://127.0.0.1:5555',
+                        help='address the ZeroMQ server binds to')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print json.dumps(measure(args.measure, args.zmq_address))
+        return
+
+    row = '%-9s %10s %10s %10s %8s'
+    print row % ('transport', 'import ms', 'first ms', 'second ms',
+                 'patched')
+    for transport in [t for t in args.transports.split(',') if t]:
+        samples = [sample(transport, args.zmq_address)
+                   for i in xrange(args.samples)]
+        print row % (transport,
+            '%.2f' % (_median([s['import'] for s in samples]) * 1000),
+            '%.2f' % (_median([s['first'] for s in samples]) * 1000),
+            '%.2f' % (_median([s['second'] for s in samples]) * 1000),
+            any(s['patched'] for s in samples))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
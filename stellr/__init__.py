@@ -16,4 +16,14 @@
 
 __version__ = '0.3.2'
 
-from .stellr import SelectCommand, StellrError, UpdateCommand
\ No newline at end of file
+from .stellr import (CircuitOpenError, RateLimitError, SelectCommand,
+                     StellrError, UpdateCommand)
+from .bulk import AdaptiveBatching, BulkIndexer
+from .cache import QueryCache
+from .client import StellrClient
+from .cursor import CursorIterator
+from .executor import execute_many
+from .hosts import HostGroup
+from .ratelimit import RateLimiter
+from .retry import RetryPolicy
+from .sharding import ShardedSelectCommand
@@ -0,0 +1,160 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# the settings of the breakers created for each host, None when disabled
+_settings = None
+_breakers = {}
+
+def enable(failures=5, window=10, reset_timeout=30, trial_requests=1):
+    """
+    Use a CircuitBreaker with the settings for every host that commands are
+    executed against, replacing any existing breakers.
+    """
+    global _settings
+    _settings = dict(failures=failures, window=window,
+                     reset_timeout=reset_timeout,
+                     trial_requests=trial_requests)
+    _breakers.clear()
+
+def disable():
+    """
+    Stop using circuit breakers.
+    """
+    global _settings
+    _settings = None
+    _breakers.clear()
+
+def get_breaker(host):
+    """
+    Get the breaker for the host, or None if circuit breakers are disabled.
+    """
+    if _settings is None:
+        return None
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(**_settings)
+    return breaker
+
+def is_open(host):
+    """
+    Whether the breaker of the host is open and refusing requests.
+    """
+    breaker = _breakers.get(host)
+    return breaker is not None and breaker.is_open()
+
+def states():
+    """
+    Get a dict of the state of the breaker of each host.
+    """
+    return dict((host, breaker.state) for host, breaker in _breakers.items())
+
+class CircuitBreaker(object):
+    """
+    A CircuitBreaker stops requests to a host that keeps failing. It opens
+    after failures requests fail within window seconds, and while open every
+    request is refused. After reset_timeout seconds it is half-open and lets
+    trial_requests requests through: if one succeeds it closes, if one fails
+    it opens again. The CircuitBreaker has the following initialization
+    parameters:
+
+        failures: the number of failures that open the breaker (default=5)
+        window: the number of seconds failures are counted over (default=10)
+        reset_timeout: the number of seconds the breaker stays open before
+            trial requests are allowed (default=30)
+        trial_requests: the number of requests allowed while half-open
+            (default=1)
+
+    A request fails when it times out, gets no response or gets a 5xx status,
+    errors reported by Solr for a bad request do not count.
+    """
+
+    def __init__(self, failures=5, window=10, reset_timeout=30,
+                 trial_requests=1):
+        self.failures = failures
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.trial_requests = trial_requests
+        self.state = CLOSED
+        self.opened = None
+        self.trials = 0
+        self._failed = collections.deque()
+
+    def is_open(self):
+        """
+        Whether requests are refused without allowing a trial request.
+        """
+        return (self.state == OPEN and
+                time.time() - self.opened < self.reset_timeout)
+
+    def allow(self):
+        """
+        Whether a request may be sent. While half-open each allowed request
+        is counted as a trial.
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.time()
+        if now - self.opened >= self.reset_timeout:
+            # trials that never completed do not keep the breaker half-open
+            self.state = HALF_OPEN
+            self.opened = now
+            self.trials = 0
+        if self.state == HALF_OPEN and self.trials < self.trial_requests:
+            self.trials += 1
+            return True
+        return False
+
+    def record(self, error=None):
+        """
+        Record the outcome of a request, the StellrError raised by it or None
+        if it succeeded.
+        """
+        if error is not None and not self.is_failure(error):
+            error = None
+        if error is None:
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self._failed.clear()
+            return
+        now = time.time()
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        if self.state == OPEN:
+            # a request sent before the breaker opened
+            return
+        self._failed.append(now)
+        while self._failed and now - self._failed[0] > self.window:
+            self._failed.popleft()
+        if len(self._failed) >= self.failures:
+            self._open(now)
+
+    def is_failure(self, error):
+        """
+        Whether the error counts as a failure of the host.
+        """
+        return (error.timeout or error.status >= 500 or
+                (error.status < 0 and error.response is None))
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened = now
+        self._failed.clear()
@@ -0,0 +1,311 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import gevent
+import gevent.event
+import gevent.pool
+
+from .codec import get_codec
+from .stellr import StellrError, UpdateCommand
+
+class AdaptiveBatching(object):
+    """
+    AdaptiveBatching adjusts the number of updates in each batch sent by a
+    BulkIndexer, and the number of batches in flight, towards a target
+    latency with additive increase and multiplicative decrease. The
+    AdaptiveBatching has the following initialization parameters:
+
+        target_latency: the number of seconds each batch should take
+            (default=1.0)
+        documents: the number of updates in the first batch (default=100)
+        min_documents: the fewest updates in a batch (default=10)
+        max_documents: the most updates in a batch (default=10000)
+        step: the number of updates added to the batch size after a full
+            batch completes within the target latency (default=50)
+        decrease: the factor the batch size is multiplied by after a batch
+            takes longer than the target latency (default=0.75)
+        backoff: the factor the batch size is multiplied by after a batch
+            times out or is refused with a 503 status, which also halves the
+            concurrency (default=0.5)
+        concurrency: the number of batches in flight at first (default=1)
+        max_concurrency: the most batches in flight (default=4)
+
+    Once the batch size reaches max_documents each fast batch allows another
+    batch in flight instead, and a slow batch at min_documents allows one
+    fewer. The throughput attribute is the moving average of the bytes sent
+    per second by each batch.
+    """
+
+    def __init__(self, target_latency=1.0, documents=100, min_documents=10,
+                 max_documents=10000, step=50, decrease=0.75, backoff=0.5,
+                 concurrency=1, max_concurrency=4):
+        self.target_latency = target_latency
+        self.min_documents = min_documents
+        self.max_documents = max_documents
+        self.step = step
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self.documents = min(max(documents, min_documents), max_documents)
+        self.concurrency = min(max(concurrency, 1), max_concurrency)
+        self.throughput = None
+
+    def record(self, documents, size, seconds, error=None):
+        """
+        Adjust the batch size and concurrency after a batch of documents
+        updates and size bytes took seconds to complete, with the StellrError
+        raised by it if it failed.
+        """
+        if error is not None:
+            if error.timeout or error.status == 503:
+                self.documents = self._resize(self.documents * self.backoff)
+                self.concurrency = max(self.concurrency // 2, 1)
+            # other errors are the fault of the updates, not of the load
+            return
+        if seconds > 0:
+            rate = size / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = 0.8 * self.throughput + 0.2 * rate
+        if seconds > self.target_latency:
+            if self.documents == self.min_documents:
+                self.concurrency = max(self.concurrency - 1, 1)
+            self.documents = self._resize(self.documents * self.decrease)
+        elif documents >= self.documents:
+            # a batch flushed before it was full says nothing about a larger
+            # batch
+            if self.documents == self.max_documents:
+                self.concurrency = min(self.concurrency + 1,
+                                       self.max_concurrency)
+            self.documents = self._resize(self.documents + self.step)
+
+    def _resize(self, documents):
+        return int(min(max(documents, self.min_documents),
+                       self.max_documents))
+
+class BulkIndexer(object):
+    """
+    A BulkIndexer buffers updates added from any number of greenlets and
+    sends them to the remote host in batches using an UpdateCommand. A batch
+    is flushed as soon as it reaches max_documents updates or max_bytes of
+    encoded data, or once max_interval seconds have passed since the first
+    update was added to it. The BulkIndexer has the following initialization
+    parameters:
+
+        host: the solr host the updates will be sent to.
+        handler: the handler on the remote host that will be called
+            (default='/solr/update/json')
+        name: the name of the commands used to flush (default='update')
+        timeout: the timeout of each flush in seconds, or None for the
+            timeout of the client (default=None)
+        commit_within: integer value to use as the number of milliseconds
+            within which the documents will be committed (default=None)
+        max_documents: the number of updates that triggers a flush
+            (default=1000)
+        max_bytes: the size of the encoded updates in bytes that triggers a
+            flush (default=5242880)
+        max_interval: the number of seconds an update may wait before it is
+            flushed, or None to only flush on size (default=1.0)
+        concurrency: the maximum number of flushes in flight; adding an update
+            that triggers a flush blocks until a slot is free (default=2)
+        isolate_failures: boolean value to indicate whether the updates in a
+            failed batch are resent one at a time so that only the updates
+            rejected by Solr are reported as failures (default=False)
+        on_error: callable invoked with the action ('add' or 'delete'), the
+            update data and the StellrError for each failed update. If None
+            the failures are appended to the errors list (default=None)
+        client: the StellrClient the updates are sent with, or None for the
+            default client (default=None)
+        adaptive: an AdaptiveBatching that sets the number of updates in each
+            batch and the number of flushes in flight from the latency of
+            earlier batches, in place of max_documents and concurrency, or
+            None to use those as is (default=None)
+
+    The indexed and failed attributes count the updates that have been sent.
+    Call flush to send any buffered updates and wait for all flushes in
+    flight, or use the BulkIndexer in a with statement.
+    """
+
+    def __init__(self, host, handler='/solr/update/json', name='update',
+                 timeout=None, commit_within=None,
+                 max_documents=1000, max_bytes=5 * 1024 * 1024,
+                 max_interval=1.0, concurrency=2, isolate_failures=False,
+                 on_error=None, client=None, adaptive=None):
+        self.host = host
+        self.handler = handler
+        self.name = name
+        self.timeout = timeout
+        self.commit_within = commit_within
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.isolate_failures = isolate_failures
+        self.on_error = on_error
+        self.client = client
+        self.adaptive = adaptive
+        self.indexed = 0
+        self.failed = 0
+        self.errors = []
+        if adaptive is not None:
+            concurrency = adaptive.max_concurrency
+        self._flushes = gevent.pool.Pool(concurrency)
+        self._in_flight = 0
+        self._flushed = gevent.event.Event()
+        self._builder = self._create_command([])
+        self._generation = 0
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+        return False
+
+    def add_documents(self, data, boost=None, overwrite=None):
+        """
+        Add a document or list of documents to be added to or updated in the
+        index, accepting the same values as UpdateCommand.add_documents.
+        """
+        self._builder.clear_command()
+        self._builder.add_documents(data, boost, overwrite)
+        self._queue(self._builder._commands)
+
+    def add_delete_by_id(self, data):
+        """
+        Add a delete of an item by its unique id in the index. The value of
+        the parameter can be a single id or a list of ids.
+        """
+        self._builder.clear_command()
+        self._builder.add_delete_by_id(data)
+        self._queue(self._builder._commands)
+
+    @property
+    def pending(self):
+        """
+        The number of updates waiting in the buffer.
+        """
+        return len(self._data)
+
+    def flush(self):
+        """
+        Send any buffered updates and wait for all flushes in flight to
+        complete.
+        """
+        self._flush_buffer()
+        self._flushes.join()
+
+    def _reset(self):
+        # start a new, empty buffer; timers started for the previous buffer
+        # are ignored once the generation changes
+        self._updates = []
+        self._data = []
+        self._bytes = 0
+        self._generation += 1
+        self._timer = None
+
+    def _create_command(self, updates):
+        command = UpdateCommand(self.host, handler=self.handler,
+            name=self.name, timeout=self.timeout,
+            commit_within=self.commit_within)
+        command.client = self.client
+        command._commands = updates
+        return command
+
+    def _queue(self, updates):
+        # the updates are encoded as they are queued so that their size is
+        # known, the command used to flush sends the encoded strings as is;
+        # deletes and adds that do not overwrite are kept as they are, so
+        # that the command can tell whether it is safe to retry
+        dumps = get_codec().dumps
+        for action, data in updates:
+            encoded = dumps(data)
+            if action == 'add' and data.get('overwrite') is not False:
+                self._updates.append((action, encoded))
+            else:
+                self._updates.append((action, data))
+            self._data.append((action, data))
+            self._bytes += len(encoded)
+            if (len(self._data) >= self._batch_size() or
+                    self._bytes >= self.max_bytes):
+                self._flush_buffer()
+        if (self._timer is None and self._data and
+                self.max_interval is not None):
+            self._timer = gevent.spawn_later(
+                self.max_interval, self._flush_expired, self._generation)
+
+    def _flush_expired(self, generation):
+        if generation == self._generation:
+            self._flush_buffer()
+
+    def _batch_size(self):
+        if self.adaptive is None:
+            return self.max_documents
+        return self.adaptive.documents
+
+    def _flush_buffer(self):
+        updates, data, size = self._updates, self._data, self._bytes
+        self._reset()
+        if data:
+            command = self._create_command(updates)
+            if self.adaptive is not None:
+                self._wait_for_slot()
+            self._in_flight += 1
+            self._flushes.spawn(self._send, command, data, size)
+
+    def _wait_for_slot(self):
+        # the pool allows max_concurrency flushes, wait until fewer than the
+        # current concurrency are in flight
+        while self._in_flight >= self.adaptive.concurrency:
+            self._flushed.clear()
+            self._flushed.wait()
+
+    def _send(self, command, data, size):
+        start = time.time()
+        try:
+            command.execute()
+            self._record(data, size, start)
+            self.indexed += len(data)
+        except StellrError as e:
+            self._record(data, size, start, e)
+            if self.isolate_failures and len(data) > 1 and not e.timeout:
+                self._send_each(data)
+            else:
+                self._report(data, e)
+        finally:
+            self._in_flight -= 1
+            self._flushed.set()
+
+    def _record(self, data, size, start, error=None):
+        if self.adaptive is not None:
+            self.adaptive.record(len(data), size, time.time() - start, error)
+
+    def _send_each(self, data):
+        for action, item in data:
+            command = self._create_command([(action, item)])
+            try:
+                command.execute()
+                self.indexed += 1
+            except StellrError as e:
+                self._report([(action, item)], e)
+
+    def _report(self, data, error):
+        self.failed += len(data)
+        for action, item in data:
+            if self.on_error is None:
+                self.errors.append((action, item, error))
+            else:
+                self.on_error(action, item, error)
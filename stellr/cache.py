@@ -0,0 +1,138 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+
+# the caches used by every cacheable command executed against a host
+_host_caches = {}
+
+def set_host_cache(host, cache):
+    """
+    Use the cache for every cacheable command executed against the host, or
+    stop caching for the host if cache is None.
+    """
+    if cache is None:
+        _host_caches.pop(host, None)
+    else:
+        _host_caches[host] = cache
+
+def get_host_cache(host):
+    """
+    Get the cache used for the host, or None if the host is not cached.
+    """
+    return _host_caches.get(host)
+
+class QueryCache(object):
+    """
+    An in-process cache of raw responses from Solr, evicting the least
+    recently used responses once the total size of the cached responses
+    exceeds max_bytes. The QueryCache has the following initialization
+    parameters:
+
+        max_bytes: the maximum size in bytes of all of the cached responses
+            (default=67108864)
+        ttl: the default number of seconds a response is cached for
+            (default=60)
+
+    Responses are stored as the raw data received from Solr so that each hit
+    returns a new JSON-parsed dict that may be modified by the caller.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = {}
+        # circular doubly linked list with the most recently used entry
+        # following the root, entries are [prev, next, key, data, expires]
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get the raw response cached for the key, or None if the key is not
+        cached or has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[4] <= time.time():
+            self.expirations += 1
+            self.misses += 1
+            self._remove(entry)
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._link(entry)
+        return entry[3]
+
+    def put(self, key, data, ttl=None):
+        """
+        Cache the raw response for the key for ttl seconds, defaulting to the
+        ttl of the cache. Responses larger than max_bytes are not cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+        if len(data) > self.max_bytes:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        entry = [None, None, key, data, expires]
+        self._entries[key] = entry
+        self._link(entry)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.evictions += 1
+            self._remove(self._root[0])
+
+    def clear(self):
+        """
+        Remove every response from the cache.
+        """
+        self._entries.clear()
+        self._root[:] = [self._root, self._root, None, None, None]
+        self.size = 0
+
+    def stats(self):
+        """
+        Get a dict of the counters and current size of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations,
+                'entries': len(self._entries), 'bytes': self.size}
+
+    def _link(self, entry):
+        # insert the entry as the most recently used
+        root = self._root
+        entry[0] = root
+        entry[1] = root[1]
+        root[1][0] = entry
+        root[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry[2]]
+        self.size -= len(entry[3])
@@ -0,0 +1,322 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import urllib3
+from gevent import monkey
+from urllib3 import poolmanager
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+from . import metrics
+from . import pool
+
+DEFAULT_HTTP_SIZE = 25
+DEFAULT_TIMEOUT = 15
+
+def patch_sockets():
+    """
+    Patch the socket and ssl modules with the cooperative versions of gevent,
+    so that http requests yield to other greenlets while they wait.
+    """
+    monkey.patch_socket()
+    monkey.patch_ssl()
+
+class HTTPPoolManager(urllib3.PoolManager):
+    """
+    A urllib3 PoolManager that keeps up to size idle connections to each
+    host, or the number in sizes for the hosts in it.
+    """
+
+    def __init__(self, size=DEFAULT_HTTP_SIZE, sizes=None, num_pools=10):
+        super(HTTPPoolManager, self).__init__(num_pools)
+        self.size = size
+        self.sizes = dict((_http_key(host), host_size)
+                          for host, host_size in (sizes or {}).items())
+
+    def connection_from_host(self, host, port=80, scheme='http'):
+        """
+        Get the connection pool of the host, creating it if needed.
+        """
+        key = (scheme, host, port)
+        conn_pool = self.pools.get(key)
+        if conn_pool:
+            return conn_pool
+        size = self.sizes.get(key, self.size)
+        pool_cls = poolmanager.pool_classes_by_scheme[scheme]
+        conn_pool = pool_cls(host, port, maxsize=size)
+        self.pools[key] = conn_pool
+        return conn_pool
+
+class StellrClient(object):
+    """
+    A StellrClient owns the transports that commands are executed with. None
+    of them are created until the first command needs them, so importing
+    stellr opens no pools and patches nothing. The StellrClient has the
+    following initialization parameters:
+
+        patch: whether to call patch_sockets when the http pool is created;
+            set to False when the application patches the socket module
+            itself or does not run commands in greenlets (default=True)
+        http_size: the number of connections kept open to each http host,
+            and when block is not None the most in use at once (default=25)
+        zmq_size: the maximum number of REQ sockets open to each ZeroMQ host
+            (default=10)
+        host_sizes: a dict of the maximum number of connections or sockets
+            to particular hosts, overriding http_size or zmq_size for those
+            hosts (default=None)
+        block: True to wait up to the timeout of a command for a connection
+            or socket when all of those to its host are in use, False to fail
+            at once, or None for the behavior of each transport: an extra
+            http connection is opened and closed once it is returned, and a
+            ZeroMQ request waits for a socket (default=None)
+        timeout: the timeout in seconds of the commands executed with the
+            client that were created without one (default=15)
+        shared: whether requests to ZeroMQ hosts use pool.zmq_socket_pool and
+            pool.zmq_dealer_pool, as the default client does, rather than
+            pools of the client's own; zmq_size and host_sizes then do not
+            apply to ZeroMQ hosts (default=False)
+        coalesce: whether a command that reads from the index (such as a
+            SelectCommand) waits for an identical command already in flight
+            to the same host and handler, rather than sending its own request
+            (default=False)
+
+    Coalesced commands receive the same parsed response, which should not be
+    modified, or the same StellrError as the command that sent the request,
+    waiting no longer than their own timeout.
+    The flights attribute holds the gevent AsyncResult of each request in
+    flight by host and handler.
+
+    A command that gets no connection or socket in time raises a StellrError
+    with timeout set to True. Commands are executed with the client by
+    passing them to execute or execute_stream, or by setting their client
+    attribute; commands without a client use the client returned by
+    get_client.
+    """
+
+    def __init__(self, patch=True, http_size=DEFAULT_HTTP_SIZE, zmq_size=10,
+                 host_sizes=None, block=None, timeout=DEFAULT_TIMEOUT,
+                 shared=False, coalesce=False):
+        self.patch = patch
+        self.http_size = http_size
+        self.zmq_size = zmq_size
+        self.host_sizes = host_sizes or {}
+        self.block = block
+        self.timeout = timeout
+        self.shared = shared
+        self.coalesce = coalesce
+        self.flights = {}
+        self._http_pool = None
+        self._socket_pool = None
+        self._dealer_pool = None
+        self._multiplexed = set()
+        self._slots = {}
+
+    @property
+    def http_pool(self):
+        """
+        The urllib3 PoolManager of the connections to http hosts, created on
+        first use.
+        """
+        if self._http_pool is None:
+            if self.patch:
+                patch_sockets()
+            sizes = dict((host, size) for host, size in self.host_sizes.items()
+                         if _is_http(host))
+            self._http_pool = HTTPPoolManager(self.http_size, sizes)
+        return self._http_pool
+
+    @property
+    def socket_pool(self):
+        """
+        The pool.PoolManager of the REQ sockets to ZeroMQ hosts, created on
+        first use.
+        """
+        if self.shared:
+            return pool.zmq_socket_pool.get_pool()
+        if self._socket_pool is None:
+            sizes = dict((host, size) for host, size in self.host_sizes.items()
+                         if not _is_http(host))
+            self._socket_pool = pool.PoolManager(pool.get_context(),
+                                                 self.zmq_size, sizes=sizes)
+        return self._socket_pool
+
+    def pool_timeout(self, timeout):
+        """
+        Get the number of seconds that a command with the timeout waits for a
+        connection or socket.
+        """
+        return 0 if self.block is False else timeout
+
+    def acquire(self, host, timeout):
+        """
+        Take one of the connections to the http host, waiting as long as block
+        allows for one to be released and raising a pool.PoolTimeout if none
+        is. Nothing is taken when block is None.
+        """
+        if self.block is None:
+            return
+        key = _http_key(host)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = Semaphore(self._http_size(key))
+        if not slots.acquire(timeout=self.pool_timeout(timeout)):
+            raise pool.PoolTimeout(
+                'No connection available for %s after %s seconds.'
+                % (host, self.pool_timeout(timeout)))
+
+    def release(self, host):
+        """
+        Release a connection to the http host taken with acquire.
+        """
+        if self.block is None:
+            return
+        self._slots[_http_key(host)].release()
+
+    def _http_size(self, key):
+        for host, size in self.host_sizes.items():
+            if _is_http(host) and _http_key(host) == key:
+                return size
+        return self.http_size
+
+    def zmq_socket(self, address, timeout):
+        """
+        Get a context manager that takes a REQ socket to the address from the
+        pool, waiting as long as block allows for one to be available.
+        """
+        timeout = self.pool_timeout(timeout)
+        if self.shared:
+            return pool.zmq_socket_pool(address, timeout)
+        return pool.zmq_socket_pool(address, timeout, self.socket_pool)
+
+    def multiplex(self, address, enabled=True):
+        """
+        Enable or disable multiplexing the requests to the ZeroMQ address over
+        a DEALER socket.
+        """
+        if self.shared:
+            pool.zmq_dealer_pool.multiplex(address, enabled)
+        elif enabled:
+            self._multiplexed.add(address)
+        else:
+            self._multiplexed.discard(address)
+
+    def is_multiplexed(self, address):
+        """
+        Whether requests to the ZeroMQ address are multiplexed.
+        """
+        if self.shared:
+            return pool.zmq_dealer_pool.is_multiplexed(address)
+        return address in self._multiplexed
+
+    def zmq_request(self, address, frames, timeout):
+        """
+        Send the frames to a multiplexed address and wait up to timeout
+        seconds for the reply, returning None if none was received.
+        """
+        if self.shared:
+            return pool.zmq_dealer_pool.request(address, frames, timeout)
+        if self._dealer_pool is None:
+            self._dealer_pool = pool.DealerManager(pool.get_context())
+        connection = self._dealer_pool.get_connection(address)
+        return connection.request(frames, timeout)
+
+    def execute(self, command, return_name=False):
+        """
+        Execute the command with the client, returning the result of its
+        execute method.
+        """
+        command.client = self
+        return command.execute(return_name)
+
+    def execute_stream(self, command):
+        """
+        Execute the SelectCommand with the client, returning the result of
+        its execute_stream method.
+        """
+        command.client = self
+        return command.execute_stream()
+
+    def add_to_registry(self, name, registry=None):
+        """
+        Include the stats of the client's pools in the snapshots of the
+        metrics registry (by default the current one) as name.http and
+        name.zmq. The pools of the default client are included as http and
+        zmq, those of other clients only once this has been called.
+        """
+        if registry is None:
+            registry = metrics.get_registry()
+        registry.add_pool('%s.http' % name, self.http_stats)
+        registry.add_pool('%s.zmq' % name, self.zmq_stats)
+
+    def http_stats(self):
+        """
+        Get a dict of the connections of each host in the http pool, with the
+        number of requests, the number that reused an idle connection (hits)
+        or created one (misses), and the number of idle connections.
+        """
+        stats = {}
+        if self._http_pool is None:
+            return stats
+        for (scheme, host, port), conn_pool in self._http_pool.pools.items():
+            created = conn_pool.num_connections
+            requests = conn_pool.num_requests
+            idle = len([c for c in conn_pool.pool.queue if c is not None])
+            stats['%s://%s:%s' % (scheme, host, port)] = {
+                'requests': requests, 'hits': max(requests - created, 0),
+                'misses': created, 'created': created, 'idle': idle}
+        return stats
+
+    def zmq_stats(self):
+        """
+        Get the stats of the REQ sockets open to each ZeroMQ host.
+        """
+        if self.shared:
+            return pool.zmq_socket_pool.stats()
+        if self._socket_pool is None:
+            return {}
+        return self._socket_pool.stats()
+
+def _is_http(host):
+    return host.startswith('http://') or host.startswith('https://')
+
+def _http_key(host):
+    # the key of the connection pool of an http host in the PoolManager
+    scheme, host, port = urllib3.get_host(host)
+    return scheme, host, port or poolmanager.port_by_scheme.get(scheme, 80)
+
+_client = None
+
+def get_client():
+    """
+    Get the client used by commands without their own, creating it on first
+    use.
+    """
+    global _client
+    if _client is None:
+        _client = StellrClient(shared=True)
+    return _client
+
+def set_client(client):
+    """
+    Set the client used by commands without their own, or go back to creating
+    one on first use if client is None. Returns the client.
+    """
+    global _client
+    _client = client
+    return client
+
+metrics.get_registry().add_pool('http', lambda: get_client().http_stats())
+metrics.get_registry().add_pool('zmq', lambda: get_client().zmq_stats())
@@ -0,0 +1,167 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# the double_precision values tried in turn, as ujson 1.x refuses values
+# above 15 while later versions accept 17
+_DOUBLE_PRECISIONS = (17, 15)
+
+def encode_datetime(o):
+    """
+    Encode a datetime instance, expected to be in UTC, in the format expected
+    by Solr: YYYY-MM-DDTHH:MM:SSZ. Precision is only to the second.
+    """
+    return o.strftime(DATETIME_FORMAT)
+
+def _default(o):
+    # only called by the encoder for objects it cannot encode itself
+    if isinstance(o, datetime.datetime):
+        return encode_datetime(o)
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+class JSONCodec(object):
+    """
+    The codec used to encode update bodies and decode responses, using
+    simplejson or the standard library's json module when simplejson is not
+    installed. A single encoder is created for the codec and reused, and
+    datetime instances are encoded as by StellrJSONEncoder.
+
+    Alternative codecs implement the dumps and loads methods and are selected
+    with set_codec.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(default=_default)
+        self._decoder = json.JSONDecoder()
+
+    def dumps(self, obj):
+        """
+        Encode the object as a JSON string.
+        """
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        """
+        Decode the JSON string, raising a ValueError if it is invalid.
+        """
+        return self._decoder.decode(data)
+
+class UltraJSONCodec(JSONCodec):
+    """
+    A codec using the ujson C extension. As ujson has no hook for objects it
+    cannot encode, documents are checked for datetime instances first and
+    only copied when one is found. Floats are encoded with the highest
+    double_precision and decoded with precise_float when the installed
+    version of ujson supports them, as its defaults round floats that
+    simplejson keeps exactly.
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError('ujson is not installed.')
+        self._dumps_options = {}
+        for precision in _DOUBLE_PRECISIONS:
+            options = _supported(ujson.dumps, 0.1, double_precision=precision)
+            if options:
+                self._dumps_options = options
+                break
+        self._loads_options = _supported(ujson.loads, '0.1',
+                                         precise_float=True)
+
+    def dumps(self, obj):
+        """
+        Encode the object as a JSON string.
+        """
+        return ujson.dumps(_prepare(obj), **self._dumps_options)
+
+    def loads(self, data):
+        """
+        Decode the JSON string, raising a ValueError if it is invalid.
+        """
+        return ujson.loads(data, **self._loads_options)
+
+def _supported(function, value, **options):
+    # the options if the ujson function accepts them, otherwise none
+    try:
+        function(value, **options)
+    except (TypeError, ValueError):
+        return {}
+    return options
+
+def _prepare(obj):
+    """
+    Return the object with any datetime instances it contains encoded as
+    strings, copying only the dicts and lists that contain one.
+    """
+    if isinstance(obj, dict):
+        prepared = None
+        for key, value in obj.iteritems():
+            encoded = _prepare(value)
+            if encoded is not value:
+                if prepared is None:
+                    prepared = dict(obj)
+                prepared[key] = encoded
+        return obj if prepared is None else prepared
+    if isinstance(obj, (list, tuple)):
+        prepared = None
+        for i, value in enumerate(obj):
+            encoded = _prepare(value)
+            if encoded is not value:
+                if prepared is None:
+                    prepared = list(obj)
+                prepared[i] = encoded
+        return obj if prepared is None else prepared
+    if isinstance(obj, datetime.datetime):
+        return encode_datetime(obj)
+    return obj
+
+CODECS = {'json': JSONCodec, 'ujson': UltraJSONCodec}
+
+_codec = JSONCodec()
+
+def get_codec():
+    """
+    Get the codec used to encode and decode JSON.
+    """
+    return _codec
+
+def set_codec(codec):
+    """
+    Set the codec used to encode and decode JSON, either a codec instance or
+    the name of one of the CODECS. Returns the codec.
+    """
+    global _codec
+    if isinstance(codec, basestring):
+        codec = CODECS[codec]()
+    _codec = codec
+    return codec
+
+def fastest_codec():
+    """
+    Select the fastest codec that is installed, returning it.
+    """
+    return set_codec('ujson' if ujson is not None else 'json')
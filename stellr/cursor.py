@@ -0,0 +1,128 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gevent
+import gevent.queue
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+from .sharding import ShardedSelectCommand
+from .stellr import SelectCommand, StellrError
+
+# the parameters replaced on each page request
+_PAGING_PARAMS = ('cursorMark', 'start', 'rows')
+
+class CursorIterator(object):
+    """
+    A CursorIterator walks every document matching a SelectCommand using
+    Solr's cursorMark deep paging, yielding the documents when iterated.
+    Pages are fetched by a background greenlet so that the next page is
+    requested while the current one is being consumed. The CursorIterator has
+    the following initialization parameters:
+
+        command: the SelectCommand with the parameters of the query, which
+            must include a sort on the uniqueKey field as required by Solr.
+            Any start, rows or cursorMark parameters are replaced.
+        rows: the number of documents in each page (default=1000)
+        prefetch: the number of pages that may be fetched ahead of the page
+            being consumed (default=1)
+
+    The num_found attribute is set once the first page has been received. A
+    StellrError raised while fetching a page is raised by the iterator after
+    the documents of the previous pages have been yielded.
+    """
+
+    def __init__(self, command, rows=1000, prefetch=1):
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1.')
+        if isinstance(command, ShardedSelectCommand):
+            raise ValueError('A ShardedSelectCommand cannot be paged with a '
+                             'cursor.')
+        self.command = command
+        self.rows = rows
+        self.prefetch = prefetch
+        self.num_found = None
+        self.pages = 0
+        self._fetcher = None
+
+    def __iter__(self):
+        # a page is only fetched while fewer than prefetch pages are waiting
+        # to be consumed
+        pages = gevent.queue.Queue()
+        ahead = Semaphore(self.prefetch)
+        self._fetcher = gevent.spawn(self._fetch, pages, ahead)
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, StellrError):
+                    raise page
+                ahead.release()
+                self.pages += 1
+                for doc in page:
+                    yield doc
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop fetching pages.
+        """
+        if self._fetcher is not None:
+            self._fetcher.kill()
+            self._fetcher = None
+
+    def _fetch(self, pages, ahead):
+        mark = '*'
+        while True:
+            ahead.acquire()
+            try:
+                response = self._page_command(mark).execute()
+                result = response.get('response', {})
+                if self.num_found is None:
+                    self.num_found = result.get('numFound')
+                docs = result.get('docs', [])
+                next_mark = response.get('nextCursorMark', mark)
+            except StellrError as e:
+                pages.put(e)
+                return
+            except Exception as e:
+                # the consumer waits for a page, so any error is passed on
+                pages.put(StellrError('Error: %s' % e,
+                                      url=self.command.handler))
+                return
+            if docs:
+                pages.put(docs)
+            # the cursor mark stops changing once every document is returned
+            if next_mark == mark or not docs:
+                pages.put(None)
+                return
+            mark = next_mark
+
+    def _page_command(self, mark):
+        command = self.command
+        page = SelectCommand(command.host, command._handler, command.name,
+                             command.timeout)
+        page.client = command.client
+        page.accept_gzip = command.accept_gzip
+        page.retry_policy = command.retry_policy
+        page.stream = command.stream
+        page._commands = [(name, value) for name, value in command._commands
+                          if name not in _PAGING_PARAMS]
+        page.add_param('rows', self.rows)
+        page.add_param('cursorMark', mark)
+        return page
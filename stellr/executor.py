@@ -0,0 +1,69 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import gevent
+import gevent.pool
+import gevent.queue
+
+from .stellr import StellrError
+
+def execute_many(commands, concurrency=10, timeout=None):
+    """
+    Execute the commands concurrently, at most concurrency at a time, and
+    yield a tuple of the command name and either the JSON-parsed response or
+    the StellrError raised as each command completes. Commands are executed
+    with their own host, so http and ZeroMQ commands may be mixed.
+
+    If timeout is set it is the number of seconds allowed for all of the
+    commands. Once it has passed any commands that have not completed are
+    stopped and yielded with a StellrError whose timeout field is True.
+    """
+    commands = list(commands)
+    deadline = None if timeout is None else time.time() + timeout
+    results = gevent.queue.Queue()
+    group = gevent.pool.Pool(concurrency)
+
+    def run(index, command):
+        try:
+            results.put((index, command.execute()))
+        except StellrError as e:
+            results.put((index, e))
+        except Exception as e:
+            results.put((index, StellrError('Error: %s' % e)))
+
+    def feed():
+        for index, command in enumerate(commands):
+            group.spawn(run, index, command)
+
+    feeder = gevent.spawn(feed)
+    pending = set(range(len(commands)))
+    try:
+        while pending:
+            wait = None
+            if deadline is not None:
+                wait = max(deadline - time.time(), 0)
+            try:
+                index, result = results.get(timeout=wait)
+            except gevent.queue.Empty:
+                break
+            pending.discard(index)
+            yield commands[index].name, result
+    finally:
+        feeder.kill()
+        group.kill()
+
+    for index in sorted(pending):
+        msg = 'Deadline exceeded after %s seconds.' % timeout
+        yield commands[index].name, StellrError(msg, timeout=True)
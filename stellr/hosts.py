@@ -0,0 +1,170 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import gevent
+
+from . import metrics
+from .retry import RetryPolicy
+from .stellr import SelectCommand, StellrError
+
+# the latencies measured for a host before its percentile is used
+MIN_HEDGE_SAMPLES = 20
+
+class HostGroup(object):
+    """
+    A HostGroup holds several equivalent replicas, any mix of http and ZeroMQ
+    hosts, and can be used as the host of any command. Each execution of a
+    command is sent to one of the hosts that is up, chosen in turn. A host is
+    marked down when a request to it times out or fails before a response is
+    received, and is then probed in the background until it answers again.
+    The HostGroup has the following initialization parameters:
+
+        hosts: a list of the equivalent solr hosts.
+        probe_handler: the handler called to check whether a host that is
+            down has recovered (default='/solr/admin/ping')
+        probe_interval: the number of seconds between probes of the hosts
+            that are down (default=5)
+        probe_timeout: the timeout of each probe in seconds (default=2)
+        hedge_delay: the number of seconds to wait for a read-only command
+            before sending it to a second host as well, using whichever
+            response arrives first, or None to not hedge (default=None)
+        hedge_percentile: hedge once the command has taken longer than this
+            percentile of the latencies measured for the first host in the
+            metrics registry, using hedge_delay until enough latencies have
+            been measured (default=None)
+        client: the StellrClient the probes are executed with, or None for
+            the client of the last command that marked a host down
+            (default=None)
+
+    If every host is down requests are still sent to the hosts in turn rather
+    than failing without being attempted. The hedged attribute counts the
+    commands sent to a second host and the cancelled attribute the requests
+    cancelled once the other host answered.
+    """
+
+    def __init__(self, hosts, probe_handler='/solr/admin/ping',
+                 probe_interval=5, probe_timeout=2, hedge_delay=None,
+                 hedge_percentile=None, client=None):
+        self.hosts = list(hosts)
+        if not self.hosts:
+            raise ValueError('At least one host is required.')
+        self.probe_handler = probe_handler
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.client = client
+        self._probe_client = None
+        self.hedged = 0
+        self.cancelled = 0
+        self._down = {}
+        self._next = 0
+        self._prober = None
+
+    def __str__(self):
+        return ','.join(self.hosts)
+
+    @property
+    def down(self):
+        """
+        A dict of the hosts that are down and the time they were marked down.
+        """
+        return dict(self._down)
+
+    def is_up(self, host):
+        """
+        Whether the host is currently considered up.
+        """
+        return host not in self._down
+
+    def choose(self, exclude=()):
+        """
+        Choose the host for the next request, skipping any hosts that are down
+        or in exclude when possible.
+        """
+        candidates = [h for h in self.hosts
+                      if h not in self._down and h not in exclude]
+        if not candidates:
+            candidates = [h for h in self.hosts if h not in exclude]
+        if not candidates:
+            candidates = self.hosts
+        self._next += 1
+        return candidates[self._next % len(candidates)]
+
+    def get_hedge_delay(self, name, host):
+        """
+        Get the number of seconds to wait for the command with the name sent
+        to the host before hedging, or None if it is not hedged.
+        """
+        if len(self.hosts) < 2:
+            return None
+        if self.hedge_percentile is not None:
+            measured = metrics.get_registry().commands.get((name, host))
+            if (measured is not None and
+                    measured.latency.count >= MIN_HEDGE_SAMPLES):
+                return measured.latency.percentile(self.hedge_percentile)
+        return self.hedge_delay
+
+    def mark_down(self, host, client=None):
+        """
+        Stop sending requests to the host until a probe succeeds, probing it
+        with the client of the command that failed when the group has none.
+        """
+        if client is not None:
+            self._probe_client = client
+        if host not in self._down:
+            self._down[host] = time.time()
+        if self._prober is None:
+            self._prober = gevent.spawn(self._probe)
+
+    def mark_up(self, host):
+        """
+        Start sending requests to the host again.
+        """
+        self._down.pop(host, None)
+
+    def stop(self):
+        """
+        Stop probing the hosts that are down.
+        """
+        if self._prober is not None:
+            self._prober.kill()
+            self._prober = None
+
+    def _probe(self):
+        try:
+            while self._down:
+                gevent.sleep(self.probe_interval)
+                gevent.joinall([gevent.spawn(self._check, host)
+                                for host in list(self._down)])
+        finally:
+            self._prober = None
+
+    def _check(self, host):
+        command = _ProbeCommand(host, handler=self.probe_handler,
+                                name='ping', timeout=self.probe_timeout)
+        command.client = self.client or self._probe_client
+        # a probe is repeated by the next interval rather than retried
+        command.retry_policy = RetryPolicy(max_retries=0)
+        try:
+            command.execute()
+        except StellrError:
+            return
+        self.mark_up(host)
+
+class _ProbeCommand(SelectCommand):
+    # a probe must reach the host, so it is never answered from a cache or
+    # by an identical command in flight
+    cacheable = False
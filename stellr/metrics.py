@@ -0,0 +1,305 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bisect
+
+# the upper bounds in seconds of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+    """
+    A histogram of values counted in fixed buckets, so that recording a value
+    takes constant time and memory. Percentiles are estimated as the upper
+    bound of the bucket they fall in.
+
+        buckets: the sorted upper bounds of the buckets, values greater than
+            the last bound are counted in an overflow bucket
+            (default=DEFAULT_BUCKETS)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Count the value in its bucket.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Estimate the value below which percent of the values fall, or None if
+        no values have been counted.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Get a dict of the count, sum, min, max, mean and estimated p50, p90
+        and p99 of the values, and the count in each bucket.
+        """
+        return {'count': self.count, 'sum': self.total,
+                'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': zip(self.buckets + (None,), self.counts)}
+
+class Compression(object):
+    """
+    The number, sizes and time taken of the bodies compressed or
+    decompressed.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    def add(self, raw, compressed, seconds):
+        """
+        Count a body of raw bytes compressed to compressed bytes.
+        """
+        self.count += 1
+        self.raw_bytes += raw
+        self.compressed_bytes += compressed
+        self.seconds += seconds
+
+    def snapshot(self):
+        """
+        Get a dict of the counts, the ratio of compressed to raw bytes and the
+        seconds taken.
+        """
+        ratio = None
+        if self.raw_bytes:
+            ratio = float(self.compressed_bytes) / self.raw_bytes
+        return {'count': self.count, 'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes, 'ratio': ratio,
+                'seconds': self.seconds}
+
+class CommandMetrics(object):
+    """
+    The metrics recorded for the commands with one name executed against one
+    host.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.latency = Histogram(buckets)
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.cached = 0
+        self.coalesced = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.compressed_requests = Compression()
+        self.compressed_responses = Compression()
+
+    def snapshot(self):
+        """
+        Get a dict of the metrics.
+        """
+        return {'requests': self.requests, 'errors': self.errors,
+                'timeouts': self.timeouts, 'retries': self.retries,
+                'cached': self.cached,
+                'coalesced': self.coalesced,
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes,
+                'compressed_requests': self.compressed_requests.snapshot(),
+                'compressed_responses': self.compressed_responses.snapshot(),
+                'latency': self.latency.snapshot()}
+
+class MetricsRegistry(object):
+    """
+    The MetricsRegistry records the latency, errors, timeouts, retries and
+    bytes sent and received of every command executed, by command name and
+    host. The statistics of the connection pools are read from the functions
+    added with add_pool when a snapshot is taken. The MetricsRegistry has the
+    following initialization parameters:
+
+        buckets: the upper bounds in seconds of the buckets of the latency
+            histograms (default=DEFAULT_BUCKETS)
+        enabled: whether anything is recorded (default=True)
+        profile: whether the time spent in each phase of every command is
+            measured, setting the timings attribute of the command and of any
+            StellrError raised (default=False)
+        profile_hook: a function called with the command, its timings and the
+            StellrError raised or None after each command is executed while
+            profiling (default=None)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, enabled=True, profile=False,
+                 profile_hook=None):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.profile = profile
+        self.profile_hook = profile_hook
+        self.commands = {}
+        self.pools = {}
+
+    def get(self, name, host):
+        """
+        Get the metrics of the commands with the name executed against the
+        host, creating them if necessary.
+        """
+        key = (name, str(host))
+        metrics = self.commands.get(key)
+        if metrics is None:
+            metrics = self.commands[key] = CommandMetrics(self.buckets)
+        return metrics
+
+    def record(self, name, host, elapsed, error=None):
+        """
+        Record the execution of a command that took elapsed seconds, and the
+        StellrError raised by it if it failed.
+        """
+        if not self.enabled:
+            return
+        metrics = self.get(name, host)
+        metrics.requests += 1
+        metrics.latency.add(elapsed)
+        if error is not None:
+            metrics.errors += 1
+            if error.timeout:
+                metrics.timeouts += 1
+
+    def record_bytes(self, name, host, sent, received):
+        """
+        Record the size of the request and response of a command.
+        """
+        if not self.enabled:
+            return
+        metrics = self.get(name, host)
+        metrics.request_bytes += sent
+        metrics.response_bytes += received
+
+    def record_compression(self, name, host, raw, compressed, seconds,
+                           response=False):
+        """
+        Record the gzip compression of a request body, or the decompression
+        of a response body if response is True.
+        """
+        if not self.enabled:
+            return
+        metrics = self.get(name, host)
+        if response:
+            metrics.compressed_responses.add(raw, compressed, seconds)
+        else:
+            metrics.compressed_requests.add(raw, compressed, seconds)
+
+    def record_retry(self, name, host):
+        """
+        Record a failed command that is about to be retried.
+        """
+        if not self.enabled:
+            return
+        self.get(name, host).retries += 1
+
+    def record_cached(self, name, host):
+        """
+        Record a command answered from a cache without a request to the host.
+        """
+        if not self.enabled:
+            return
+        self.get(name, host).cached += 1
+
+    def record_coalesced(self, name, host):
+        """
+        Record a command that waited for an identical command in flight
+        instead of sending a request to the host.
+        """
+        if not self.enabled:
+            return
+        self.get(name, host).coalesced += 1
+
+    def profiled(self, command, timings, error=None):
+        """
+        Pass the timings of a command that has been executed to the
+        profile_hook.
+        """
+        if self.profile_hook is not None:
+            self.profile_hook(command, timings, error)
+
+    def add_pool(self, name, stats):
+        """
+        Include the dict returned by the stats function in snapshots under the
+        name of the pool.
+        """
+        self.pools[name] = stats
+
+    def snapshot(self):
+        """
+        Get a dict of the metrics of each command name by host and of each
+        pool.
+        """
+        commands = {}
+        for (name, host), metrics in self.commands.items():
+            commands.setdefault(name, {})[host] = metrics.snapshot()
+        pools = dict((name, stats()) for name, stats in self.pools.items())
+        return {'commands': commands, 'pools': pools}
+
+    def reset(self):
+        """
+        Discard the metrics recorded for every command.
+        """
+        self.commands = {}
+
+_registry = MetricsRegistry()
+
+def get_registry():
+    """
+    Get the registry that the metrics of every command are recorded in.
+    """
+    return _registry
+
+def set_registry(registry):
+    """
+    Set the registry that the metrics of every command are recorded in,
+    keeping the pools of the current registry. Returns the registry.
+    """
+    global _registry
+    for name, stats in _registry.pools.items():
+        registry.pools.setdefault(name, stats)
+    _registry = registry
+    return registry
+
+def snapshot():
+    """
+    Get a snapshot of the metrics of the registry.
+    """
+    return _registry.snapshot()
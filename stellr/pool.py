@@ -12,96 +12,447 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import itertools
+import time
+import gevent
+import gevent.event
 import gevent.queue
 from gevent_zeromq import zmq
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+# the context that sockets are created with, created on first use
+_context = None
+
+def get_context():
+    """
+    Get the ZeroMQ context that the pools create sockets with, creating it on
+    first use.
+    """
+    global _context
+    if _context is None:
+        _context = zmq.Context()
+    return _context
+
+class PoolTimeout(Exception):
+    """
+    Raised when no socket became available within the timeout.
+    """
+    pass
 
 class PoolManager(object):
     """
     The PoolManager is used to manage pools of ZeroMQ connections.
 
-    size: the maximum size of each pool
+    size: the maximum number of sockets open to each address
+    idle_ttl: the number of seconds a socket may sit unused in the pool
+        before it is closed, or None to keep idle sockets open (default=None)
+    check: whether to check an idle socket is still connected to its peer
+        before it is reused, replacing it with a new socket if not; sockets
+        are created with ZMQ_IMMEDIATE so that only a completed connection
+        counts, and a peer that stopped without closing the connection is
+        only detected with heartbeat (default=False)
+    heartbeat: the interval in seconds of the ZMTP heartbeats sent on each
+        socket so that a dead peer is detected, or None to not send them; it
+        requires libzmq 4.2 or later (default=None)
+    sizes: a dict of the maximum number of sockets open to particular
+        addresses, overriding size for those addresses (default=None)
+
+    Sockets are created as they are needed until size sockets are open to an
+    address, after which callers wait for a socket to be returned to the pool
+    or destroyed. The most recently returned socket is reused first so that
+    sockets beyond those needed sit idle and expire.
     """
 
-    def __init__(self, context, size=10):
+    def __init__(self, context, size=10, idle_ttl=None, check=False,
+                 heartbeat=None, sizes=None):
         self.context = context
         self.size = size
+        self.sizes = sizes or {}
+        self.idle_ttl = idle_ttl
+        self.check = check
+        self.heartbeat = heartbeat
         self.pools = {}
+        self.slots = {}
+        self.counters = {}
+        self._reaper = None
 
-    def get_socket(self, address):
+    def get_socket(self, address, timeout=None):
         """
         Get an open socket from a pool, creating a new pool and/or a new open
-        socket as necessary.
+        socket as necessary. If size sockets are already in use this waits
+        up to timeout seconds (forever if None) for one to become available,
+        raising a PoolTimeout if none does.
         """
-        pool = self.pools.get(address)
-        if not pool:
-            pool = gevent.queue.Queue(maxsize=self.size)
-            self.pools[address] = pool
-        if pool.empty():
-            return self._create_socket(address)
+        pool = self._get_pool(address)
+        if not self.slots[address].acquire(timeout=timeout):
+            raise PoolTimeout('No socket available for %s after %s seconds.'
+                              % (address, timeout))
+        now = time.time()
+        while True:
+            try:
+                socket, returned = pool.get_nowait()
+            except gevent.queue.Empty:
+                break
+            if self._is_expired(returned, now) or not self._is_alive(socket):
+                self._close_socket(address, socket)
+                continue
+            self.counters[address]['hits'] += 1
+            return socket
+        self.counters[address]['misses'] += 1
         try:
-            return pool.get_nowait()
-        except gevent.queue.Empty:
-            #TODO: his should not happen, log an error
             return self._create_socket(address)
+        except:
+            self.slots[address].release()
+            raise
 
     def replace_socket(self, address, socket):
         """
-        Put a socket back into the pool unless it is full, then close and
-        discard of it.
+        Put a socket back into the pool so that it can be reused.
         """
         pool = self.pools.get(address)
         if not pool:
             #TODO: his should not happen, log an error
             self.destroy_socket(socket)
-        elif pool.full():
-            #TODO: this could happen, log a warning that the pool is full
-            self.destroy_socket(socket)
-        else:
-            try:
-                pool.put_nowait(socket)
-            except gevent.queue.Full:
+            return
+        try:
+            pool.put_nowait((socket, time.time()))
+        except gevent.queue.Full:
             #TODO: his should not happen, log an error
-                self.destroy_socket(socket)
+            self._close_socket(address, socket)
+        self.slots[address].release()
 
-    def destroy_socket(self, socket):
+    def destroy_socket(self, socket, address=None):
         """
-        Close a socket.
+        Close a socket. If the address is given the socket was taken from the
+        pool for that address, and another socket may now be opened to it.
         """
-        socket.setsockopt(zmq.LINGER, 0)
-        socket.close()
+        self._close_socket(address, socket)
+        if address in self.slots:
+            self.slots[address].release()
+
+    def warm(self, address, count):
+        """
+        Open up to count sockets to the address and leave them idle in the
+        pool, so that the first requests do not wait for them to connect.
+        Returns the number of sockets opened.
+        """
+        pool = self._get_pool(address)
+        count = min(count, self.get_size(address) - self._open(address))
+        for i in range(count):
+            pool.put_nowait((self._create_socket(address), time.time()))
+        return max(count, 0)
+
+    def evict_idle(self):
+        """
+        Close every socket that has been idle for longer than idle_ttl,
+        returning the number closed.
+        """
+        if self.idle_ttl is None:
+            return 0
+        now = time.time()
+        evicted = 0
+        for address, pool in self.pools.items():
+            idle = []
+            while not pool.empty():
+                idle.append(pool.get_nowait())
+            # put back the sockets in use most recently last
+            for socket, returned in idle[::-1]:
+                if self._is_expired(returned, now):
+                    self._close_socket(address, socket)
+                    evicted += 1
+                else:
+                    pool.put_nowait((socket, returned))
+        return evicted
+
+    def stats(self):
+        """
+        Get a dict of the sockets of each address, with the number open,
+        idle and in use, the number of requests for a socket that reused an
+        idle socket (hits) or created one (misses), and the number created
+        and destroyed.
+        """
+        stats = {}
+        for address, pool in self.pools.items():
+            in_use = self.get_size(address) - self.slots[address].counter
+            stats[address] = dict(self.counters[address], idle=pool.qsize(),
+                                  in_use=in_use, size=in_use + pool.qsize())
+        return stats
+
+    def get_size(self, address):
+        """
+        Get the maximum number of sockets open to the address.
+        """
+        return self.sizes.get(address, self.size)
+
+    def _get_pool(self, address):
+        pool = self.pools.get(address)
+        if pool is None:
+            pool = gevent.queue.LifoQueue()
+            self.pools[address] = pool
+            self.slots[address] = Semaphore(self.get_size(address))
+            self.counters[address] = {'hits': 0, 'misses': 0,
+                                      'created': 0, 'destroyed': 0}
+            if self.idle_ttl is not None and self._reaper is None:
+                self._reaper = gevent.spawn(self._reap)
+        return pool
+
+    def _open(self, address):
+        # the number of sockets open to the address, idle or in use
+        return (self.get_size(address) - self.slots[address].counter +
+                self.pools[address].qsize())
+
+    def _is_expired(self, returned, now):
+        return self.idle_ttl is not None and now - returned > self.idle_ttl
+
+    def _is_alive(self, socket):
+        # with ZMQ_IMMEDIATE a REQ socket can only send once it is connected
+        if not self.check:
+            return True
+        try:
+            return bool(socket.getsockopt(zmq.EVENTS) & zmq.POLLOUT)
+        except zmq.ZMQError:
+            return False
+
+    def _reap(self):
+        while True:
+            gevent.sleep(self.idle_ttl)
+            self.evict_idle()
 
     def _create_socket(self, address):
         socket = self.context.socket(zmq.REQ)
+        if self.check:
+            # otherwise a socket can send whether or not a peer is connected
+            socket.setsockopt(zmq.IMMEDIATE, 1)
+        if self.heartbeat is not None:
+            socket.setsockopt(zmq.HEARTBEAT_IVL, int(self.heartbeat * 1000))
+            socket.setsockopt(zmq.HEARTBEAT_TIMEOUT,
+                              int(self.heartbeat * 3000))
         socket.connect(address)
+        if address in self.counters:
+            self.counters[address]['created'] += 1
         return socket
 
+    def _close_socket(self, address, socket):
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.close()
+        if address in self.counters:
+            self.counters[address]['destroyed'] += 1
+
 class zmq_socket_pool(object):
     """
     The pool class provides access to the pol through a with statement
     that will automatically close a socket if the pool is full or an exception
-    was raised during execution.
+    was raised during execution. Unless create has been called, a pool with
+    the default settings is created on first use. The socket is taken from
+    the PoolManager passed as manager, or from the shared pool if None.
     """
     pool = None
 
     @classmethod
-    def create(cls, context, size=10):
+    def create(cls, context, size=10, idle_ttl=None, check=False,
+               heartbeat=None):
         """
         Create the connection pool.
         """
-        zmq_socket_pool.pool = PoolManager(context, size)
+        zmq_socket_pool.pool = PoolManager(context, size, idle_ttl, check,
+                                           heartbeat)
+
+    @classmethod
+    def get_pool(cls):
+        """
+        Get the PoolManager, creating it with the default settings if create
+        has not been called.
+        """
+        if zmq_socket_pool.pool is None:
+            zmq_socket_pool.create(get_context())
+        return zmq_socket_pool.pool
+
+    @classmethod
+    def warm(cls, addresses, count):
+        """
+        Open up to count sockets to each of the addresses.
+        """
+        for address in addresses:
+            zmq_socket_pool.get_pool().warm(address, count)
 
-    def __init__(self, address):
+    @classmethod
+    def stats(cls):
+        """
+        Get the stats of the sockets open to each address.
+        """
+        if zmq_socket_pool.pool is None:
+            return {}
+        return zmq_socket_pool.pool.stats()
+
+    def __init__(self, address, timeout=None, manager=None):
         self.address = address
+        self.timeout = timeout
+        self.manager = manager
 
     def __enter__(self):
-        self.socket = zmq_socket_pool.pool.get_socket(self.address)
+        if self.manager is None:
+            self.manager = zmq_socket_pool.get_pool()
+        self.socket = self.manager.get_socket(self.address, self.timeout)
         return self.socket
 
     def __exit__(self, type, value, traceback):
         # was there an error? if so, ditch this socket
         if value:
-            zmq_socket_pool.pool.destroy_socket(self.socket)
+            self.manager.destroy_socket(self.socket, self.address)
             return False
         else:
-            zmq_socket_pool.pool.replace_socket(self.address, self.socket)
-            return True
\ No newline at end of file
+            self.manager.replace_socket(self.address, self.socket)
+            return True
+
+def send_frames(socket, frames, copy=True):
+    """
+    Send each of the frames as the parts of a single multipart message,
+    without needing to know in advance how many frames there are. With
+    copy=False ZeroMQ sends the frames from the strings without copying them.
+    """
+    previous = None
+    for frame in frames:
+        if previous is not None:
+            socket.send(previous, zmq.SNDMORE, copy=copy)
+        previous = frame
+    socket.send(previous or '', copy=copy)
+
+class DealerConnection(object):
+    """
+    A DealerConnection multiplexes many concurrent requests over a single
+    DEALER socket. Each request is sent with a unique id as its envelope, which
+    a REP (or ROUTER) socket on the remote host returns with the reply, and a
+    reader greenlet routes each reply to the greenlet waiting for it.
+    """
+
+    def __init__(self, context, address):
+        self.address = address
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.connect(address)
+        self.pending = {}
+        self.closed = False
+        self._ids = itertools.count()
+        self._send_lock = Semaphore()
+        self._reader = gevent.spawn(self._read)
+
+    def request(self, frames, timeout=None):
+        """
+        Send the frames as a request and wait up to timeout seconds for the
+        reply, returning None if none was received.
+        """
+        request_id = str(next(self._ids))
+        result = gevent.event.AsyncResult()
+        self.pending[request_id] = result
+        try:
+            # frames of concurrent requests must not be interleaved
+            with self._send_lock:
+                send_frames(self.socket,
+                            itertools.chain([request_id, ''], frames),
+                            copy=False)
+            return result.get(timeout=timeout)
+        except gevent.Timeout:
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+
+    def close(self):
+        """
+        Close the socket, failing any requests that are waiting for a reply.
+        """
+        self.closed = True
+        self._reader.kill(block=False)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
+        self._fail(zmq.ZMQError('Connection to %s closed.' % self.address))
+
+    def _read(self):
+        try:
+            while True:
+                frames = self.socket.recv_multipart(copy=False)
+                # a reply to a request that timed out is dropped
+                result = self.pending.get(frames[0].bytes)
+                if result is not None:
+                    result.set(frames[-1].bytes)
+        except Exception as e:
+            self.closed = True
+            self._fail(e)
+
+    def _fail(self, error):
+        for result in self.pending.values():
+            result.set_exception(error)
+
+class DealerManager(object):
+    """
+    The DealerManager holds the DealerConnections used to multiplex requests
+    to each address.
+
+    sockets: the number of DEALER sockets used for each address
+    """
+
+    def __init__(self, context, sockets=1):
+        self.context = context
+        self.sockets = sockets
+        self.connections = {}
+        self._next = itertools.count()
+
+    def get_connection(self, address):
+        """
+        Get a connection to the address, replacing any that have closed.
+        """
+        connections = self.connections.setdefault(address, [])
+        if len(connections) < self.sockets:
+            connections.append(DealerConnection(self.context, address))
+            return connections[-1]
+        index = next(self._next) % len(connections)
+        if connections[index].closed:
+            connections[index] = DealerConnection(self.context, address)
+        return connections[index]
+
+class zmq_dealer_pool(object):
+    """
+    Provides access to the multiplexed DEALER transport. Requests to an
+    address are only multiplexed once it has been enabled with multiplex,
+    other addresses use the REQ sockets of zmq_socket_pool. Unless create has
+    been called, a manager with one socket to each address is created on
+    first use.
+    """
+    manager = None
+    addresses = set()
+
+    @classmethod
+    def create(cls, context, sockets=1):
+        """
+        Create the manager of the DEALER connections.
+        """
+        zmq_dealer_pool.manager = DealerManager(context, sockets)
+
+    @classmethod
+    def multiplex(cls, address, enabled=True):
+        """
+        Enable or disable multiplexing requests to the address.
+        """
+        if enabled:
+            zmq_dealer_pool.addresses.add(address)
+        else:
+            zmq_dealer_pool.addresses.discard(address)
+
+    @classmethod
+    def is_multiplexed(cls, address):
+        """
+        Whether requests to the address are multiplexed.
+        """
+        return address in zmq_dealer_pool.addresses
+
+    @classmethod
+    def request(cls, address, frames, timeout=None):
+        """
+        Send the frames to the address and wait up to timeout seconds for the
+        reply, returning None if none was received.
+        """
+        if zmq_dealer_pool.manager is None:
+            zmq_dealer_pool.create(get_context())
+        connection = zmq_dealer_pool.manager.get_connection(address)
+        return connection.request(frames, timeout)
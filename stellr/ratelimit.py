@@ -0,0 +1,221 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+
+WAIT = 'wait'
+FAIL = 'fail'
+BUDGET = 'budget'
+
+# the limiters of each host and of each command name
+_hosts = {}
+_names = {}
+
+def set_limit(host=None, name=None, requests=None, bytes=None, burst=1,
+              mode=WAIT, budget=None):
+    """
+    Limit the rate of the requests sent to the host, or of those sent by the
+    commands with the name, replacing any existing limit. Returns the
+    RateLimiter created with the remaining parameters.
+    """
+    limits = _limits(host, name)
+    key = host if host is not None else name
+    limiter = limits[key] = RateLimiter(requests, bytes, burst, mode,
+                                        budget)
+    return limiter
+
+def remove_limit(host=None, name=None):
+    """
+    Stop limiting the rate of the requests sent to the host, or of those sent
+    by the commands with the name.
+    """
+    _limits(host, name).pop(host if host is not None else name, None)
+
+def clear():
+    """
+    Remove every limit.
+    """
+    _hosts.clear()
+    _names.clear()
+
+def get_limiter(host=None, name=None):
+    """
+    Get the limiter of the host or of the command name, or None if there is
+    none.
+    """
+    return _limits(host, name).get(host if host is not None else name)
+
+def stats():
+    """
+    Get a dict of the stats of the limiter of each host and command name.
+    """
+    return {'hosts': dict((host, limiter.stats())
+                          for host, limiter in _hosts.items()),
+            'names': dict((name, limiter.stats())
+                          for name, limiter in _names.items())}
+
+def reserve(name, host, size=0, timeout=None):
+    """
+    Take a request of size bytes from the limiters of the host and of the
+    command name, returning the number of seconds to wait before it is sent.
+    Nothing is taken and RateLimited is raised if a limiter refuses to wait
+    that long for a command with the timeout.
+    """
+    if not _hosts and not _names:
+        return 0
+    limiters = [(scope, key, limiter) for scope, key, limiter in
+                (('host', host, _hosts.get(host)),
+                 ('command', name, _names.get(name)))
+                if limiter is not None]
+    now = time.time()
+    delay = 0
+    for scope, key, limiter in limiters:
+        wait = limiter.delay(size, now)
+        if not limiter.allows(wait, timeout):
+            limiter.rejected += 1
+            raise RateLimited('Rate limit of %s %s exceeded, %.3f seconds '
+                              'to wait.' % (scope, key, wait))
+        delay = max(delay, wait)
+    for scope, key, limiter in limiters:
+        limiter.take(size, delay)
+    return delay
+
+def _limits(host, name):
+    if (host is None) == (name is None):
+        raise ValueError('Either a host or a command name is required.')
+    return _hosts if host is not None else _names
+
+class RateLimited(Exception):
+    """
+    Raised when a limiter refuses a request.
+    """
+    pass
+
+class TokenBucket(object):
+    """
+    A TokenBucket fills with rate tokens each second up to capacity. Tokens
+    taken beyond those available are owed, so that the requests waiting for
+    the bucket are sent in the order they were taken in.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def delay(self, tokens, now):
+        """
+        Get the number of seconds until the tokens are available.
+        """
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.capacity)
+        self.updated = now
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens):
+        """
+        Take the tokens from the bucket, whether or not they are available.
+        """
+        self.tokens -= tokens
+
+class RateLimiter(object):
+    """
+    A RateLimiter limits the rate of requests with a token bucket for the
+    number of requests and another for the bytes of their bodies. Each bucket
+    holds burst seconds of its rate, so that a quiet period allows a short
+    burst. The RateLimiter has the following initialization parameters:
+
+        requests: the number of requests allowed each second, or None for no
+            limit (default=None)
+        bytes: the number of bytes of request bodies allowed each second, or
+            None for no limit (default=None)
+        burst: the number of seconds of requests and bytes that can be sent
+            at once (default=1)
+        mode: WAIT to delay a request until the limits allow it however long
+            that takes, FAIL to refuse any request the limits do not allow at
+            once, or BUDGET to wait up to budget seconds and refuse requests
+            that would need longer (default=WAIT)
+        budget: the number of seconds a request may wait in BUDGET mode, or
+            None for the timeout of the command (default=None)
+
+    The bytes of a streamed body are not known before it is sent and are not
+    counted. As greenlets only switch while waiting, the buckets are shared
+    by every greenlet without locking.
+    """
+
+    def __init__(self, requests=None, bytes=None, burst=1, mode=WAIT,
+                 budget=None):
+        if mode not in (WAIT, FAIL, BUDGET):
+            raise ValueError('Unknown rate limit mode: %s' % mode)
+        self.mode = mode
+        self.budget = budget
+        self.requests = None
+        self.bytes = None
+        if requests is not None:
+            self.requests = TokenBucket(requests, requests * burst)
+        if bytes is not None:
+            self.bytes = TokenBucket(bytes, bytes * burst)
+        self.allowed = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.waited = 0.0
+
+    def delay(self, size, now=None):
+        """
+        Get the number of seconds until a request of size bytes is allowed.
+        """
+        if now is None:
+            now = time.time()
+        delay = 0
+        if self.requests is not None:
+            delay = self.requests.delay(1, now)
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.delay(size, now))
+        return delay
+
+    def allows(self, delay, timeout=None):
+        """
+        Whether a request of a command with the timeout may wait delay
+        seconds.
+        """
+        if not delay or self.mode == WAIT:
+            return True
+        if self.mode == FAIL:
+            return False
+        budget = self.budget if self.budget is not None else timeout
+        return budget is None or delay <= budget
+
+    def take(self, size, delay=0):
+        """
+        Take a request of size bytes that is sent after delay seconds.
+        """
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.bytes is not None:
+            self.bytes.take(size)
+        self.allowed += 1
+        if delay:
+            self.delayed += 1
+            self.waited += delay
+
+    def stats(self):
+        """
+        Get a dict of the requests allowed, delayed and rejected, and the
+        seconds that requests were delayed for.
+        """
+        return {'allowed': self.allowed, 'delayed': self.delayed,
+                'rejected': self.rejected, 'waited': self.waited}
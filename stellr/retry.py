@@ -0,0 +1,121 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import time
+
+class RetryPolicy(object):
+    """
+    A RetryPolicy decides whether a failed command is executed again and how
+    long to wait first. Only commands that are idempotent are retried, and
+    only after a timeout, a request that got no response or a 5xx status, and
+    a retry is sent to a different host of a HostGroup when one is available.
+    The RetryPolicy has the following initialization parameters:
+
+        max_retries: the maximum number of retries of a command (default=2)
+        backoff: the number of seconds to wait before the first retry, which
+            doubles for each further retry (default=0.05)
+        max_backoff: the maximum number of seconds to wait before a retry
+            (default=1)
+        jitter: the fraction of each wait that is randomized, so that
+            commands that failed together are not retried together
+            (default=0.5)
+        budget: the number of retries allowed for each command executed, so
+            that retries cannot multiply the load on a failing cluster
+            (default=0.1)
+        min_budget: the number of retries allowed however few commands have
+            been executed, and the most retries that can be saved up
+            (default=10)
+        deadline: the number of seconds from the start of the first attempt
+            by which every attempt must complete, capping the timeout of each
+            attempt, or None for no deadline (default=None)
+    """
+
+    def __init__(self, max_retries=2, backoff=0.05, max_backoff=1,
+                 jitter=0.5, budget=0.1, min_budget=10, deadline=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.min_budget = min_budget
+        self.deadline = deadline
+        self.tokens = float(min_budget)
+        self.retries = 0
+        self.exhausted = 0
+
+    def record_request(self):
+        """
+        Record the execution of a command, adding to the retry budget.
+        """
+        self.tokens = min(self.tokens + self.budget, self.min_budget)
+
+    def is_retryable(self, error):
+        """
+        Whether the StellrError may be resolved by retrying the command.
+        """
+        return (error.timeout or error.status >= 500 or
+                (error.status < 0 and error.response is None))
+
+    def retry_delay(self, error, retries, start):
+        """
+        Get the number of seconds to wait before retrying a command that has
+        already been retried retries times and first started at start, or
+        None if it should not be retried.
+        """
+        if retries >= self.max_retries or not self.is_retryable(error):
+            return None
+        delay = self.backoff_delay(retries)
+        if self.deadline is not None:
+            if time.time() + delay >= start + self.deadline:
+                return None
+        if self.tokens < 1:
+            self.exhausted += 1
+            return None
+        self.tokens -= 1
+        self.retries += 1
+        return delay
+
+    def backoff_delay(self, retries):
+        """
+        Get the randomized number of seconds to wait before a retry.
+        """
+        delay = min(self.backoff * 2 ** retries, self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+    def attempt_timeout(self, timeout, start):
+        """
+        Get the timeout of an attempt, capped so that it ends by the deadline.
+        """
+        if self.deadline is None:
+            return timeout
+        return max(min(timeout, start + self.deadline - time.time()), 0)
+
+_policy = None
+
+def get_policy():
+    """
+    Get the policy used for commands without their own retry_policy, or None
+    if they are not retried.
+    """
+    return _policy
+
+def set_policy(policy):
+    """
+    Set the policy used for commands without their own retry_policy, or stop
+    retrying them if policy is None. Returns the policy.
+    """
+    global _policy
+    _policy = policy
+    return policy
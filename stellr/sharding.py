@@ -0,0 +1,245 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import heapq
+import re
+
+from .executor import execute_many
+from .stellr import SelectCommand, StellrError
+
+DEFAULT_ROWS = 10
+DEFAULT_FACET_LIMIT = 100
+
+class ShardedSelectCommand(SelectCommand):
+    """
+    A ShardedSelectCommand sends the same request to each of several hosts
+    that hold a shard of an index and merges the responses into one. It is
+    used in the same way as a SelectCommand and has the following
+    initialization parameters:
+
+        hosts: a list of the solr hosts the command will be executed against,
+            which may be http or ZeroMQ hosts.
+        handler: the handler on the remote hosts that will be called
+            (default='/solr/select')
+        name: the name of the command (default='select')
+        timeout: the timeout of the call to the hosts in seconds, or None for
+            the timeout of the client (default=None)
+
+    Each shard is asked for the first start + rows documents, which are
+    merged in the order of the sort parameter (or by score when there is no
+    sort) so only the requested page is returned. Fields needed to merge are
+    added to the fl parameter. The numFound values are summed, as are the
+    counts of facet.field and facet.query facets; facet field counts are
+    only as complete as the per shard facet.limit allows.
+
+    The cache, cache_ttl, accept_gzip and retry_policy attributes apply to
+    the request to each shard. If the request to any shard fails its
+    StellrError is raised. Responses cannot be streamed, and a
+    ShardedSelectCommand cannot be walked by a CursorIterator.
+    """
+
+    def __init__(self, hosts, handler='/solr/select', name='select',
+                 timeout=None):
+        hosts = list(hosts)
+        if not hosts:
+            raise ValueError('At least one host is required.')
+        super(ShardedSelectCommand, self).__init__(
+            hosts[0], handler, name, timeout)
+        self.hosts = hosts
+
+    def execute(self, return_name=False):
+        """
+        Execute the command against every shard concurrently, returning the
+        merged response as a JSON-parsed dict or a tuple with the merged dict
+        and the command name.
+        """
+        start = int(self._get_param('start', 0))
+        rows = int(self._get_param('rows', DEFAULT_ROWS))
+        sort = _parse_sort(self._get_param('sort'))
+        commands = [self._shard_command(host, start + rows, sort)
+                    for host in self.hosts]
+        responses = []
+        for name, result in execute_many(commands, len(commands),
+                                         self._get_timeout()):
+            if isinstance(result, StellrError):
+                raise result
+            responses.append(result)
+        merged = self._merge(responses, start, rows, sort)
+        if return_name:
+            return merged, self.name
+        else:
+            return merged
+
+    def execute_stream(self):
+        """
+        Not supported, as the responses of the shards must be merged.
+        """
+        raise NotImplementedError(
+            'The responses of a ShardedSelectCommand cannot be streamed.')
+
+    def _get_param(self, name, default=None):
+        # the last value added for a parameter is the one used
+        for param, value in reversed(self._commands):
+            if param == name:
+                return value
+        return default
+
+    def _shard_command(self, host, count, sort):
+        command = SelectCommand(host, self._handler, self.name, self.timeout)
+        command.client = self.client
+        command.cache = self.cache
+        command.cache_ttl = self.cache_ttl
+        command.accept_gzip = self.accept_gzip
+        command.retry_policy = self.retry_policy
+        command._commands = [(name, value) for name, value in self._commands
+                             if name not in ('start', 'rows')]
+        command._commands.append(('start', '0'))
+        command._commands.append(('rows', str(count)))
+        self._add_sort_fields(command, [field for field, desc in sort])
+        return command
+
+    def _add_sort_fields(self, command, fields):
+        # make sure each shard returns the values the docs are merged on
+        for i in range(len(command._commands) - 1, -1, -1):
+            name, value = command._commands[i]
+            if name == 'fl':
+                present = set(re.split(r'[\s,]+', value))
+                # '*' returns every stored field, but never the score
+                missing = [f for f in fields if f not in present and
+                           (f == 'score' or '*' not in present)]
+                if missing:
+                    command._commands[i] = (
+                        name, ','.join([value] + missing))
+                return
+        if 'score' in fields:
+            command._commands.append(('fl', '*,score'))
+
+    def _merge(self, responses, start, rows, sort):
+        merged = {'responseHeader': {'status': 0, 'QTime': 0},
+                  'response': {'numFound': 0, 'start': start, 'docs': []}}
+        max_score = None
+        for response in responses:
+            header = response.get('responseHeader', {})
+            merged['responseHeader']['QTime'] = max(
+                merged['responseHeader']['QTime'], header.get('QTime', 0))
+            result = response.get('response', {})
+            merged['response']['numFound'] += result.get('numFound', 0)
+            if result.get('maxScore') is not None:
+                max_score = max(max_score, result['maxScore'])
+        if max_score is not None:
+            merged['response']['maxScore'] = max_score
+        docs = [r.get('response', {}).get('docs', []) for r in responses]
+        merged['response']['docs'] = _merge_docs(docs, start, rows, sort)
+        facets = [r['facet_counts'] for r in responses if 'facet_counts' in r]
+        if facets:
+            limit = int(self._get_param('facet.limit', DEFAULT_FACET_LIMIT))
+            by_index = self._get_param('facet.sort') in ('index', 'false')
+            merged['facet_counts'] = _merge_facets(facets, limit, by_index)
+        return merged
+
+class _Entry(object):
+    """
+    The next unmerged document of a shard, ordered by the sort values of the
+    document and then by the position of the shard so that ties are stable.
+    """
+    __slots__ = ('values', 'directions', 'shard', 'position', 'doc')
+
+    def __init__(self, doc, sort, shard, position):
+        self.values = [doc.get(field) for field, desc in sort]
+        self.directions = [desc for field, desc in sort]
+        self.shard = shard
+        self.position = position
+        self.doc = doc
+
+    def __lt__(self, other):
+        for value, other_value, desc in zip(
+                self.values, other.values, self.directions):
+            if value == other_value:
+                continue
+            # documents missing the value sort last
+            if value is None:
+                return False
+            if other_value is None:
+                return True
+            return value > other_value if desc else value < other_value
+        return (self.shard, self.position) < (other.shard, other.position)
+
+def _parse_sort(sort):
+    """
+    Parse a sort parameter into a list of (field, descending) tuples,
+    defaulting to descending score.
+    """
+    if not sort:
+        return [('score', True)]
+    fields = []
+    for clause in sort.split(','):
+        parts = clause.split()
+        if parts:
+            desc = len(parts) > 1 and parts[1].lower() == 'desc'
+            fields.append((parts[0], desc))
+    return fields
+
+def _merge_docs(docs, start, rows, sort):
+    """
+    Merge the sorted docs of each shard with a k-way heap merge, only
+    comparing documents until the requested page has been filled.
+    """
+    heap = []
+    for shard, shard_docs in enumerate(docs):
+        if shard_docs:
+            heap.append(_Entry(shard_docs[0], sort, shard, 0))
+    heapq.heapify(heap)
+    page = []
+    merged = 0
+    while heap and merged < start + rows:
+        entry = heapq.heappop(heap)
+        if merged >= start:
+            page.append(entry.doc)
+        merged += 1
+        position = entry.position + 1
+        if position < len(docs[entry.shard]):
+            heapq.heappush(heap, _Entry(
+                docs[entry.shard][position], sort, entry.shard, position))
+    return page
+
+def _merge_facets(facets, limit, by_index):
+    """
+    Sum the facet.query and facet.field counts of each shard.
+    """
+    queries = {}
+    fields = {}
+    for facet in facets:
+        for query, count in facet.get('facet_queries', {}).iteritems():
+            queries[query] = queries.get(query, 0) + count
+        for field, values in facet.get('facet_fields', {}).iteritems():
+            counts = fields.setdefault(field, {})
+            if isinstance(values, dict):
+                pairs = values.iteritems()
+            else:
+                pairs = zip(values[::2], values[1::2])
+            for term, count in pairs:
+                counts[term] = counts.get(term, 0) + count
+    merged = {'facet_queries': queries, 'facet_fields': {}}
+    for field, counts in fields.iteritems():
+        if by_index:
+            terms = sorted(counts.iteritems())
+        else:
+            terms = sorted(counts.iteritems(), key=lambda t: (-t[1], t[0]))
+        if limit >= 0:
+            terms = terms[:limit]
+        values = []
+        for term, count in terms:
+            values.extend((term, count))
+        merged['facet_fields'][field] = values
+    return merged
@@ -11,25 +11,39 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from gevent import monkey; monkey.patch_all()
 from cStringIO import StringIO
 import datetime
 import gevent
+import gevent.event
 import gevent.queue
+import itertools
+import breaker
+import cache as query_cache
+import client as stellr_client
+import codec
+import metrics
 import pool
-import simplejson as json
+import ratelimit
+import retry
+import socket
+import time
 import urllib
 import urllib3
+import zlib
+from client import DEFAULT_TIMEOUT
+from codec import json
 from gevent_zeromq import zmq
 
 CONTENT_FORM = 'application/x-www-form-urlencoded; charset=utf-8'
 CONTENT_JSON = 'application/json; charset=utf-8'
-DEFAULT_TIMEOUT = 15
+DEFAULT_CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+# the zlib window bits that read and write the gzip format
+GZIP_WBITS = 31
 
-# the pool of connections
-http_pool = urllib3.PoolManager(maxsize=25)
-context = zmq.Context()
-pool.zmq_socket_pool.create(context)
+# deprecated: a urllib3 PoolManager set here is used by every command that
+# has no pool of its own, in place of the pool of its client
+http_pool = None
 
 class StellrError(Exception):
     """
@@ -41,6 +55,8 @@ class StellrError(Exception):
         timeout: a boolean indicating whether a timeout occurred
         code: the http error code received from the remote host, or if less
             than 0 the remote host was never called
+        timings: the time spent in each phase of the command when profiling
+            is enabled, otherwise None
     """
     def __init__(self, message, url=None, body=None, response=None,
                  timeout=False, status=-1):
@@ -51,10 +67,25 @@ class StellrError(Exception):
         self.response = response
         self.timeout = timeout
         self.status = status
+        self.timings = None
 
     def __str__(self):
         return self.message
 
+class CircuitOpenError(StellrError):
+    """
+    Raised without calling the remote host when the circuit breaker of the
+    host is open after too many recent failures.
+    """
+    pass
+
+class RateLimitError(StellrError):
+    """
+    Raised without calling the remote host when a limit set with
+    ratelimit.set_limit for the host or the command name refuses the request.
+    """
+    pass
+
 class BaseCommand(object):
     """
     Base class for all commands. When overridden the BaseCommand needs to be
@@ -64,15 +95,49 @@ class BaseCommand(object):
         handler: the handler that will be called on the remote host
         content_type: the value to set the content-type header to when calling
             the handler on the remote host
+
+    Commands that only read from the remote host set cacheable to True, and
+    their responses are cached when either the cache attribute is set to a
+    QueryCache or one has been set for the host with cache.set_host_cache.
+
+    Over http, a body of at least gzip_threshold bytes is compressed with gzip
+    (a streamed body is always compressed when gzip_threshold is set), and
+    when accept_gzip is True Solr may compress the response, which is then
+    decompressed transparently.
+
+    Requests are made with the transports of the StellrClient set as the
+    client attribute, or of the client returned by client.get_client when
+    that is None.
+
+    A failed command is retried according to its retry_policy, or the
+    policy set with retry.set_policy when that is None, if is_idempotent
+    returns True. A command refused by a rate limit is not retried.
+
+    When profiling is enabled in the metrics registry the timings attribute is
+    set to a dict of the seconds spent in each phase of the last execution:
+    url (building the handler and query string), encode (building the body),
+    rate_wait (waiting for the rate limits of the host and name), pool_wait
+    (waiting for a ZeroMQ socket or, when the client blocks, an http
+    connection), coalesced (waiting for an identical command already in
+    flight), network, decode and total.
     """
 
+    cacheable = False
+
     def __init__(self, host, handler, timeout, name, content_type):
-        global http_pool
-        self.pool = http_pool
+        self.client = None
+        self._pool = None
         self.host = host
         self._handler = handler
         self.timeout = timeout
         self.name = name
+        self.stream = False
+        self.cache = None
+        self.cache_ttl = None
+        self.timings = None
+        self.retry_policy = None
+        self.gzip_threshold = None
+        self.accept_gzip = False
         self.headers = self._create_headers(content_type)
         self.clear_command()
 
@@ -98,6 +163,16 @@ class BaseCommand(object):
         """
         raise NotImplementedError
 
+    def iter_body(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Generate the data that is posted to the remote host in chunks. By
+        default the whole body is a single chunk, sub classes that are able to
+        produce their body incrementally should override this.
+        """
+        body = self.body
+        if body is not None:
+            yield body
+
     def execute(self, return_name=False):
         """
         Execute the command against the Solr instance, returning either the
@@ -106,32 +181,430 @@ class BaseCommand(object):
         the host starts with 'http://', otherwise it will be executed using a
         ZeroMQ socket.
         """
-        if self.host.startswith('http://'):
-            return self._execute_http(return_name)
+        registry = metrics.get_registry()
+        start = time.time()
+        self.timings = {} if registry.profile else None
+        cache, cache_key = self._get_cache(), None
+        if cache is not None:
+            cache_key = self.cache_key
+            data = cache.get(cache_key)
+            if data is not None:
+                registry.record_cached(self.name, self.host)
+                phase = self._start_phase()
+                json_resp = codec.get_codec().loads(data)
+                self._end_phase('decode', phase)
+                self._profiled(start)
+                if return_name:
+                    return json_resp, self.name
+                else:
+                    return json_resp
+        flights = self._get_flights()
+        if flights is None:
+            return self._execute_retrying(registry, start, return_name,
+                                          cache, cache_key)
+        json_resp = self._execute_coalesced(flights, registry, start, cache,
+                                            cache_key)
+        if return_name:
+            return json_resp, self.name
         else:
-            return self._execute_zmq(return_name)
+            return json_resp
 
-    def _execute_http(self, return_name=False):
+    def _execute_retrying(self, registry, start, return_name, cache,
+                          cache_key):
+        """
+        Execute the command, retrying it according to its retry policy.
+        """
+        policy = self._get_retry_policy()
+        if policy is not None:
+            policy.record_request()
+        timeout = self.timeout
+        limit = self._get_timeout()
+        tried = []
+        try:
+            self.timeout = limit
+            while True:
+                host = self._choose_host(exclude=tried)
+                attempt = time.time()
+                if policy is not None:
+                    self.timeout = policy.attempt_timeout(limit, start)
+                try:
+                    result, host = self._execute_attempt(host, return_name,
+                                                         cache, cache_key)
+                except StellrError as e:
+                    registry.record(self.name, host, time.time() - attempt,
+                                    e)
+                    self._host_failed(host, e)
+                    delay = None
+                    if policy is not None and self._may_retry(e, host,
+                                                              tried):
+                        delay = policy.retry_delay(e, len(tried), start)
+                    if delay is None:
+                        self._profiled(start, e)
+                        raise
+                    registry.record_retry(self.name, host)
+                    tried.append(host)
+                    gevent.sleep(delay)
+                    continue
+                registry.record(self.name, host, time.time() - attempt)
+                self._profiled(start)
+                return result
+        finally:
+            self.timeout = timeout
+
+    def _execute_coalesced(self, flights, registry, start, cache,
+                           cache_key):
+        """
+        Execute the command unless an identical command is already in flight,
+        in which case wait for its response or StellrError instead.
+        """
+        key = (self.host, self.handler)
+        flight = flights.get(key)
+        if flight is not None:
+            registry.record_coalesced(self.name, self.host)
+            phase = self._start_phase()
+            timeout = self._get_timeout()
+            try:
+                json_resp = flight.get(timeout=timeout)
+            except gevent.Timeout:
+                # the command waits no longer than its own timeout
+                e = StellrError('Timeout after %s seconds.' % timeout,
+                                url=self.handler, timeout=True)
+                registry.record(self.name, self.host, time.time() - start, e)
+                self._end_phase('coalesced', phase)
+                self._profiled(start, e)
+                raise e
+            except StellrError as e:
+                self._end_phase('coalesced', phase)
+                self._profiled(start, e)
+                raise
+            self._end_phase('coalesced', phase)
+            self._profiled(start)
+            return json_resp
+        flight = flights[key] = gevent.event.AsyncResult()
+        try:
+            json_resp = self._execute_retrying(registry, start, False, cache,
+                                               cache_key)
+        except StellrError as e:
+            flight.set_exception(e)
+            raise
+        except BaseException:
+            # the waiting commands must not be left waiting, or be killed
+            flight.set_exception(StellrError(
+                'The coalesced command was not completed.'))
+            raise
+        finally:
+            del flights[key]
+        flight.set(json_resp)
+        return json_resp
+
+    @property
+    def pool(self):
+        """
+        The urllib3 PoolManager that http requests are made with: the one set
+        on the command, or the deprecated stellr.stellr.http_pool if that has
+        been set, or else the pool of the client.
+        """
+        if self._pool is not None:
+            return self._pool
+        if http_pool is not None:
+            return http_pool
+        return self._get_client().http_pool
+
+    @pool.setter
+    def pool(self, pool):
+        self._pool = pool
+
+    def is_idempotent(self):
+        """
+        Whether executing the command more than once has the same effect as
+        executing it once, so that it is safe to retry.
+        """
+        return False
+
+    def _get_retry_policy(self):
+        if not self.is_idempotent():
+            return None
+        if self.retry_policy is not None:
+            return self.retry_policy
+        return retry.get_policy()
+
+    def _get_client(self):
+        return self.client or stellr_client.get_client()
+
+    def _get_flights(self):
+        # only commands that read from the index are coalesced
+        if not self.cacheable:
+            return None
+        client = self._get_client()
+        return client.flights if client.coalesce else None
+
+    def _get_timeout(self):
+        # commands created without a timeout use the timeout of the client
+        if self.timeout is None:
+            return self._get_client().timeout
+        return self.timeout
+
+    def _execute_attempt(self, host, return_name, cache, cache_key):
+        # execute against the host, hedging if configured, returning the
+        # result and the host that returned it
+        delay = self._hedge_delay(host)
+        if delay is None:
+            return self._execute_host(host, return_name, cache,
+                                      cache_key), host
+        return self._execute_hedged(host, delay, return_name, cache,
+                                     cache_key)
+
+    def _hedge_delay(self, host):
+        # only commands that read from a group of hosts are hedged
+        if not self.cacheable or isinstance(self.host, basestring):
+            return None
+        return self.host.get_hedge_delay(self.name, host)
+
+    def _execute_hedged(self, host, delay, return_name, cache, cache_key):
+        """
+        Execute the command against the host, and if it has not completed
+        within delay seconds against a second host as well. The first
+        successful response and the host that returned it are returned, and
+        the other request is cancelled. If both fail the error from the first
+        host is raised.
+        """
+        args = (host, return_name, cache, cache_key)
+        first = gevent.spawn(self._execute_request, *args)
+        first.join(delay)
+        second = self._choose_host(exclude=[host])
+        if first.ready() or second == host:
+            result, error = first.get()
+            if error is not None:
+                raise error
+            return result, host
+        self.host.hedged += 1
+        requests = {first: host, gevent.spawn(self._execute_request, second,
+                                              *args[1:]): second}
+        done = gevent.queue.Queue()
+        for request in requests:
+            request.link(done.put)
+        failures = {}
+        while requests:
+            request = done.get()
+            completed = requests.pop(request)
+            result, error = request.get()
+            if error is not None:
+                failures[completed] = error
+                continue
+            for other in requests:
+                other.kill(block=False)
+                self.host.cancelled += 1
+            for failed, error in failures.items():
+                self._host_failed(failed, error)
+            return result, completed
+        # the failure of the first host is handled by execute
+        error = failures.pop(host)
+        for failed, other in failures.items():
+            self._host_failed(failed, other)
+        raise error
+
+    def _execute_request(self, host, return_name, cache, cache_key):
+        # execute against the host in a greenlet, returning any error raised
+        try:
+            return self._execute_host(host, return_name, cache,
+                                      cache_key), None
+        except StellrError as e:
+            return None, e
+
+    def _start_phase(self):
+        # the start time of a phase, or None when not profiling
+        if self.timings is not None:
+            return time.time()
+
+    def _end_phase(self, phase, start):
+        # add the time since the start of the phase to its timing
+        if self.timings is not None:
+            self.timings[phase] = (self.timings.get(phase, 0.0) +
+                                   time.time() - start)
+
+    def _profiled(self, start, error=None):
+        # complete the timings and pass them to the profile hook
+        if self.timings is None:
+            return
+        self.timings['total'] = time.time() - start
+        if error is not None and error.timings is None:
+            # an error shared by coalesced commands keeps the first timings
+            error.timings = self.timings
+        metrics.get_registry().profiled(self, self.timings, error)
+
+    def _choose_host(self, exclude=()):
+        if isinstance(self.host, basestring):
+            return self.host
+        # avoid the hosts whose circuit breakers are open
+        exclude = list(exclude) + [h for h in self.host.hosts
+                                   if breaker.is_open(h)]
+        return self.host.choose(exclude=exclude)
+
+    def _may_retry(self, error, host, tried):
+        # a request refused without calling the host is only retried when
+        # there is another host in the group that may accept it
+        if isinstance(error, RateLimitError):
+            return False
+        if isinstance(error, CircuitOpenError):
+            if isinstance(self.host, basestring):
+                return False
+            return any(h != host and h not in tried and not breaker.is_open(h)
+                       for h in self.host.hosts)
+        return True
+
+    def _host_failed(self, host, error):
+        # a host in a group is marked down if it could not be reached
+        if isinstance(self.host, basestring) or isinstance(error,
+                (CircuitOpenError, RateLimitError)):
+            return
+        if error.timeout or (error.status < 0 and error.response is None):
+            self.host.mark_down(host, self.client)
+
+    def _execute_host(self, host, return_name, cache, cache_key):
+        host_breaker = self._allow(host)
+        try:
+            if host.startswith('http://'):
+                result = self._execute_http(host, return_name, cache,
+                                            cache_key)
+            else:
+                result = self._execute_zmq(host, return_name, cache,
+                                           cache_key)
+        except StellrError as e:
+            if (host_breaker is not None and
+                    not isinstance(e, RateLimitError)):
+                host_breaker.record(e)
+            raise
+        if host_breaker is not None:
+            host_breaker.record()
+        return result
+
+    def _allow(self, host):
+        """
+        Raise a CircuitOpenError if the circuit breaker of the host refuses
+        the request, otherwise return the breaker or None if there is none.
+        """
+        host_breaker = breaker.get_breaker(host)
+        if host_breaker is not None and not host_breaker.allow():
+            raise CircuitOpenError('Circuit breaker open for %s.' % host,
+                                   url=host)
+        return host_breaker
+
+    def _limit(self, host, body):
+        """
+        Wait until the rate limits of the host and the command name allow the
+        request, raising a RateLimitError if they refuse it.
+        """
+        try:
+            delay = ratelimit.reserve(self.name, host,
+                                      len(body) if body else 0, self.timeout)
+        except ratelimit.RateLimited as e:
+            raise RateLimitError(e, url=host, body=body)
+        if delay:
+            phase = self._start_phase()
+            gevent.sleep(delay)
+            self._end_phase('rate_wait', phase)
+
+    @property
+    def cache_key(self):
+        """
+        The key the response is cached under, made up of the host, handler
+        and parameters. Parameters are ordered by name, keeping the order of
+        parameters with the same name, so that equivalent commands share the
+        same key.
+        """
+        params = sorted(self._commands, key=lambda param: param[0])
+        return '%s%s?%s' % (self.host, self._handler, urllib.urlencode(params))
+
+    def _get_cache(self):
+        if not self.cacheable:
+            return None
+        if self.cache is not None:
+            return self.cache
+        return query_cache.get_host_cache(self.host)
+
+    def _execute_http(self, host, return_name=False, cache=None,
+                      cache_key=None):
         """
         Execute the command against the Solr instance via http.
         """
+        phase = self._start_phase()
+        url = host + self.handler
+        self._end_phase('url', phase)
+        phase = self._start_phase()
+        body = None if self.stream else self.body
+        self._end_phase('encode', phase)
+        self._limit(host, body)
+        client = self._get_client()
+        phase = self._start_phase()
+        self._acquire_http(client, host, url, body)
+        if client.block is not None:
+            self._end_phase('pool_wait', phase)
+            phase = self._start_phase()
+        try:
+            response = self._request_http(host, url, body)
+        finally:
+            client.release(host)
+        self._end_phase('network', phase)
+        try:
+            data = self._response_data(host, response)
+        except zlib.error as e:
+            raise StellrError('Error: %s' % e, url=url, body=body,
+                response=response.data)
+        metrics.get_registry().record_bytes(self.name, host,
+            len(body) if body else 0, len(data))
+        phase = self._start_phase()
+        try:
+            json_resp = codec.get_codec().loads(data)
+        except Exception as e:
+            raise StellrError('Error: %s' % e, url=url, body=body,
+                response=data)
+        self._end_phase('decode', phase)
+        if cache is not None:
+            cache.put(cache_key, data, self.cache_ttl)
+        if return_name:
+            return json_resp, self.name
+        else:
+            return json_resp
+
+    def _acquire_http(self, client, host, url, body):
+        """
+        Take one of the client's connections to the host, raising a
+        StellrError if none is available in time.
+        """
+        try:
+            client.acquire(host, self.timeout)
+        except pool.PoolTimeout as e:
+            raise StellrError(e, url=url, body=body, timeout=True)
+
+    def _request_http(self, host, url, body, **response_kw):
+        """
+        Make the request to the Solr instance via http, returning the response
+        if its status is 200.
+        """
         response = None
-        url = self.host + self.handler
-        body = self.body
         try:
-            method = 'POST' if body is not None else 'GET'
-            response = self.pool.urlopen(method, url, body=body,
-                headers=self.headers, timeout=self.timeout,
-                assert_same_host=False)
+            if self.stream:
+                response = self._stream_http(host, url)
+            else:
+                method = 'POST' if body is not None else 'GET'
+                data, headers = body, self.headers
+                if (body is not None and self.gzip_threshold is not None and
+                        len(body) >= self.gzip_threshold):
+                    data = ''.join(self._compress(host, [body]))
+                    headers = dict(headers, **{'content-encoding': 'gzip'})
+                if self.accept_gzip:
+                    # responses are decompressed by _response_data
+                    headers = dict(headers, **{'accept-encoding': 'gzip'})
+                    response_kw['decode_content'] = False
+                response = self.pool.urlopen(method, url, body=data,
+                    headers=headers, timeout=self.timeout,
+                    assert_same_host=False, **response_kw)
             if response.status == 200:
-                json_resp = json.loads(response.data)
-                if return_name:
-                    return json_resp, self.name
-                else:
-                    return json_resp
+                return response
             else:
                 raise StellrError(response.reason, url=url, body=body,
-                    response=response.data, status=response.status)
+                    response=self._response_data(host, response),
+                    status=response.status)
         except StellrError:
             raise
         except urllib3.TimeoutError:
@@ -142,47 +615,226 @@ class BaseCommand(object):
             raise StellrError('Error: %s' % e, url=url, body=body,
                 response=data)
 
-    def _execute_zmq(self, return_name=False):
+    def _stream_http(self, host, url):
         """
-        Execute the command against the Solr instance via ZeroMQ.
+        Post the body to the remote host with chunked transfer encoding,
+        sending each chunk from iter_body as soon as it has been generated.
         """
-        if self._handler.startswith('/solr'):
-            self._handler = self._handler.replace('/solr', '', 1)
-        body = self.body
-        message = '%s %s' % (self.handler, body) if body else self.handler
+        conn_pool = self.pool.connection_from_url(url)
+        conn = conn_pool._get_conn()
+        # counted as urllib3 counts the requests it makes itself
+        conn_pool.num_requests += 1
+        chunks = self.iter_body()
         try:
-            with pool.zmq_socket_pool(self.host) as socket:
-                socket.send(message)
-                response = None
-                with gevent.Timeout(self.timeout):
-                    response = socket.recv()
-                if response:
-                    json_resp = json.loads(response)
-                    header = json_resp.get('responseHeader', None)
-                    if header is None:
-                        raise StellrError('No header in response.',
-                            url=message, body=self.body, response=response)
-                    status = header.get('status', -1)
-                    if status < 0:
-                        raise StellrError('No status in header.', url=message,
-                            body=self.body, response=response, status=status)
-                    if status > 0:
-                        raise StellrError('Error from Solr.', url=message,
-                            body=self.body, response=response, status=status)
-                    if return_name:
-                        return json_resp, self.name
-                    else:
-                        return json_resp
+            conn.timeout = self.timeout
+            conn.putrequest('POST', url, skip_accept_encoding=True)
+            for header, value in self.headers.iteritems():
+                conn.putheader(header, value)
+            conn.putheader('transfer-encoding', 'chunked')
+            if self.gzip_threshold is not None:
+                conn.putheader('content-encoding', 'gzip')
+                chunks = self._compress(host, chunks)
+            if self.accept_gzip:
+                conn.putheader('accept-encoding', 'gzip')
+            conn.endheaders()
+            conn.sock.settimeout(self.timeout)
+            for chunk in chunks:
+                if not chunk:
+                    # an empty chunk would end the body
+                    continue
+                conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            conn.send('0\r\n\r\n')
+            httplib_response = conn.getresponse()
+        except socket.timeout:
+            conn.close()
+            conn_pool._put_conn(None)
+            raise urllib3.TimeoutError(
+                'Request timed out. (timeout=%s)' % self.timeout)
+        except Exception:
+            conn.close()
+            conn_pool._put_conn(None)
+            raise
+        # the connection is returned to the pool once the response is read
+        return urllib3.HTTPResponse.from_httplib(httplib_response,
+            pool=conn_pool, connection=conn, decode_content=False)
+
+    def _compress(self, host, chunks):
+        """
+        Compress the chunks with gzip as they are generated, recording the
+        sizes and time taken in the metrics.
+        """
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        raw = compressed = 0
+        seconds = 0.0
+        for chunk in itertools.chain(chunks, [None]):
+            start = time.time()
+            if chunk is None:
+                data = compressor.flush()
+            else:
+                raw += len(chunk)
+                data = compressor.compress(chunk)
+            seconds += time.time() - start
+            compressed += len(data)
+            yield data
+        metrics.get_registry().record_compression(self.name, host, raw,
+                                                  compressed, seconds)
+
+    def _response_data(self, host, response):
+        """
+        The data of a response that has been read, decompressed if Solr
+        compressed it.
+        """
+        data = response.data
+        if response.getheader('content-encoding') != 'gzip' or not data:
+            return data
+        start = time.time()
+        raw = zlib.decompress(data, GZIP_WBITS)
+        metrics.get_registry().record_compression(self.name, host, len(raw),
+            len(data), time.time() - start, response=True)
+        return raw
+
+    def _decompressing_reader(self, host, read):
+        """
+        Wrap the read function of a gzip compressed response in one that
+        returns the decompressed data.
+        """
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        totals = {'raw': 0, 'compressed': 0, 'seconds': 0.0}
+
+        def read_decompressed(size):
+            while decompressor is not None:
+                data = read(size)
+                start = time.time()
+                if data:
+                    raw = decompressor.decompress(data)
                 else:
-                    socket.setsockopt(zmq.LINGER, 0)
+                    raw = decompressor.flush()
+                totals['seconds'] += time.time() - start
+                totals['raw'] += len(raw)
+                totals['compressed'] += len(data)
+                if not data:
+                    metrics.get_registry().record_compression(self.name,
+                        host, totals['raw'], totals['compressed'],
+                        totals['seconds'], response=True)
+                    return raw
+                if raw:
+                    return raw
+        return read_decompressed
+
+    def _execute_zmq(self, host, return_name=False, cache=None,
+                     cache_key=None):
+        """
+        Execute the command against the Solr instance via ZeroMQ.
+        """
+        phase = self._start_phase()
+        handler = self._zmq_handler
+        self._end_phase('url', phase)
+        phase = self._start_phase()
+        body = None if self.stream else self.body
+        self._end_phase('encode', phase)
+        self._limit(host, body)
+        response = self._request_zmq(host, handler, body)
+        metrics.get_registry().record_bytes(self.name, host,
+            len(body) if body else 0, len(response))
+        phase = self._start_phase()
+        try:
+            json_resp = codec.get_codec().loads(response)
+        except Exception as ex:
+            raise StellrError('Error calling Solr: %s' % ex,
+                url=host + handler, body=body)
+        self._end_phase('decode', phase)
+        self._check_header(json_resp.get('responseHeader', None), handler,
+                           body, response)
+        if cache is not None:
+            cache.put(cache_key, response, self.cache_ttl)
+        if return_name:
+            return json_resp, self.name
+        else:
+            return json_resp
+
+    @property
+    def _zmq_handler(self):
+        # ZeroMQ handlers do not include the /solr prefix of the http handler
+        handler = self.handler
+        if handler.startswith('/solr'):
+            handler = handler.replace('/solr', '', 1)
+        return handler
+
+    def _request_zmq(self, host, handler, body):
+        """
+        Make the request to the Solr instance via ZeroMQ, returning the raw
+        response. Requests to hosts that are multiplexed share DEALER sockets,
+        other requests are sent on a REQ socket from the pool. The frames are
+        sent and received without copying them.
+        """
+        frames = self._zmq_frames(handler, body)
+        try:
+            client = self._get_client()
+            if client.is_multiplexed(host):
+                phase = self._start_phase()
+                response = client.zmq_request(host, frames, self.timeout)
+                self._end_phase('network', phase)
+                if not response:
                     raise StellrError(
                         'Timeout after %s seconds.' % self.timeout,
-                        url=message, timeout=True)
+                        url=handler, timeout=True)
+                return response
+            return self._request_zmq_socket(host, frames, handler)
         except StellrError:
             raise
+        except pool.PoolTimeout as ex:
+            raise StellrError(ex, url=handler, body=body, timeout=True)
         except Exception as ex:
             raise StellrError('Error calling Solr: %s' % ex,
-                url=self.host + self.handler, body=body)
+                url=host + handler, body=body)
+
+    def _request_zmq_socket(self, host, frames, handler):
+        """
+        Make the request on a REQ socket from the pool, returning the raw
+        response.
+        """
+        start = time.time()
+        with self._get_client().zmq_socket(host, self.timeout) as socket:
+            phase = self._start_phase()
+            self._end_phase('pool_wait', start)
+            pool.send_frames(socket, frames, copy=False)
+            # time spent waiting for a socket counts against the timeout
+            remaining = max(self.timeout - (time.time() - start), 0)
+            response = None
+            with gevent.Timeout(remaining, False):
+                response = socket.recv(copy=False).bytes
+            self._end_phase('network', phase)
+            if response:
+                return response
+            else:
+                socket.setsockopt(zmq.LINGER, 0)
+                raise StellrError('Timeout after %s seconds.' % self.timeout,
+                    url=handler, timeout=True)
+
+    def _check_header(self, header, url, body, response):
+        """
+        Raise a StellrError unless the response header from ZeroMQ has a
+        status of 0.
+        """
+        if header is None:
+            raise StellrError('No header in response.',
+                url=url, body=body, response=response)
+        status = header.get('status', -1)
+        if status < 0:
+            raise StellrError('No status in header.', url=url,
+                body=body, response=response, status=status)
+        if status > 0:
+            raise StellrError('Error from Solr.', url=url,
+                body=body, response=response, status=status)
+
+    def _zmq_frames(self, handler, body):
+        """
+        The frames of the ZeroMQ request: the handler followed by the body,
+        or when streaming by each chunk from iter_body.
+        """
+        if self.stream:
+            return itertools.chain([handler], self.iter_body())
+        return [handler, body] if body else [handler]
 
     def _create_headers(self, content_type):
         """
@@ -201,21 +853,34 @@ class UpdateCommand(BaseCommand):
         handler: the handler on the remote host that will be called
             (default='/solr/update/json')
         name: the name of the command (default='Update')
-        timeout: the timeout of the call to the host in seconds (default=15)
+        timeout: the timeout of the call to the host in seconds, or None for
+            the timeout of the client (default=None)
         commit_within: integer value to use as the value to use for the number
             of milliseconds within the documents will be committed
             (default=None)
         commit: boolean value to indicate whether a commit will be performed
             after the documents in the command are added (default=False)
+        stream: boolean value to indicate whether the body will be generated
+            while it is sent, using chunked transfer encoding over http or a
+            multipart message over ZeroMQ, rather than being built in full
+            before the request is made (default=False)
+        gzip_threshold: the size in bytes of a body sent over http at or above
+            which it is compressed with gzip, or None to never compress it. A
+            streamed body is compressed whenever gzip_threshold is not None.
+            Solr must be configured to decompress gzip request bodies
+            (default=None)
 
     An UpdateCommand holds a list of commands that are performed in sequence
     on the remote host.
     """
 
     def __init__(self, host, handler='/solr/update/json', name='update',
-                 timeout=DEFAULT_TIMEOUT, commit_within=None, commit=False):
+                 timeout=None, commit_within=None, commit=False,
+                 stream=False, gzip_threshold=None):
         super(UpdateCommand, self).__init__(
             host, handler, timeout, name, CONTENT_JSON)
+        self.stream = stream
+        self.gzip_threshold = gzip_threshold
         self._handler += '?wt=json'
         if commit_within is not None:
             self._handler += '&commitWithin=%s' % commit_within
@@ -236,16 +901,58 @@ class UpdateCommand(BaseCommand):
         dictionary.
         """
         writer = StringIO()
-        writer.write('{')
-        for i in range(len(self._commands)):
-            command, document = self._commands[i]
-            body = json.dumps(document, cls=StellrJSONEncoder)
-            writer.write('"%s": %s' % (command, body))
-            if i != len(self._commands) - 1:
-                writer.write(',')
-        writer.write('}')
+        for part in self._body_parts():
+            writer.write(part)
         return writer.getvalue()
 
+    def iter_body(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Generate the body in chunks of at least chunk_size bytes (the final
+        chunk may be smaller), encoding the commands one at a time so that
+        only a single chunk is held in memory.
+        """
+        writer = StringIO()
+        for part in self._body_parts():
+            writer.write(part)
+            if writer.tell() >= chunk_size:
+                yield writer.getvalue()
+                writer = StringIO()
+        if writer.tell():
+            yield writer.getvalue()
+
+    def _body_parts(self):
+        # generate the body one encoded command at a time
+        dumps = codec.get_codec().dumps
+        yield '{'
+        for i, (command, document) in enumerate(self._commands):
+            if i:
+                yield ','
+            # a string is a document that has already been encoded, such as
+            # those queued by a BulkIndexer
+            if isinstance(document, basestring):
+                body = document
+            else:
+                body = dumps(document)
+            yield '"%s": %s' % (command, body)
+        yield '}'
+
+    def is_idempotent(self):
+        """
+        Whether the command only adds documents that overwrite any with the
+        same id and deletes documents by id, which leaves the index the same
+        however many times it is executed. A delete that has already been
+        encoded is not known to be by id.
+        """
+        for command, document in self._commands:
+            if command == 'add':
+                if (isinstance(document, dict) and
+                        document.get('overwrite') is False):
+                    return False
+            elif command != 'delete' or not (isinstance(document, dict) and
+                                             'id' in document):
+                return False
+        return True
+
     def add_documents(self, data, boost=None, overwrite=None):
         """
         Add a document or list of documents to the command that will be added
@@ -345,12 +1052,27 @@ class SelectCommand(BaseCommand):
         handler: the handler on the remote host that will be called
             (default='/solr/update/json')
         name: the name of the command (default='Update')
-        timeout: the timeout of the call to the host in seconds (default=15)
+        timeout: the timeout of the call to the host in seconds, or None for
+            the timeout of the client (default=None)
+        cache: the QueryCache to cache the response in, if None the cache set
+            for the host is used if there is one (default=None)
+        cache_ttl: the number of seconds to cache the response for, if None
+            the ttl of the cache is used (default=None)
+        accept_gzip: boolean value to indicate whether Solr may compress the
+            response with gzip over http, which is decompressed transparently
+            (default=False)
     """
+
+    cacheable = True
+
     def __init__(self, host, handler='/solr/select', name='select',
-                 timeout=DEFAULT_TIMEOUT):
+                 timeout=None, cache=None, cache_ttl=None,
+                 accept_gzip=False):
         super(SelectCommand, self).__init__(
             host, handler, timeout, name, CONTENT_FORM)
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.accept_gzip = accept_gzip
         self.add_param('wt', 'json')
 
     def add_param(self, name, value):
@@ -362,6 +1084,75 @@ class SelectCommand(BaseCommand):
         value = unicode(value)
         self._commands.append((name, value.encode('utf-8')))
 
+    def is_idempotent(self):
+        """
+        A select only reads from the index, so it is always safe to retry.
+        """
+        return True
+
+    def execute_stream(self):
+        """
+        Execute the command against the Solr instance, returning a
+        StreamingResponse that parses the response as it is read and yields
+        the documents in response.docs. Over http the response is read from
+        the connection in chunks, over ZeroMQ it is parsed from the received
+        message. Errors in the response header raise a StellrError. The
+        latency recorded in the metrics is the time until the response
+        started to arrive.
+        """
+        timeout = self.timeout
+        try:
+            self.timeout = self._get_timeout()
+            return self._execute_stream()
+        finally:
+            self.timeout = timeout
+
+    def _execute_stream(self):
+        from .streaming import StreamingResponse
+        host = self._choose_host()
+        start = time.time()
+        host_breaker = None
+        try:
+            host_breaker = self._allow(host)
+            self._limit(host, None)
+            if host.startswith('http://'):
+                url = host + self.handler
+                client = self._get_client()
+                self._acquire_http(client, host, url, None)
+                try:
+                    response = self._request_http(host, url, None,
+                                                  preload_content=False)
+                except StellrError:
+                    client.release(host)
+                    raise
+                read = response.read
+                if response.getheader('content-encoding') == 'gzip':
+                    read = self._decompressing_reader(host, read)
+
+                def release_conn():
+                    response.release_conn()
+                    client.release(host)
+                streaming = StreamingResponse(read, release_conn, url=url)
+            else:
+                handler = self._zmq_handler
+                response = self._request_zmq(host, handler, None)
+                streaming = StreamingResponse(StringIO(response).read,
+                    url=handler)
+                self._check_header(streaming.header, handler, None,
+                                   response)
+        except StellrError as e:
+            if (host_breaker is not None and
+                    not isinstance(e, RateLimitError)):
+                host_breaker.record(e)
+            metrics.get_registry().record(self.name, host,
+                                          time.time() - start, e)
+            self._host_failed(host, e)
+            raise
+        if host_breaker is not None:
+            host_breaker.record()
+        metrics.get_registry().record(self.name, host, time.time() - start)
+        return streaming
+
     @property
     def handler(self):
         """
@@ -389,5 +1180,5 @@ class StellrJSONEncoder(json.JSONEncoder):
         Encode! The datetime instance is expected to be in UTC.
         """
         if isinstance(o, datetime.datetime):
-            return o.strftime('%Y-%m-%dT%H:%M:%SZ')
+            return codec.encode_datetime(o)
         return json.JSONEncoder.default(self, o)
\ No newline at end of file
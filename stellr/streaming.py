@@ -0,0 +1,221 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+
+from .codec import json
+from .stellr import StellrError
+
+DEFAULT_READ_SIZE = 16 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER = '0123456789.eE+-'
+
+class StreamingResponse(object):
+    """
+    A response from Solr that is parsed incrementally as it is read, created
+    by SelectCommand.execute_stream. Iterating over the response yields each
+    document in response.docs, and only the documents that have not been
+    consumed yet are held in memory. The following attributes are parsed
+    when they are first accessed:
+
+        header: the responseHeader of the response
+        num_found: the numFound of the response
+        start: the start of the response
+        extra: a dict of any other values in the response, including those
+            in the response object after the docs; it is only complete
+            once every document has been consumed
+
+    A StreamingResponse should be closed when it is no longer needed, or used
+    in a with statement, so that the connection can be reused. Any error
+    while reading or parsing the response is raised as a StellrError.
+    """
+
+    def __init__(self, read, close=None, url=None,
+                 read_size=DEFAULT_READ_SIZE):
+        self.url = url
+        self.extra = {}
+        self._read = read
+        self._close = close
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._values = {}
+        self._docs = collections.deque()
+        self._events = self._parse()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while True:
+            if self._docs:
+                yield self._docs.popleft()
+            elif not self._advance():
+                return
+
+    def close(self):
+        """
+        Stop reading the response and release the connection.
+        """
+        self._events = iter(())
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    @property
+    def header(self):
+        """
+        The responseHeader of the response.
+        """
+        return self._get('responseHeader')
+
+    @property
+    def num_found(self):
+        """
+        The number of documents matching the query.
+        """
+        return self._get('numFound')
+
+    @property
+    def start(self):
+        """
+        The offset of the first document in the response.
+        """
+        return self._get('start')
+
+    def _get(self, name):
+        # parse until the value is found, keeping any documents passed over
+        while name not in self._values:
+            if not self._advance():
+                return None
+        return self._values[name]
+
+    def _advance(self):
+        try:
+            next(self._events)
+            return True
+        except StopIteration:
+            self.close()
+            return False
+        except StellrError:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            raise StellrError('Error: %s' % e, url=self.url)
+
+    def _parse(self):
+        # a generator that yields after each value found, putting docs in the
+        # queue of documents and any other values in the values dict
+        self._expect('{')
+        for key in self._keys():
+            if key == 'response':
+                self._expect('{')
+                for name in self._keys():
+                    if name == 'docs':
+                        self._expect('[')
+                        while self._next_item(']'):
+                            self._docs.append(self._value())
+                            yield
+                    else:
+                        self._values[name] = self._value()
+                        self.extra.setdefault('response', {})
+                        if name not in ('numFound', 'start'):
+                            self.extra['response'][name] = self._values[name]
+                        yield
+            else:
+                value = self._value()
+                if key == 'responseHeader':
+                    self._values[key] = value
+                else:
+                    self.extra[key] = value
+                yield
+
+    def _keys(self):
+        # generate the keys of an object whose opening brace has been read,
+        # leaving the position at the start of each value
+        while self._next_item('}'):
+            key = self._value()
+            self._expect(':')
+            yield key
+
+    def _next_item(self, close):
+        # whether there is another item in an object or array, consuming the
+        # separating comma or closing character
+        char = self._peek()
+        if char == close:
+            self._pos += 1
+            return False
+        if char == ',':
+            self._pos += 1
+            char = self._peek()
+        if char == close:
+            raise ValueError('Unexpected %r in response.' % close)
+        return True
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected %r in response.' % char)
+        self._pos += 1
+
+    def _peek(self):
+        # skip whitespace and return the next character
+        while True:
+            while (self._pos < len(self._buffer) and
+                    self._buffer[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of response.')
+
+    def _value(self):
+        # decode the complete JSON value at the position, reading more of the
+        # response while the value is incomplete; the amount read doubles on
+        # each attempt so that large values are not decoded too many times
+        self._peek()
+        size = self._read_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            # a number may continue in data that has not been read yet
+            if (isinstance(value, (int, long, float)) and not self._eof and
+                    not self._buffer[end:].strip(_NUMBER) and self._fill()):
+                continue
+            self._pos = end
+            return value
+
+    def _fill(self, size=None):
+        # read more of the response, discarding what has been parsed
+        if self._eof:
+            return False
+        data = self._read(size or self._read_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
@@ -0,0 +1,109 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import unittest
+import urllib3
+
+import stellr
+from stellr.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+HOSTS = ['http://replica1:8983', 'http://replica2:8983']
+TIMEOUT = stellr.StellrError('timeout', timeout=True)
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Perform tests on the breaker module."""
+
+    def tearDown(self):
+        stellr.breaker.disable()
+
+    @patch('stellr.breaker.time')
+    def test_open_and_close(self, time):
+        """Test the breaker opens, half-opens and closes."""
+        time.time.return_value = 100
+        b = CircuitBreaker(failures=2, window=10, reset_timeout=30)
+        b.record(TIMEOUT)
+        time.time.return_value = 120
+        b.record(TIMEOUT)
+        self.assertEqual(CLOSED, b.state)
+        b.record(TIMEOUT)
+        self.assertEqual(OPEN, b.state)
+        self.assertTrue(b.is_open())
+        self.assertFalse(b.allow())
+
+        # a single trial request is allowed once half-open
+        time.time.return_value = 150
+        self.assertFalse(b.is_open())
+        self.assertTrue(b.allow())
+        self.assertEqual(HALF_OPEN, b.state)
+        self.assertFalse(b.allow())
+        b.record()
+        self.assertEqual(CLOSED, b.state)
+        self.assertTrue(b.allow())
+
+    @patch('stellr.breaker.time')
+    def test_trial_fails(self, time):
+        """Test a failed trial request opens the breaker again."""
+        time.time.return_value = 100
+        b = CircuitBreaker(failures=1, reset_timeout=30)
+        b.record(TIMEOUT)
+        time.time.return_value = 130
+        self.assertTrue(b.allow())
+        b.record(stellr.StellrError('error', status=503))
+        self.assertEqual(OPEN, b.state)
+        self.assertTrue(b.is_open())
+
+    def test_bad_requests_are_not_failures(self):
+        """Test errors from Solr for a bad request do not open the breaker."""
+        b = CircuitBreaker(failures=1)
+        b.record(stellr.StellrError('bad', status=400, response='{}'))
+        self.assertEqual(CLOSED, b.state)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_fails_fast(self, pool):
+        """Test commands fail fast while the breaker of the host is open."""
+        pool.urlopen.side_effect = urllib3.TimeoutError()
+        stellr.breaker.enable(failures=2, reset_timeout=60)
+        for i in range(2):
+            self.assertRaises(stellr.StellrError,
+                              stellr.SelectCommand(HOSTS[0]).execute)
+        self.assertRaises(stellr.CircuitOpenError,
+                          stellr.SelectCommand(HOSTS[0]).execute)
+        self.assertEqual(2, pool.urlopen.call_count)
+        self.assertEqual({HOSTS[0]: OPEN}, stellr.breaker.states())
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_group_avoids_open_hosts(self, pool):
+        """Test a host group does not choose hosts with an open breaker."""
+        response = Mock(status=200, data='{}')
+        pool.urlopen.return_value = response
+        stellr.breaker.enable(failures=1, reset_timeout=60)
+        stellr.breaker.get_breaker(HOSTS[0]).record(TIMEOUT)
+        g = stellr.HostGroup(HOSTS)
+        for i in range(4):
+            stellr.SelectCommand(g).execute()
+        for call in pool.urlopen.call_args_list:
+            self.assertTrue(call[0][1].startswith(HOSTS[1]))
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_open_host_not_retried(self, pool):
+        """Test a command refused by an open breaker is not retried."""
+        policy = stellr.RetryPolicy(backoff=0)
+        stellr.breaker.enable(failures=1, reset_timeout=60)
+        stellr.breaker.get_breaker(HOSTS[0]).record(TIMEOUT)
+        command = stellr.SelectCommand(HOSTS[0])
+        command.retry_policy = policy
+        self.assertRaises(stellr.CircuitOpenError, command.execute)
+        self.assertEqual(0, pool.urlopen.call_count)
+        self.assertEqual(0, policy.retries)
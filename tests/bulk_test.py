@@ -0,0 +1,206 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import gevent
+import unittest
+
+import stellr
+
+TEST_HTTP = 'http://localhost:8983'
+
+class BulkIndexerTest(unittest.TestCase):
+    """Perform tests on the bulk module."""
+
+    def setUp(self):
+        self.bodies = []
+        self.fail_on = None
+        patcher = patch('stellr.stellr.UpdateCommand.execute',
+                        autospec=True, side_effect=self._execute)
+        self.execute = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _execute(self, command, return_name=False):
+        body = command.body
+        self.bodies.append(body)
+        if self.fail_on is not None and self.fail_on in body:
+            raise stellr.StellrError('Bad Request', status=400)
+        return {'responseHeader': {'status': 0}}
+
+    def test_flush_on_document_count(self):
+        """Test that reaching max_documents flushes a batch."""
+        b = stellr.BulkIndexer(TEST_HTTP, max_documents=2, max_interval=None)
+        b.add_documents({'a': 1})
+        self.assertEqual(1, b.pending)
+        b.add_documents([{'b': 2}, {'c': 3}])
+        self.assertEqual(1, b.pending)
+        b.flush()
+        self.assertEqual(self.bodies,
+            ['{"add": {"doc": {"a": 1}},"add": {"doc": {"b": 2}}}',
+             '{"add": {"doc": {"c": 3}}}'])
+        self.assertEqual(3, b.indexed)
+        self.assertEqual(0, b.pending)
+
+    def test_flush_on_bytes(self):
+        """Test that reaching max_bytes flushes a batch."""
+        b = stellr.BulkIndexer(TEST_HTTP, max_bytes=20, max_interval=None)
+        b.add_delete_by_id(1)
+        self.assertEqual(0, len(self.bodies))
+        b.add_delete_by_id([2, 3])
+        gevent.sleep(0)
+        self.assertEqual(self.bodies,
+            ['{"delete": {"id": "1"},"delete": {"id": "2"}}'])
+        b.flush()
+        self.assertEqual(2, len(self.bodies))
+        self.assertEqual(3, b.indexed)
+        # adds and deletes by id are safe to retry
+        for call in self.execute.call_args_list:
+            self.assertTrue(call[0][0].is_idempotent())
+
+    def test_add_without_overwrite(self):
+        """Test that a batch with adds that do not overwrite is not retried."""
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=None)
+        b.add_documents({'a': 1})
+        b.add_documents({'b': 2}, overwrite=False)
+        b.flush()
+        self.assertEqual(self.bodies,
+            ['{"add": {"doc": {"a": 1}},'
+             '"add": {"doc": {"b": 2}, "overwrite": false}}'])
+        self.assertFalse(self.execute.call_args[0][0].is_idempotent())
+
+    def test_flush_on_interval(self):
+        """Test that a batch is flushed after max_interval seconds."""
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=0.01)
+        b.add_documents({'a': 1})
+        gevent.sleep(0.05)
+        self.assertEqual(self.bodies, ['{"add": {"doc": {"a": 1}}}'])
+        self.assertEqual(1, b.indexed)
+
+    def test_context_manager(self):
+        """Test that leaving a with statement flushes the buffer."""
+        with stellr.BulkIndexer(TEST_HTTP, max_interval=None) as b:
+            b.add_documents({'a': 1})
+        self.assertEqual(self.bodies, ['{"add": {"doc": {"a": 1}}}'])
+
+    def test_failed_batch(self):
+        """Test that every update in a failed batch is reported."""
+        self.fail_on = '"b"'
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=None)
+        b.add_documents([{'a': 1}, {'b': 2}])
+        b.flush()
+        self.assertEqual(0, b.indexed)
+        self.assertEqual(2, b.failed)
+        self.assertEqual([e[:2] for e in b.errors],
+            [('add', {'doc': {'a': 1}}), ('add', {'doc': {'b': 2}})])
+        self.assertEqual(400, b.errors[0][2].status)
+
+    def test_isolate_failures(self):
+        """Test that isolating failures only reports the rejected update."""
+        self.fail_on = '"b"'
+        on_error = Mock()
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=None,
+                               isolate_failures=True, on_error=on_error)
+        b.add_documents([{'a': 1}, {'b': 2}])
+        b.flush()
+        self.assertEqual(3, len(self.bodies))
+        self.assertEqual(1, b.indexed)
+        self.assertEqual(1, b.failed)
+        self.assertEqual([], b.errors)
+        action, data, error = on_error.call_args[0]
+        self.assertEqual(('add', {'doc': {'b': 2}}), (action, data))
+
+    def test_adaptive_batch_size(self):
+        """Test an adaptive indexer flushes at the adjusted batch size."""
+        adaptive = stellr.AdaptiveBatching(documents=2, min_documents=1,
+                                           step=1)
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=None,
+                               adaptive=adaptive)
+        b.add_documents([{'a': 1}, {'b': 2}])
+        gevent.sleep(0)
+        self.assertEqual(1, len(self.bodies))
+        self.assertEqual(3, adaptive.documents)
+        b.add_documents([{'c': 3}, {'d': 4}])
+        gevent.sleep(0)
+        self.assertEqual(1, len(self.bodies))
+        b.add_documents({'e': 5})
+        b.flush()
+        self.assertEqual(2, len(self.bodies))
+        self.assertEqual(5, b.indexed)
+
+    def test_adaptive_concurrency(self):
+        """Test an adaptive indexer limits the flushes in flight."""
+        adaptive = stellr.AdaptiveBatching(documents=1, min_documents=1,
+                                           max_documents=1)
+        b = stellr.BulkIndexer(TEST_HTTP, max_interval=None,
+                               adaptive=adaptive)
+        in_flight = []
+
+        def execute(command, return_name=False):
+            in_flight.append(b._in_flight)
+            gevent.sleep(0.01)
+            return {'responseHeader': {'status': 0}}
+        self.execute.side_effect = execute
+        for i in range(4):
+            b.add_documents({'a': i})
+        b.flush()
+        # the first batch goes alone, once it succeeds two may be in flight
+        self.assertEqual([1, 2, 2], in_flight[:3])
+        self.assertEqual(4, adaptive.concurrency)
+        self.assertEqual(4, b.indexed)
+
+class AdaptiveBatchingTest(unittest.TestCase):
+    """Perform tests on AdaptiveBatching."""
+
+    def test_additive_increase(self):
+        """Test full batches within the target latency grow the batch."""
+        a = stellr.AdaptiveBatching(target_latency=1, documents=100, step=50,
+                                    max_documents=180)
+        a.record(100, 1000, 0.5)
+        self.assertEqual(150, a.documents)
+        a.record(100, 1000, 0.5)
+        self.assertEqual(150, a.documents)
+        a.record(150, 1000, 0.5)
+        self.assertEqual(180, a.documents)
+        self.assertEqual(1, a.concurrency)
+        a.record(180, 1000, 0.5)
+        self.assertEqual(180, a.documents)
+        self.assertEqual(2, a.concurrency)
+        self.assertEqual(2000, a.throughput)
+
+    def test_multiplicative_decrease(self):
+        """Test batches slower than the target shrink the batch."""
+        a = stellr.AdaptiveBatching(target_latency=1, documents=100,
+                                    min_documents=50, concurrency=2)
+        a.record(100, 1000, 1.5)
+        self.assertEqual(75, a.documents)
+        a.record(75, 1000, 1.5)
+        self.assertEqual(56, a.documents)
+        a.record(56, 1000, 1.5)
+        self.assertEqual(50, a.documents)
+        self.assertEqual(2, a.concurrency)
+        a.record(50, 1000, 1.5)
+        self.assertEqual(1, a.concurrency)
+
+    def test_backoff(self):
+        """Test timeouts and 503s back off sharply."""
+        a = stellr.AdaptiveBatching(documents=1000, concurrency=4)
+        a.record(1000, 1000, 5, stellr.StellrError('timeout', timeout=True))
+        self.assertEqual(500, a.documents)
+        self.assertEqual(2, a.concurrency)
+        a.record(500, 1000, 1, stellr.StellrError('busy', status=503))
+        self.assertEqual(250, a.documents)
+        self.assertEqual(1, a.concurrency)
+        a.record(250, 1000, 1, stellr.StellrError('bad', status=400))
+        self.assertEqual(250, a.documents)
+        self.assertEqual(None, a.throughput)
@@ -0,0 +1,89 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch
+import unittest
+
+import stellr
+
+class QueryCacheTest(unittest.TestCase):
+    """Perform tests on the cache module."""
+
+    def test_get_and_put(self):
+        """Test caching a response."""
+        c = stellr.QueryCache()
+        self.assertEqual(None, c.get('a'))
+        c.put('a', '{"a": 1}')
+        self.assertEqual('{"a": 1}', c.get('a'))
+        self.assertEqual(1, len(c))
+        stats = c.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(8, stats['bytes'])
+
+    def test_replace(self):
+        """Test replacing a cached response."""
+        c = stellr.QueryCache()
+        c.put('a', '1234')
+        c.put('a', '12')
+        self.assertEqual('12', c.get('a'))
+        self.assertEqual(2, c.size)
+
+    def test_lru_eviction(self):
+        """Test the least recently used response is evicted."""
+        c = stellr.QueryCache(max_bytes=10)
+        c.put('a', '1234')
+        c.put('b', '1234')
+        c.get('a')
+        c.put('c', '1234')
+        self.assertEqual(None, c.get('b'))
+        self.assertEqual('1234', c.get('a'))
+        self.assertEqual('1234', c.get('c'))
+        self.assertEqual(1, c.evictions)
+        self.assertEqual(8, c.size)
+
+    def test_too_large(self):
+        """Test a response larger than the cache is not cached."""
+        c = stellr.QueryCache(max_bytes=3)
+        c.put('a', '1234')
+        self.assertEqual(0, len(c))
+
+    @patch('time.time')
+    def test_ttl(self, now):
+        """Test responses expire after their ttl."""
+        now.return_value = 100
+        c = stellr.QueryCache(ttl=10)
+        c.put('a', '1')
+        c.put('b', '1', ttl=30)
+        now.return_value = 120
+        self.assertEqual(None, c.get('a'))
+        self.assertEqual('1', c.get('b'))
+        self.assertEqual(1, c.expirations)
+        self.assertEqual(1, len(c))
+
+    def test_clear(self):
+        """Test clearing the cache."""
+        c = stellr.QueryCache()
+        c.put('a', '1')
+        c.clear()
+        self.assertEqual(None, c.get('a'))
+        self.assertEqual(0, c.size)
+
+    def test_host_cache(self):
+        """Test setting the cache for a host."""
+        c = stellr.QueryCache()
+        stellr.cache.set_host_cache('http://a', c)
+        self.assertEqual(c, stellr.cache.get_host_cache('http://a'))
+        stellr.cache.set_host_cache('http://a', None)
+        self.assertEqual(None, stellr.cache.get_host_cache('http://a'))
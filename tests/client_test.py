@@ -0,0 +1,321 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import gevent
+import subprocess
+import sys
+import time
+import unittest
+
+import stellr
+from stellr import client
+
+TEST_HTTP = 'http://localhost:8983'
+TEST_ZMQ = 'tcp://localhost:9000'
+
+class ClientTest(unittest.TestCase):
+    """Perform tests on the client module."""
+
+    def test_command_pool(self):
+        """Test a pool set on a command or module replaces the client's."""
+        command = stellr.SelectCommand(TEST_HTTP)
+        command.client = client.StellrClient(patch=False)
+        command.client._http_pool = Mock()
+        self.assertTrue(command.pool is command.client._http_pool)
+        with patch('stellr.stellr.http_pool', Mock()) as module_pool:
+            self.assertTrue(command.pool is module_pool)
+            command.pool = Mock()
+            module_pool.urlopen.return_value = Mock(status=200, data='{}')
+            command.pool.urlopen.return_value = Mock(status=200, data='{}')
+            command.execute()
+            self.assertEqual(1, command.pool.urlopen.call_count)
+            self.assertFalse(module_pool.urlopen.called)
+
+    def test_add_to_registry(self):
+        """Test the pools of a client are included in snapshots."""
+        registry = stellr.metrics.MetricsRegistry()
+        c = client.StellrClient(patch=False, zmq_size=3)
+        c.add_to_registry('indexing', registry)
+        pools = registry.snapshot()['pools']
+        self.assertEqual({}, pools['indexing.http'])
+        self.assertEqual({}, pools['indexing.zmq'])
+
+    def test_import_side_effects(self):
+        """Test importing stellr patches nothing and creates no transports."""
+        code = ('import sys, stellr\n'
+                'from gevent import monkey\n'
+                'from stellr import pool\n'
+                'sys.exit(monkey.is_module_patched("socket") or\n'
+                '         stellr.client._client is not None or\n'
+                '         pool._context is not None or\n'
+                '         pool.zmq_socket_pool.pool is not None)\n')
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+    @patch('stellr.client.HTTPPoolManager')
+    @patch('stellr.client.patch_sockets')
+    def test_lazy_http_pool(self, patch_sockets, pool_manager):
+        """Test the http pool is created and sockets patched on first use."""
+        c = client.StellrClient(host_sizes={TEST_HTTP: 4, TEST_ZMQ: 2})
+        self.assertEqual(0, pool_manager.call_count)
+        self.assertEqual(pool_manager.return_value, c.http_pool)
+        self.assertEqual(pool_manager.return_value, c.http_pool)
+        pool_manager.assert_called_once_with(25, {TEST_HTTP: 4})
+        patch_sockets.assert_called_once_with()
+
+    @patch('stellr.client.HTTPPoolManager')
+    @patch('stellr.client.patch_sockets')
+    def test_no_patch(self, patch_sockets, pool_manager):
+        """Test sockets are not patched when patch is False."""
+        c = client.StellrClient(patch=False)
+        c.http_pool
+        self.assertEqual(0, patch_sockets.call_count)
+
+    def test_default_client(self):
+        """Test the default client is created once and can be replaced."""
+        previous = client.set_client(None)
+        try:
+            default = client.get_client()
+            self.assertTrue(isinstance(default, client.StellrClient))
+            self.assertTrue(default is client.get_client())
+            c = client.StellrClient()
+            self.assertEqual(c, client.set_client(c))
+            self.assertTrue(c is client.get_client())
+        finally:
+            client.set_client(previous)
+
+    def test_command_client(self):
+        """Test a command uses its own client's pool when it has one."""
+        c = client.StellrClient()
+        c._http_pool = Mock()
+        command = stellr.SelectCommand(TEST_HTTP)
+        command.client = c
+        self.assertEqual(c._http_pool, command.pool)
+
+    def test_http_host_sizes(self):
+        """Test the connections kept to each http host."""
+        manager = client.HTTPPoolManager(3, {TEST_HTTP + '/': 5})
+        conn_pool = manager.connection_from_url(TEST_HTTP + '/solr/select')
+        self.assertEqual(5, conn_pool.pool.maxsize)
+        conn_pool = manager.connection_from_url('http://other/solr/select')
+        self.assertEqual(3, conn_pool.pool.maxsize)
+
+    def test_acquire_block(self):
+        """Test waiting for a connection to an http host."""
+        c = client.StellrClient(patch=False, http_size=1, block=True)
+        c.acquire(TEST_HTTP, 1)
+        gevent.spawn_later(0.01, c.release, TEST_HTTP)
+        c.acquire(TEST_HTTP, 1)
+        self.assertRaises(stellr.pool.PoolTimeout, c.acquire, TEST_HTTP,
+                          0.01)
+
+    def test_acquire_no_block(self):
+        """Test failing at once when every connection is in use."""
+        c = client.StellrClient(patch=False, host_sizes={TEST_HTTP: 2},
+                                block=False)
+        c.acquire(TEST_HTTP, 10)
+        c.acquire(TEST_HTTP, 10)
+        self.assertRaises(stellr.pool.PoolTimeout, c.acquire, TEST_HTTP, 10)
+        c.release(TEST_HTTP)
+        c.acquire(TEST_HTTP, 10)
+
+    def test_acquire_default(self):
+        """Test connections are not limited when block is None."""
+        c = client.StellrClient(patch=False, http_size=1)
+        c.acquire(TEST_HTTP, 0)
+        c.acquire(TEST_HTTP, 0)
+        c.release(TEST_HTTP)
+        self.assertEqual({}, c._slots)
+
+    def test_execute_no_connection(self):
+        """Test a command fails when no connection is available."""
+        c = client.StellrClient(patch=False, http_size=1, block=False)
+        c._http_pool = Mock()
+        c.acquire(TEST_HTTP, 1)
+        try:
+            c.execute(stellr.SelectCommand(TEST_HTTP))
+        except stellr.StellrError as e:
+            self.assertTrue(e.timeout)
+            self.assertEqual(0, c._http_pool.urlopen.call_count)
+            return
+        self.assertFalse(True, 'Error should have been raised')
+
+    def test_execute_timeout(self):
+        """Test commands created without a timeout use the client's."""
+        c = client.StellrClient(timeout=3)
+        c._http_pool = Mock()
+        c._http_pool.urlopen.return_value = Mock(status=200, data='{}')
+        command = stellr.SelectCommand(TEST_HTTP)
+        self.assertEqual({}, c.execute(command))
+        self.assertEqual(3, c._http_pool.urlopen.call_args[1]['timeout'])
+        self.assertEqual(None, command.timeout)
+        self.assertEqual(c, command.client)
+        command = stellr.SelectCommand(TEST_HTTP, timeout=5)
+        c.execute(command)
+        self.assertEqual(5, c._http_pool.urlopen.call_args[1]['timeout'])
+
+    @patch('stellr.pool.get_context')
+    def test_zmq_socket_pool(self, get_context):
+        """Test a client that is not shared owns its ZeroMQ sockets."""
+        c = client.StellrClient(zmq_size=3, host_sizes={TEST_ZMQ: 2,
+                                                        TEST_HTTP: 4})
+        self.assertEqual({}, c.zmq_stats())
+        manager = c.socket_pool
+        self.assertTrue(manager is c.socket_pool)
+        self.assertFalse(manager is stellr.pool.zmq_socket_pool.pool)
+        self.assertEqual(get_context.return_value, manager.context)
+        self.assertEqual(2, manager.get_size(TEST_ZMQ))
+        self.assertEqual(3, manager.get_size('tcp://other:9000'))
+        with patch('stellr.pool.zmq_socket_pool') as socket_pool:
+            c.zmq_socket(TEST_ZMQ, 5)
+            socket_pool.assert_called_once_with(TEST_ZMQ, 5, manager)
+            c.block = False
+            c.zmq_socket(TEST_ZMQ, 5)
+            socket_pool.assert_called_with(TEST_ZMQ, 0, manager)
+
+    @patch('stellr.pool.zmq_dealer_pool')
+    def test_multiplex(self, dealer_pool):
+        """Test multiplexing is per client unless the client is shared."""
+        c = client.StellrClient()
+        c.multiplex(TEST_ZMQ)
+        self.assertTrue(c.is_multiplexed(TEST_ZMQ))
+        c.multiplex(TEST_ZMQ, False)
+        self.assertFalse(c.is_multiplexed(TEST_ZMQ))
+        self.assertEqual(0, dealer_pool.multiplex.call_count)
+        shared = client.StellrClient(shared=True)
+        shared.multiplex(TEST_ZMQ)
+        dealer_pool.multiplex.assert_called_once_with(TEST_ZMQ, True)
+        shared.zmq_request(TEST_ZMQ, ['frame'], 1)
+        dealer_pool.request.assert_called_once_with(TEST_ZMQ, ['frame'], 1)
+
+class CoalesceTest(unittest.TestCase):
+    """Perform tests on coalescing identical commands in flight."""
+
+    def setUp(self):
+        self.registry = stellr.metrics.MetricsRegistry()
+        self.previous = stellr.metrics.set_registry(self.registry)
+        self.client = client.StellrClient(patch=False, coalesce=True)
+        self.client._http_pool = Mock()
+
+    def tearDown(self):
+        stellr.metrics.set_registry(self.previous)
+
+    def _respond(self, *responses):
+        # each request answers after yielding to the other greenlets
+        responses = list(responses)
+
+        def urlopen(*args, **kwargs):
+            gevent.sleep(0.01)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return Mock(status=200, data=response)
+        self.client._http_pool.urlopen.side_effect = urlopen
+
+    def _select(self, query='*:*'):
+        command = stellr.SelectCommand(TEST_HTTP)
+        command.add_param('q', query)
+        return command
+
+    def _execute(self, commands):
+        # the result or StellrError of each command executed concurrently
+        def execute(command):
+            try:
+                return self.client.execute(command)
+            except stellr.StellrError as e:
+                return e
+        greenlets = [gevent.spawn(execute, c) for c in commands]
+        gevent.joinall(greenlets)
+        return [g.value for g in greenlets]
+
+    def test_coalesce(self):
+        """Test identical selects in flight share one request."""
+        self._respond('{"a": 1}')
+        results = self._execute([self._select() for i in range(5)])
+        self.assertEqual(1, self.client._http_pool.urlopen.call_count)
+        self.assertEqual({'a': 1}, results[0])
+        for result in results[1:]:
+            self.assertTrue(result is results[0])
+        self.assertEqual({}, self.client.flights)
+        self.assertEqual(4, self.registry.get('select', TEST_HTTP).coalesced)
+
+    def test_coalesce_error(self):
+        """Test identical selects in flight share the StellrError."""
+        self._respond(IOError('refused'))
+        results = self._execute([self._select() for i in range(3)])
+        self.assertEqual(1, self.client._http_pool.urlopen.call_count)
+        self.assertTrue(isinstance(results[0], stellr.StellrError))
+        for result in results[1:]:
+            self.assertTrue(result is results[0])
+
+    def test_coalesce_timeout(self):
+        """Test a coalesced select waits no longer than its timeout."""
+        def urlopen(*args, **kwargs):
+            gevent.sleep(0.5)
+            return Mock(status=200, data='{"a": 1}')
+        self.client._http_pool.urlopen.side_effect = urlopen
+        leader = self._select()
+        leader.timeout = 5
+        waiter = self._select()
+        waiter.timeout = 0.05
+        first = gevent.spawn(self.client.execute, leader)
+        gevent.sleep(0)
+        start = time.time()
+        self.assertRaises(stellr.StellrError, self.client.execute, waiter)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual({'a': 1}, first.get())
+        self.assertEqual(1, self.client._http_pool.urlopen.call_count)
+        self.assertEqual(1, self.registry.get('select', TEST_HTTP).timeouts)
+
+    def test_coalesce_return_name(self):
+        """Test each coalesced command returns its own name if asked."""
+        self._respond('{"a": 1}')
+        first = self._select()
+        second = self._select()
+        second.name = 'other'
+        g = gevent.spawn(self.client.execute, first)
+        result = self.client.execute(second, True)
+        self.assertEqual(({'a': 1}, 'other'), result)
+        self.assertEqual({'a': 1}, g.get())
+
+    def test_different_commands(self):
+        """Test selects with different parameters are not coalesced."""
+        self._respond('{"a": 1}', '{"b": 2}')
+        results = self._execute([self._select('a'), self._select('b')])
+        self.assertEqual(2, self.client._http_pool.urlopen.call_count)
+        self.assertEqual([{'a': 1}, {'b': 2}], results)
+
+    def test_sequential(self):
+        """Test a select sent after the first completed is not coalesced."""
+        self._respond('{"a": 1}', '{"a": 2}')
+        self.assertEqual({'a': 1}, self.client.execute(self._select()))
+        self.assertEqual({'a': 2}, self.client.execute(self._select()))
+
+    def test_not_enabled(self):
+        """Test selects are not coalesced unless the client coalesces."""
+        self.client.coalesce = False
+        self._respond('{"a": 1}', '{"a": 1}')
+        self._execute([self._select(), self._select()])
+        self.assertEqual(2, self.client._http_pool.urlopen.call_count)
+
+    def test_updates(self):
+        """Test updates are never coalesced."""
+        self._respond('{"a": 1}', '{"a": 1}')
+        commands = []
+        for i in range(2):
+            command = stellr.UpdateCommand(TEST_HTTP)
+            command.add_documents({'id': 1})
+            commands.append(command)
+        self._execute(commands)
+        self.assertEqual(2, self.client._http_pool.urlopen.call_count)
@@ -0,0 +1,92 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+from mock import patch, Mock
+from nose.tools import raises
+import simplejson as json
+import unittest
+
+import stellr
+
+DATA = {'date': datetime.datetime(1970, 2, 3, 11, 20, 42),
+        'dates': [1, datetime.datetime(2012, 1, 2, 3, 4, 5)],
+        'int': 4,
+        'str': 'string'}
+
+class CodecTest(unittest.TestCase):
+    """Perform tests on the codec module."""
+
+    def tearDown(self):
+        stellr.codec.set_codec(stellr.codec.JSONCodec())
+
+    def test_json_codec(self):
+        """Test the default codec matches the StellrJSONEncoder."""
+        c = stellr.codec.JSONCodec()
+        encoded = c.dumps(DATA)
+        self.assertEqual(encoded,
+            json.dumps(DATA, cls=stellr.stellr.StellrJSONEncoder))
+        self.assertEqual(c.loads(encoded)['dates'][1], '2012-01-02T03:04:05Z')
+
+    @raises(TypeError)
+    def test_json_codec_unknown_type(self):
+        """Test the default codec rejects unknown types."""
+        stellr.codec.JSONCodec().dumps({'a': object()})
+
+    @raises(ValueError)
+    def test_json_codec_invalid(self):
+        """Test the default codec raises a ValueError for invalid JSON."""
+        stellr.codec.JSONCodec().loads('{"a": ')
+
+    def test_prepare(self):
+        """Test datetime instances are encoded before using ujson."""
+        plain = {'a': [1, 2], 'b': {'c': 'd'}}
+        self.assertTrue(stellr.codec._prepare(plain) is plain)
+        prepared = stellr.codec._prepare(DATA)
+        self.assertEqual(prepared['date'], '1970-02-03T11:20:42Z')
+        self.assertEqual(prepared['dates'], [1, '2012-01-02T03:04:05Z'])
+        self.assertTrue(isinstance(DATA['date'], datetime.datetime))
+
+    @patch('stellr.codec.ujson')
+    def test_set_codec(self, ujson):
+        """Test selecting a codec by name."""
+        ujson.dumps.return_value = '{}'
+        c = stellr.codec.set_codec('ujson')
+        self.assertEqual(c, stellr.codec.get_codec())
+        self.assertEqual('ujson', c.name)
+
+        u = stellr.UpdateCommand('http://localhost:8983')
+        u.add_documents({'a': datetime.datetime(2012, 1, 2, 3, 4, 5)})
+        self.assertEqual('{"add": {}}', u.body)
+        ujson.dumps.assert_called_with(
+            {'doc': {'a': '2012-01-02T03:04:05Z'}}, double_precision=17)
+
+    @patch('stellr.codec.ujson')
+    def test_ujson_precision(self, ujson):
+        """Test ujson keeps the precision of floats its version allows."""
+        def dumps(obj, double_precision=10):
+            if double_precision > 15:
+                raise ValueError('max is 15')
+            return '0.1'
+        ujson.dumps.side_effect = dumps
+        ujson.loads.side_effect = TypeError('precise_float')
+        c = stellr.codec.UltraJSONCodec()
+        self.assertEqual({'double_precision': 15}, c._dumps_options)
+        self.assertEqual({}, c._loads_options)
+
+    @raises(ImportError)
+    def test_missing_ujson(self):
+        """Test the ujson codec cannot be created when it is missing."""
+        with patch('stellr.codec.ujson', None):
+            stellr.codec.set_codec('ujson')
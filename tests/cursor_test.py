@@ -0,0 +1,129 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch
+from nose.tools import raises
+import gevent
+import unittest
+
+import stellr
+
+TEST_HTTP = 'http://localhost:8983'
+
+PAGES = {
+    '*': ([{'id': 1}, {'id': 2}], 'AoE1'),
+    'AoE1': ([{'id': 3}, {'id': 4}], 'AoE2'),
+    'AoE2': ([{'id': 5}], 'AoE3'),
+    'AoE3': ([], 'AoE3'),
+}
+
+class CursorIteratorTest(unittest.TestCase):
+    """Perform tests on the cursor module."""
+
+    def setUp(self):
+        self.requests = []
+        self.error_on = None
+        self.error = stellr.StellrError('oops', status=500)
+        patcher = patch('stellr.stellr.SelectCommand.execute',
+                        autospec=True, side_effect=self._execute)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _execute(self, command, return_name=False):
+        params = dict(command._commands)
+        self.requests.append(command._commands)
+        mark = params['cursorMark']
+        if mark == self.error_on:
+            raise self.error
+        gevent.sleep(0)
+        docs, next_mark = PAGES[mark]
+        return {'response': {'numFound': 5, 'docs': docs},
+                'nextCursorMark': next_mark}
+
+    def _command(self):
+        command = stellr.SelectCommand(TEST_HTTP)
+        command.add_param('q', '*:*')
+        command.add_param('sort', 'id asc')
+        command.add_param('rows', 50)
+        return command
+
+    def test_iterate(self):
+        """Test every document is yielded across the pages."""
+        cursor = stellr.CursorIterator(self._command(), rows=2)
+        self.assertEqual([1, 2, 3, 4, 5], [d['id'] for d in cursor])
+        self.assertEqual(5, cursor.num_found)
+        self.assertEqual(3, cursor.pages)
+        self.assertEqual(4, len(self.requests))
+        self.assertEqual(self.requests[1],
+            [('wt', 'json'), ('q', '*:*'), ('sort', 'id asc'),
+             ('rows', '2'), ('cursorMark', 'AoE1')])
+
+    def test_prefetch(self):
+        """Test the next page is fetched while a page is consumed."""
+        cursor = iter(stellr.CursorIterator(self._command(), rows=2))
+        self.assertEqual({'id': 1}, next(cursor))
+        gevent.sleep(0.01)
+        self.assertTrue(len(self.requests) >= 2)
+
+    def test_prefetch_depth(self):
+        """Test no more than prefetch pages are fetched ahead."""
+        cursor = iter(stellr.CursorIterator(self._command(), rows=2))
+        self.assertEqual({'id': 1}, next(cursor))
+        gevent.sleep(0.01)
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual([{'id': 2}, {'id': 3}], [next(cursor), next(cursor)])
+        gevent.sleep(0.01)
+        self.assertEqual(3, len(self.requests))
+
+    def test_page_settings(self):
+        """Test the settings of the command apply to each page."""
+        command = self._command()
+        command.accept_gzip = True
+        command.retry_policy = stellr.RetryPolicy()
+        page = stellr.CursorIterator(command)._page_command('*')
+        self.assertTrue(page.accept_gzip)
+        self.assertTrue(page.retry_policy is command.retry_policy)
+
+    def test_close(self):
+        """Test that stopping iteration stops fetching pages."""
+        cursor = stellr.CursorIterator(self._command(), rows=2)
+        for doc in cursor:
+            break
+        self.assertEqual(None, cursor._fetcher)
+
+    @raises(stellr.StellrError)
+    def test_error(self):
+        """Test that an error fetching a page is raised."""
+        self.error_on = 'AoE1'
+        cursor = stellr.CursorIterator(self._command(), rows=2)
+        docs = []
+        try:
+            for doc in cursor:
+                docs.append(doc)
+        finally:
+            self.assertEqual([{'id': 1}, {'id': 2}], docs)
+
+    def test_unexpected_error(self):
+        """Test that any error fetching a page is raised as a StellrError."""
+        self.error_on = 'AoE1'
+        self.error = ValueError('not a dict')
+        cursor = iter(stellr.CursorIterator(self._command(), rows=2))
+        self.assertEqual([{'id': 1}, {'id': 2}], [next(cursor), next(cursor)])
+        with gevent.Timeout(1):
+            self.assertRaises(stellr.StellrError, next, cursor)
+
+    @raises(ValueError)
+    def test_invalid_prefetch(self):
+        """Test that at least one page must be prefetched."""
+        stellr.CursorIterator(self._command(), prefetch=0)
@@ -0,0 +1,67 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import Mock
+import gevent
+import unittest
+
+import stellr
+
+def _command(name, delay, result=None, error=None):
+    command = Mock()
+    command.name = name
+    def execute():
+        gevent.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    command.execute.side_effect = execute
+    return command
+
+class ExecuteManyTest(unittest.TestCase):
+    """Perform tests on the executor module."""
+
+    def test_results_as_completed(self):
+        """Test that results are yielded in the order they complete."""
+        commands = [_command('slow', 0.03, {'n': 1}),
+                    _command('fast', 0.01, {'n': 2})]
+        results = list(stellr.execute_many(commands))
+        self.assertEqual(results, [('fast', {'n': 2}), ('slow', {'n': 1})])
+
+    def test_concurrent_execution(self):
+        """Test that commands run concurrently up to the limit."""
+        commands = [_command(str(i), 0.05, i) for i in range(4)]
+        with gevent.Timeout(0.15):
+            results = list(stellr.execute_many(commands, concurrency=4))
+        self.assertEqual(sorted(r for n, r in results), [0, 1, 2, 3])
+
+    def test_errors(self):
+        """Test that errors are yielded in place of results."""
+        error = stellr.StellrError('bad', status=500)
+        commands = [_command('bad', 0, error=error),
+                    _command('other', 0, error=ValueError('oops'))]
+        results = dict(stellr.execute_many(commands))
+        self.assertEqual(results['bad'], error)
+        self.assertTrue(isinstance(results['other'], stellr.StellrError))
+        self.assertEqual(str(results['other']), 'Error: oops')
+
+    def test_deadline(self):
+        """Test that commands still running at the deadline time out."""
+        commands = [_command('fast', 0, {'n': 1}),
+                    _command('slow', 1, {'n': 2})]
+        results = list(stellr.execute_many(commands, timeout=0.02))
+        self.assertEqual(results[0], ('fast', {'n': 1}))
+        name, error = results[1]
+        self.assertEqual(name, 'slow')
+        self.assertTrue(error.timeout)
@@ -0,0 +1,198 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import gevent
+import unittest
+import urllib3
+
+import stellr
+
+HOSTS = ['http://replica1:8983', 'http://replica2:8983', 'tcp://replica3:9000']
+
+class HostGroupTest(unittest.TestCase):
+    """Perform tests on the hosts module."""
+
+    def test_choose_in_turn(self):
+        """Test that hosts are chosen in turn."""
+        g = stellr.HostGroup(HOSTS)
+        chosen = [g.choose() for i in range(6)]
+        self.assertEqual(sorted(chosen), sorted(HOSTS * 2))
+        self.assertEqual('%s' % g, ','.join(HOSTS))
+
+    def test_skip_down_hosts(self):
+        """Test that hosts that are down are not chosen."""
+        g = stellr.HostGroup(HOSTS, probe_interval=60)
+        g.mark_down(HOSTS[0])
+        self.assertFalse(g.is_up(HOSTS[0]))
+        chosen = set(g.choose() for i in range(6))
+        self.assertEqual(chosen, set(HOSTS[1:]))
+        self.assertEqual(chosen, set([g.choose(exclude=[HOSTS[2]]),
+                                      g.choose(exclude=[HOSTS[1]])]))
+        g.mark_up(HOSTS[0])
+        self.assertEqual(set(g.choose() for i in range(6)), set(HOSTS))
+        g.stop()
+
+    def test_all_hosts_down(self):
+        """Test that a host is still chosen when every host is down."""
+        g = stellr.HostGroup(HOSTS[:1], probe_interval=60)
+        g.mark_down(HOSTS[0])
+        self.assertEqual(HOSTS[0], g.choose())
+        self.assertEqual(HOSTS[0], g.choose(exclude=HOSTS))
+        g.stop()
+
+    @patch('stellr.stellr.SelectCommand.execute')
+    def test_probe(self, execute):
+        """Test that a host is marked up once a probe succeeds."""
+        execute.side_effect = [stellr.StellrError('down'), {}]
+        g = stellr.HostGroup(HOSTS, probe_interval=0.01)
+        g.mark_down(HOSTS[1])
+        gevent.sleep(0.015)
+        self.assertFalse(g.is_up(HOSTS[1]))
+        gevent.sleep(0.015)
+        self.assertTrue(g.is_up(HOSTS[1]))
+        self.assertEqual(2, execute.call_count)
+        gevent.sleep(0.01)
+        self.assertEqual(None, g._prober)
+
+    @patch('stellr.stellr.SelectCommand.execute', autospec=True)
+    def test_probe_client(self, execute):
+        """Test that a probe uses the client of the failed command."""
+        client = stellr.StellrClient(patch=False)
+        g = stellr.HostGroup(HOSTS, probe_interval=0.01)
+        g.mark_down(HOSTS[1], client)
+        gevent.sleep(0.015)
+        self.assertTrue(g.is_up(HOSTS[1]))
+        command = execute.call_args[0][0]
+        self.assertTrue(command.client is client)
+        self.assertEqual(0, command.retry_policy.max_retries)
+
+        other = stellr.StellrClient(patch=False)
+        g = stellr.HostGroup(HOSTS, probe_interval=0.01, client=other)
+        g.mark_down(HOSTS[1], client)
+        gevent.sleep(0.015)
+        self.assertTrue(execute.call_args[0][0].client is other)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_probe_not_cached(self, pool):
+        """Test that a probe is sent even when the host is cached."""
+        pool.urlopen.side_effect = [Mock(status=200, data='{}'),
+                                    urllib3.TimeoutError()]
+        stellr.cache.set_host_cache(HOSTS[1], stellr.QueryCache())
+        try:
+            g = stellr.HostGroup(HOSTS, probe_interval=0.01)
+            stellr.SelectCommand(HOSTS[1], handler=g.probe_handler,
+                                 name='ping').execute()
+            g.mark_down(HOSTS[1])
+            gevent.sleep(0.015)
+            g.stop()
+            self.assertFalse(g.is_up(HOSTS[1]))
+            self.assertEqual(2, pool.urlopen.call_count)
+        finally:
+            stellr.cache.set_host_cache(HOSTS[1], None)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_marks_down(self, pool):
+        """Test that a timeout during execution marks the host down."""
+        pool.urlopen.side_effect = urllib3.TimeoutError()
+        g = stellr.HostGroup(HOSTS[:2], probe_interval=60)
+        command = stellr.SelectCommand(g)
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertTrue(e.timeout)
+        host = pool.urlopen.call_args[0][1].split('/solr')[0]
+        self.assertEqual([host], g.down.keys())
+
+        response = Mock()
+        response.status = 500
+        response.data = ''
+        pool.urlopen.side_effect = None
+        pool.urlopen.return_value = response
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertEqual(500, e.status)
+        self.assertEqual(1, len(g.down))
+        url = pool.urlopen.call_args[0][1]
+        self.assertFalse(url.startswith(host))
+        g.stop()
+
+    def _hedged_group(self, delays, errors=()):
+        # a group whose hosts answer after their delay, or fail if in errors
+        def execute_host(command, host, return_name, cache, cache_key):
+            gevent.sleep(delays[host])
+            if host in errors:
+                raise stellr.StellrError('failed', status=500)
+            return {'host': host}
+        patcher = patch('stellr.stellr.BaseCommand._execute_host',
+                        execute_host)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return stellr.HostGroup(HOSTS[:2], hedge_delay=0.01)
+
+    def test_hedge(self):
+        """Test a slow host is hedged by sending to a second host."""
+        g = self._hedged_group({HOSTS[0]: 1, HOSTS[1]: 0.01})
+        g.choose = Mock(side_effect=[HOSTS[0], HOSTS[1]])
+        self.assertEqual({'host': HOSTS[1]}, stellr.SelectCommand(g).execute())
+        self.assertEqual(1, g.hedged)
+        self.assertEqual(1, g.cancelled)
+        g.choose.assert_called_with(exclude=[HOSTS[0]])
+
+    def test_no_hedge_fast_host(self):
+        """Test a host that answers within the delay is not hedged."""
+        g = self._hedged_group({HOSTS[0]: 0, HOSTS[1]: 0})
+        self.assertTrue(stellr.SelectCommand(g).execute()['host'] in HOSTS)
+        self.assertEqual(0, g.hedged)
+
+    def test_no_hedge_update(self):
+        """Test commands that write are never hedged."""
+        g = self._hedged_group({HOSTS[0]: 0.02, HOSTS[1]: 0.02})
+        stellr.UpdateCommand(g).execute()
+        self.assertEqual(0, g.hedged)
+
+    def test_hedge_first_fails(self):
+        """Test the second response is used when the first host fails."""
+        g = self._hedged_group({HOSTS[0]: 0.02, HOSTS[1]: 0.05},
+                               errors=[HOSTS[0]])
+        g.choose = Mock(side_effect=[HOSTS[0], HOSTS[1]])
+        self.assertEqual({'host': HOSTS[1]}, stellr.SelectCommand(g).execute())
+        self.assertEqual(0, g.cancelled)
+
+    def test_hedge_both_fail(self):
+        """Test the error of the first host is raised when both fail."""
+        g = self._hedged_group({HOSTS[0]: 0.03, HOSTS[1]: 0.02},
+                               errors=HOSTS)
+        g.choose = Mock(side_effect=[HOSTS[0], HOSTS[1]])
+        self.assertRaises(stellr.StellrError,
+                          stellr.SelectCommand(g).execute)
+        self.assertEqual(1, g.hedged)
+
+    def test_hedge_percentile(self):
+        """Test the hedge delay is taken from the measured latencies."""
+        previous = stellr.metrics.get_registry()
+        registry = stellr.metrics.set_registry(
+            stellr.metrics.MetricsRegistry())
+        try:
+            g = stellr.HostGroup(HOSTS[:2], hedge_delay=0.5,
+                                 hedge_percentile=90)
+            self.assertEqual(0.5, g.get_hedge_delay('select', HOSTS[0]))
+            for i in range(100):
+                registry.record('select', HOSTS[0], 0.002 if i < 95 else 1)
+            self.assertEqual(0.0025, g.get_hedge_delay('select', HOSTS[0]))
+            self.assertEqual(None, stellr.HostGroup(HOSTS[:1],
+                hedge_delay=1).get_hedge_delay('select', HOSTS[0]))
+        finally:
+            stellr.metrics.set_registry(previous)
@@ -0,0 +1,175 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import unittest
+
+import stellr
+from stellr.metrics import Histogram, MetricsRegistry
+
+TEST_HTTP = 'http://localhost:8983'
+RESPONSE = '{"response": {"numFound": 0, "docs": []}}'
+
+class HistogramTest(unittest.TestCase):
+    """Perform tests on the Histogram."""
+
+    def test_percentiles(self):
+        """Test estimating percentiles from the buckets."""
+        h = Histogram(buckets=(1, 2, 5))
+        self.assertEqual(None, h.percentile(50))
+        for value in (0.5, 0.7, 1.5, 4, 9):
+            h.add(value)
+        self.assertEqual(1, h.percentile(20))
+        self.assertEqual(1, h.percentile(40))
+        self.assertEqual(2, h.percentile(60))
+        self.assertEqual(5, h.percentile(80))
+        self.assertEqual(9, h.percentile(99))
+
+        s = h.snapshot()
+        self.assertEqual(5, s['count'])
+        self.assertEqual(0.5, s['min'])
+        self.assertEqual(9, s['max'])
+        self.assertAlmostEqual(3.14, s['mean'])
+        self.assertEqual([(1, 2), (2, 1), (5, 1), (None, 1)], s['buckets'])
+
+class MetricsRegistryTest(unittest.TestCase):
+    """Perform tests on the MetricsRegistry."""
+
+    def setUp(self):
+        self.previous = stellr.metrics.get_registry()
+        self.registry = stellr.metrics.set_registry(MetricsRegistry())
+
+    def tearDown(self):
+        stellr.metrics.set_registry(self.previous)
+
+    def test_record(self):
+        """Test recording commands by name and host."""
+        r = self.registry
+        r.record('select', 'a', 0.01)
+        r.record('select', 'a', 0.02, stellr.StellrError('x', timeout=True))
+        r.record('select', 'b', 0.03, stellr.StellrError('x'))
+        r.record_bytes('select', 'a', 10, 100)
+        r.record_cached('update', 'a')
+        s = r.snapshot()['commands']
+        self.assertEqual(2, s['select']['a']['requests'])
+        self.assertEqual(1, s['select']['a']['errors'])
+        self.assertEqual(1, s['select']['a']['timeouts'])
+        self.assertEqual(10, s['select']['a']['request_bytes'])
+        self.assertEqual(100, s['select']['a']['response_bytes'])
+        self.assertEqual(2, s['select']['a']['latency']['count'])
+        self.assertEqual(1, s['select']['b']['errors'])
+        self.assertEqual(0, s['select']['b']['timeouts'])
+        self.assertEqual(1, s['update']['a']['cached'])
+
+        r.reset()
+        self.assertEqual({}, r.snapshot()['commands'])
+
+    def test_disabled(self):
+        """Test nothing is recorded when the registry is disabled."""
+        r = self.registry
+        r.enabled = False
+        r.record('select', 'a', 0.01)
+        r.record_bytes('select', 'a', 10, 100)
+        self.assertEqual({}, r.snapshot()['commands'])
+
+    def test_pools(self):
+        """Test the pools are kept when the registry is replaced."""
+        self.assertTrue('http' in self.registry.pools)
+        self.assertTrue('zmq' in self.registry.pools)
+        self.registry.add_pool('test', lambda: {'size': 1})
+        self.assertEqual({'size': 1},
+                         self.registry.snapshot()['pools']['test'])
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute(self, pool):
+        """Test the execution of commands is recorded."""
+        response = Mock()
+        response.status = 200
+        response.data = RESPONSE
+        pool.urlopen.return_value = response
+        stellr.SelectCommand(TEST_HTTP).execute()
+        response.status = 500
+        self.assertRaises(stellr.StellrError,
+                          stellr.SelectCommand(TEST_HTTP).execute)
+
+        s = self.registry.snapshot()['commands']['select'][TEST_HTTP]
+        self.assertEqual(2, s['requests'])
+        self.assertEqual(1, s['errors'])
+        self.assertEqual(len(RESPONSE), s['response_bytes'])
+        self.assertEqual(0, s['request_bytes'])
+
+    def test_http_pool_stats(self):
+        """Test the stats of the http pool."""
+        client = stellr.StellrClient()
+        self.assertEqual({}, client.http_stats())
+        conn_pool = Mock(num_connections=2, num_requests=5)
+        conn_pool.pool.queue = [None, Mock(), None]
+        client._http_pool = Mock()
+        client._http_pool.pools = {('http', 'localhost', 8983): conn_pool}
+        self.assertEqual({'http://localhost:8983': {
+            'requests': 5, 'hits': 3, 'misses': 2, 'created': 2, 'idle': 1}},
+            client.http_stats())
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_profile(self, pool):
+        """Test the timings of each phase are passed to the hook."""
+        hook = Mock()
+        self.registry.profile = True
+        self.registry.profile_hook = hook
+        response = Mock()
+        response.status = 200
+        response.data = RESPONSE
+        pool.urlopen.return_value = response
+        command = stellr.UpdateCommand(TEST_HTTP)
+        command.add_documents({'id': 1})
+        command.execute()
+
+        self.assertEqual(set(['url', 'encode', 'network', 'decode', 'total']),
+                         set(command.timings))
+        hook.assert_called_once_with(command, command.timings, None)
+
+        response.status = 500
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertEqual(command.timings, e.timings)
+            self.assertTrue('network' not in e.timings)
+            self.assertTrue('total' in e.timings)
+            hook.assert_called_with(command, e.timings, e)
+            return
+
+        self.assertFalse(True, 'Error should have been raised')
+
+    @patch('stellr.pool.zmq_socket_pool')
+    def test_profile_zmq(self, pool):
+        """Test the time waiting for a ZeroMQ socket is measured."""
+        self.registry.profile = True
+        socket = Mock()
+        socket.recv.return_value = Mock(
+            bytes='{"responseHeader": {"status": 0}}')
+        context = pool.return_value
+        context.__enter__ = Mock(return_value=socket)
+        context.__exit__ = Mock(return_value=False)
+        command = stellr.SelectCommand('tcp://localhost:5555')
+        command.execute()
+        self.assertEqual(set(['url', 'encode', 'pool_wait', 'network',
+                              'decode', 'total']), set(command.timings))
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_not_profiled(self, pool):
+        """Test no timings are set unless profiling."""
+        pool.urlopen.side_effect = Exception()
+        command = stellr.SelectCommand(TEST_HTTP)
+        self.assertRaises(stellr.StellrError, command.execute)
+        self.assertEqual(None, command.timings)
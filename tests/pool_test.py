@@ -14,6 +14,7 @@
 
 from mock import patch, Mock, MagicMock
 import unittest
+import gevent
 import gevent.queue
 from gevent_zeromq import zmq
 
@@ -31,6 +32,7 @@ class PoolTest(unittest.TestCase):
         self.assertEquals(p.context, context)
         self.assertEquals(p.size, 42)
         self.assertEquals(p.pools, {})
+        self.assertEquals(p.slots, {})
 
     @patch('stellr.pool.PoolManager')
     def pool_creation_test(self, pool_mgr):
@@ -42,7 +44,37 @@ class PoolTest(unittest.TestCase):
         stellr.pool.zmq_socket_pool.create(context, 69)
 
         self.assertEquals(stellr.pool.zmq_socket_pool.pool, mgr)
-        pool_mgr.assert_called_once_with(context, 69)
+        pool_mgr.assert_called_once_with(context, 69, None, False, None)
+
+    @patch('stellr.pool.get_context')
+    @patch('stellr.pool.PoolManager')
+    def lazy_pool_creation_test(self, pool_mgr, get_context):
+        """Test the pool is created on first use if create was not called."""
+        previous = stellr.pool.zmq_socket_pool.pool
+        stellr.pool.zmq_socket_pool.pool = None
+        try:
+            self.assertEqual({}, stellr.pool.zmq_socket_pool.stats())
+            self.assertEqual(0, pool_mgr.call_count)
+            with stellr.pool.zmq_socket_pool(ADDRESS, 1):
+                pass
+            pool_mgr.assert_called_once_with(get_context.return_value, 10,
+                                             None, False, None)
+            pool_mgr.return_value.get_socket.assert_called_once_with(
+                ADDRESS, 1)
+        finally:
+            stellr.pool.zmq_socket_pool.pool = previous
+
+    @patch('stellr.pool.zmq.Context')
+    def get_context_test(self, context):
+        """Test the context is created once, on first use."""
+        previous = stellr.pool._context
+        stellr.pool._context = None
+        try:
+            self.assertEqual(context.return_value, stellr.pool.get_context())
+            self.assertEqual(context.return_value, stellr.pool.get_context())
+            context.assert_called_once_with()
+        finally:
+            stellr.pool._context = previous
 
     def create_socket_test(self):
         """Test the _create_socket method."""
@@ -63,12 +95,8 @@ class PoolTest(unittest.TestCase):
         p.destroy_socket(socket)
         socket.setsockopt.assert_called_once_with(zmq.LINGER, 0)
 
-    @patch('gevent.queue.Queue')
-    def get_socket_empty_queue_test(self, q):
+    def get_socket_empty_queue_test(self):
         """Test getting a socket with an empty pool."""
-        queue = Mock()
-        queue.empty.return_value = True
-        q.return_value = queue
         context = Mock()
         p = stellr.pool.PoolManager(context)
         socket = Mock()
@@ -77,55 +105,65 @@ class PoolTest(unittest.TestCase):
 
         s = p.get_socket(ADDRESS)
         self.assertEqual(s, socket)
-        self.assertEqual(1, queue.empty.call_count)
+        socket.assert_called_once_with(ADDRESS)
         self.assertEqual(1, len(p.pools))
+        self.assertEqual(9, p.slots[ADDRESS].counter)
 
-    @patch('gevent.queue.Queue')
-    def get_socket_empty_queue_empty_error_test(self, q):
-        """Test getting a socket with pool that throws an empty error."""
-        queue = Mock()
-        queue.empty.return_value = False
-        queue.get_nowait.side_effect = gevent.queue.Empty
-        q.return_value = queue
-        context = Mock()
-        p = stellr.pool.PoolManager(context)
+    def get_socket_non_empty_queue_test(self):
+        """Test getting a socket with a non-empty pool."""
+        p = stellr.pool.PoolManager(Mock())
+        create = Mock()
+        p._create_socket = create
         socket = Mock()
-        socket.return_value = socket
-        p._create_socket = socket
+        p.get_socket(ADDRESS)
+        p.replace_socket(ADDRESS, socket)
+        create.reset_mock()
 
         s = p.get_socket(ADDRESS)
         self.assertEqual(s, socket)
-        self.assertEqual(1, queue.empty.call_count)
+        self.assertEqual(0, create.call_count)
         self.assertEqual(1, len(p.pools))
 
-    @patch('gevent.queue.Queue')
-    def get_socket_non_empty_queue_test(self, q):
-        """Test getting a socket with a non-empty pool."""
-        socket = Mock()
-        queue = Mock()
-        queue.empty.return_value = False
-        queue.get_nowait.return_value = socket
-        q.return_value = queue
-        context = Mock()
-        p = stellr.pool.PoolManager(context)
-        p.pools[ADDRESS] = queue
+    def get_socket_limit_test(self):
+        """Test no more than size sockets are opened to an address."""
+        p = stellr.pool.PoolManager(Mock(), 2)
+        p._create_socket = Mock(side_effect=lambda address: Mock())
+        first = p.get_socket(ADDRESS)
+        second = p.get_socket(ADDRESS)
+        self.assertEqual(2, p._create_socket.call_count)
+        self.assertRaises(stellr.pool.PoolTimeout,
+                          p.get_socket, ADDRESS, 0.01)
 
-        s = p.get_socket(ADDRESS)
-        self.assertEqual(s, socket)
-        self.assertEqual(1, queue.empty.call_count)
-        self.assertEqual(1, len(p.pools))
+        # a waiting caller receives the socket that is returned
+        waiter = gevent.spawn(p.get_socket, ADDRESS, 1)
+        gevent.sleep(0)
+        p.replace_socket(ADDRESS, first)
+        self.assertEqual(first, waiter.get())
+
+        # destroying a socket allows another to be opened
+        waiter = gevent.spawn(p.get_socket, ADDRESS, 1)
+        gevent.sleep(0)
+        p.destroy_socket(second, ADDRESS)
+        self.assertNotEqual(second, waiter.get())
+        self.assertEqual(3, p._create_socket.call_count)
+
+    def get_socket_create_error_test(self):
+        """Test a failure to create a socket does not use up the limit."""
+        p = stellr.pool.PoolManager(Mock(), 1)
+        p._create_socket = Mock(side_effect=zmq.ZMQError())
+        self.assertRaises(zmq.ZMQError, p.get_socket, ADDRESS)
+        self.assertEqual(1, p.slots[ADDRESS].counter)
 
     def replace_socket_success_test(self):
         """Test successfully replacing a socket."""
         p = stellr.pool.PoolManager(Mock())
-        q = Mock()
-        q.full.return_value = False
-        p.pools[ADDRESS] = q
+        p._create_socket = Mock()
+        p.get_socket(ADDRESS)
         s = Mock()
 
         p.replace_socket(ADDRESS, s)
-        self.assertEqual(1, q.full.call_count)
-        q.put_nowait.assert_called_once_with(s)
+        self.assertEqual(1, p.pools[ADDRESS].qsize())
+        self.assertEqual(10, p.slots[ADDRESS].counter)
 
     def replace_socket_no_queue_test(self):
         """Test replacing a socket with no pool to put it in."""
@@ -136,30 +174,108 @@ class PoolTest(unittest.TestCase):
         p.replace_socket(ADDRESS, socket)
         destroy.assert_called_once_with(socket)
 
-    def replace_socket_full_queue_test(self):
-        """Test replacing a socket into a full pool."""
-        q = Mock()
-        q.full.return_value = True
-        socket = Mock()
-        p = stellr.pool.PoolManager(Mock())
-        p.pools[ADDRESS] = q
-        destroy = Mock()
-        p.destroy_socket = destroy
-        p.replace_socket(ADDRESS, socket)
-        destroy.assert_called_once_with(socket)
-
     def replace_socket_full_queue_full_error_test(self):
         """Test replacing a socket into a full pool."""
         q = Mock()
-        q.full.return_value = False
         q.put_nowait.side_effect = gevent.queue.Full
         socket = Mock()
         p = stellr.pool.PoolManager(Mock())
+        p._create_socket = Mock()
+        p.get_socket(ADDRESS)
         p.pools[ADDRESS] = q
-        destroy = Mock()
-        p.destroy_socket = destroy
         p.replace_socket(ADDRESS, socket)
-        destroy.assert_called_once_with(socket)
+        socket.close.assert_called_once_with()
+        self.assertEqual(10, p.slots[ADDRESS].counter)
+
+    def warm_test(self):
+        """Test opening idle sockets to an address."""
+        p = stellr.pool.PoolManager(Mock(), 3)
+        p._create_socket = Mock(side_effect=lambda address: Mock())
+        self.assertEqual(2, p.warm(ADDRESS, 2))
+        self.assertEqual(2, p.pools[ADDRESS].qsize())
+
+        # no more than size sockets are opened
+        p.get_socket(ADDRESS)
+        self.assertEqual(1, p.warm(ADDRESS, 5))
+        self.assertEqual(0, p.warm(ADDRESS, 5))
+        self.assertEqual(3, p._create_socket.call_count)
+
+    @patch('stellr.pool.time')
+    def idle_ttl_test(self, time):
+        """Test sockets idle for longer than idle_ttl are not reused."""
+        time.time.return_value = 100
+        context = Mock()
+        context.socket.side_effect = lambda socket_type: Mock()
+        p = stellr.pool.PoolManager(context, idle_ttl=10)
+        p._reaper = Mock()
+        old = p.get_socket(ADDRESS)
+        recent = p.get_socket(ADDRESS)
+        p.replace_socket(ADDRESS, old)
+        time.time.return_value = 105
+        p.replace_socket(ADDRESS, recent)
+
+        # the most recently returned socket is reused first
+        time.time.return_value = 112
+        self.assertEqual(recent, p.get_socket(ADDRESS))
+        p.replace_socket(ADDRESS, recent)
+
+        self.assertEqual(1, p.evict_idle())
+        old.close.assert_called_once_with()
+        self.assertEqual(1, p.pools[ADDRESS].qsize())
+
+        time.time.return_value = 130
+        s = p.get_socket(ADDRESS)
+        self.assertNotEqual(recent, s)
+        recent.close.assert_called_once_with()
+        self.assertEqual(3, p.counters[ADDRESS]['created'])
+        self.assertEqual(2, p.counters[ADDRESS]['destroyed'])
+
+    def check_test(self):
+        """Test idle sockets that cannot send are replaced."""
+        p = stellr.pool.PoolManager(Mock(), check=True)
+        p._create_socket = Mock(side_effect=lambda address: Mock())
+        ready = p.get_socket(ADDRESS)
+        ready.getsockopt.return_value = zmq.POLLOUT
+        p.replace_socket(ADDRESS, ready)
+        self.assertEqual(ready, p.get_socket(ADDRESS))
+        ready.getsockopt.assert_called_once_with(zmq.EVENTS)
+
+        ready.getsockopt.return_value = 0
+        p.replace_socket(ADDRESS, ready)
+        self.assertNotEqual(ready, p.get_socket(ADDRESS))
+        ready.close.assert_called_once_with()
+
+    def check_immediate_test(self):
+        """Test checked sockets only count a connected peer."""
+        context = Mock()
+        stellr.pool.PoolManager(context, check=True).get_socket(ADDRESS)
+        context.socket.return_value.setsockopt.assert_any_call(
+            zmq.IMMEDIATE, 1)
+        context = Mock()
+        stellr.pool.PoolManager(context).get_socket(ADDRESS)
+        self.assertFalse(context.socket.return_value.setsockopt.called)
+
+    def stats_test(self):
+        """Test the stats of the pool."""
+        p = stellr.pool.PoolManager(Mock(), 5)
+        p.warm(ADDRESS, 2)
+        s = p.get_socket(ADDRESS)
+        p.get_socket(ADDRESS)
+        p.get_socket(ADDRESS)
+        p.destroy_socket(s, ADDRESS)
+        self.assertEqual({ADDRESS: {'size': 2, 'idle': 0, 'in_use': 2,
+                                    'hits': 2, 'misses': 1,
+                                    'created': 3, 'destroyed': 1}},
+                         p.stats())
+
+    def heartbeat_test(self):
+        """Test heartbeats are enabled on new sockets."""
+        context = Mock()
+        p = stellr.pool.PoolManager(context, heartbeat=2)
+        p.get_socket(ADDRESS)
+        socket = context.socket.return_value
+        socket.setsockopt.assert_any_call(zmq.HEARTBEAT_IVL, 2000)
+        socket.setsockopt.assert_any_call(zmq.HEARTBEAT_TIMEOUT, 6000)
 
     def enter_context_test(self):
         """Test entering the context."""
@@ -170,12 +286,12 @@ class PoolTest(unittest.TestCase):
         stellr.pool.zmq_socket_pool.pool = pool
         with z as f:
             self.assertEqual(f, socket)
-        pool.get_socket.assert_called_once_with(ADDRESS)
+        pool.get_socket.assert_called_once_with(ADDRESS, None)
         pool.replace_socket.assert_called_once_with(ADDRESS, socket)
 
     def enter_context_error_test(self):
         """Test entering the context."""
-        z = stellr.pool.zmq_socket_pool(ADDRESS)
+        z = stellr.pool.zmq_socket_pool(ADDRESS, 5)
         socket = Mock()
         pool = Mock()
         pool.get_socket.return_value = socket
@@ -186,5 +302,93 @@ class PoolTest(unittest.TestCase):
                 raise Exception()
         except Exception:
             pass
-        pool.get_socket.assert_called_once_with(ADDRESS)
-        pool.destroy_socket.assert_called_once_with(socket)
\ No newline at end of file
+        pool.get_socket.assert_called_once_with(ADDRESS, 5)
+        pool.destroy_socket.assert_called_once_with(socket, ADDRESS)
+    def send_frames_test(self):
+        """Test sending frames as a single multipart message."""
+        socket = Mock()
+        stellr.pool.send_frames(socket, iter(['a', 'b', 'c']), copy=False)
+        self.assertEqual([(('a', zmq.SNDMORE), {'copy': False}),
+                          (('b', zmq.SNDMORE), {'copy': False}),
+                          (('c',), {'copy': False})],
+                         socket.send.call_args_list)
+
+    def dealer_pipelining_test(self):
+        """Test replies are routed to the request with the same id."""
+        c, socket, replies = self._create_dealer()
+        first = gevent.spawn(c.request, ['first'], 1)
+        second = gevent.spawn(c.request, ['second'], 1)
+        gevent.sleep(0)
+        sent = [args[0] for args, kwargs in socket.send.call_args_list]
+        self.assertEqual(6, len(sent))
+        self.assertEqual('', sent[1])
+        self.assertEqual('', sent[4])
+
+        # reply to the requests in the reverse order they were sent
+        replies.put([sent[3], '', 're:second'])
+        replies.put([sent[0], '', 're:first'])
+        self.assertEqual('re:first', first.get())
+        self.assertEqual('re:second', second.get())
+        self.assertEqual({}, c.pending)
+        c.close()
+
+    def dealer_timeout_test(self):
+        """Test a request without a reply times out."""
+        c, socket, replies = self._create_dealer()
+        self.assertEqual(None, c.request(['message'], 0.01))
+        self.assertEqual({}, c.pending)
+
+        # a late reply is dropped
+        replies.put(['0', '', 'late'])
+        gevent.sleep(0)
+        self.assertFalse(c.closed)
+        c.close()
+
+    def dealer_error_test(self):
+        """Test waiting requests fail when the socket fails."""
+        c, socket, replies = self._create_dealer()
+        gevent.spawn(replies.put, zmq.ZMQError())
+        self.assertRaises(zmq.ZMQError, c.request, ['message'], 1)
+        self.assertTrue(c.closed)
+
+    def dealer_manager_test(self):
+        """Test the DealerManager spreads requests over its connections."""
+        context = Mock()
+        m = stellr.pool.DealerManager(context, 2)
+        with patch('stellr.pool.DealerConnection') as connection:
+            connection.side_effect = lambda context, address: Mock(
+                closed=False)
+            a = m.get_connection(ADDRESS)
+            b = m.get_connection(ADDRESS)
+            self.assertNotEqual(a, b)
+            self.assertEqual(set([a, b]), set([m.get_connection(ADDRESS),
+                                               m.get_connection(ADDRESS)]))
+            a.closed = True
+            self.assertFalse(a in [m.get_connection(ADDRESS)
+                                   for i in range(2)])
+            self.assertEqual(3, connection.call_count)
+
+    def dealer_pool_multiplex_test(self):
+        """Test enabling and disabling multiplexing of an address."""
+        self.assertFalse(stellr.pool.zmq_dealer_pool.is_multiplexed(ADDRESS))
+        stellr.pool.zmq_dealer_pool.multiplex(ADDRESS)
+        self.assertTrue(stellr.pool.zmq_dealer_pool.is_multiplexed(ADDRESS))
+        stellr.pool.zmq_dealer_pool.multiplex(ADDRESS, False)
+        self.assertFalse(stellr.pool.zmq_dealer_pool.is_multiplexed(ADDRESS))
+
+    def _create_dealer(self):
+        replies = gevent.queue.Queue()
+
+        def recv_multipart(copy=True):
+            reply = replies.get()
+            if isinstance(reply, Exception):
+                raise reply
+            return [Mock(bytes=frame) for frame in reply]
+
+        context = Mock()
+        socket = context.socket.return_value
+        socket.recv_multipart.side_effect = recv_multipart
+        c = stellr.pool.DealerConnection(context, ADDRESS)
+        context.socket.assert_called_once_with(zmq.DEALER)
+        socket.connect.assert_called_once_with(ADDRESS)
+        return c, socket, replies
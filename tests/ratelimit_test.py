@@ -0,0 +1,115 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import unittest
+
+import stellr
+from stellr import ratelimit
+from stellr.ratelimit import RateLimiter, TokenBucket, BUDGET, FAIL, WAIT
+
+HOST = 'http://localhost:8983'
+
+class RateLimitTest(unittest.TestCase):
+    """Perform tests on the ratelimit module."""
+
+    def tearDown(self):
+        ratelimit.clear()
+        stellr.retry.set_policy(None)
+
+    @patch('stellr.ratelimit.time')
+    def test_token_bucket(self, time):
+        """Test the bucket refills at its rate up to its capacity."""
+        time.time.return_value = 100
+        bucket = TokenBucket(10, 20)
+        self.assertEqual(0, bucket.delay(20, 100))
+        bucket.take(20)
+        self.assertEqual(0.5, bucket.delay(5, 100))
+        bucket.take(5)
+
+        # owed tokens are paid back before the next request
+        self.assertEqual(0.6, bucket.delay(1, 100))
+        self.assertEqual(0, bucket.delay(1, 101))
+        self.assertEqual(0, bucket.delay(20, 1000))
+        self.assertEqual(20, bucket.tokens)
+
+    def test_modes(self):
+        """Test whether each mode allows a request to wait."""
+        self.assertTrue(RateLimiter(mode=WAIT).allows(60))
+        self.assertTrue(RateLimiter(mode=FAIL).allows(0))
+        self.assertFalse(RateLimiter(mode=FAIL).allows(0.01))
+        self.assertTrue(RateLimiter(mode=BUDGET, budget=1).allows(1, 15))
+        self.assertFalse(RateLimiter(mode=BUDGET, budget=1).allows(2, 15))
+        self.assertTrue(RateLimiter(mode=BUDGET).allows(10, 15))
+        self.assertFalse(RateLimiter(mode=BUDGET).allows(20, 15))
+        self.assertRaises(ValueError, RateLimiter, mode='queue')
+
+    @patch('stellr.ratelimit.time')
+    def test_reserve(self, time):
+        """Test requests are limited by both the host and the name."""
+        time.time.return_value = 100
+        ratelimit.set_limit(host=HOST, requests=2)
+        ratelimit.set_limit(name='index', bytes=100, mode=FAIL)
+        self.assertEqual(0, ratelimit.reserve('select', HOST))
+        self.assertEqual(0, ratelimit.reserve('index', HOST, 100))
+        self.assertEqual(0.5, ratelimit.reserve('select', HOST))
+        self.assertRaises(ratelimit.RateLimited, ratelimit.reserve, 'index',
+                          'http://other:8983', 10)
+        self.assertEqual(0, ratelimit.reserve('other', 'http://other:8983'))
+
+        stats = ratelimit.stats()
+        self.assertEqual({'allowed': 3, 'delayed': 1, 'rejected': 0,
+                          'waited': 0.5}, stats['hosts'][HOST])
+        self.assertEqual({'allowed': 1, 'delayed': 0, 'rejected': 1,
+                          'waited': 0.0}, stats['names']['index'])
+
+        ratelimit.remove_limit(host=HOST)
+        self.assertEqual(None, ratelimit.get_limiter(host=HOST))
+        self.assertRaises(ValueError, ratelimit.set_limit, requests=1)
+
+    @patch('stellr.stellr.gevent.sleep')
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_waits(self, pool, sleep):
+        """Test a command waits for the limit of its host."""
+        pool.urlopen.return_value = Mock(status=200, data='{}')
+        ratelimit.set_limit(host=HOST, requests=1)
+        stellr.SelectCommand(HOST).execute()
+        self.assertEqual(0, sleep.call_count)
+        stellr.SelectCommand(HOST).execute()
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(0 < sleep.call_args[0][0] <= 1)
+        self.assertEqual(2, pool.urlopen.call_count)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_fails_fast(self, pool):
+        """Test a refused command is neither sent nor retried."""
+        pool.urlopen.return_value = Mock(status=200, data='{}')
+        stellr.retry.set_policy(stellr.RetryPolicy(backoff=0))
+        ratelimit.set_limit(name='select', requests=1, mode=FAIL)
+        stellr.SelectCommand(HOST).execute()
+        command = stellr.SelectCommand(HOST)
+        self.assertRaises(stellr.RateLimitError, command.execute)
+        self.assertEqual(1, pool.urlopen.call_count)
+        self.assertEqual(1, ratelimit.get_limiter(name='select').rejected)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_update_bytes(self, pool):
+        """Test the bytes of an update body are limited."""
+        pool.urlopen.return_value = Mock(status=200,
+                                         data='{"responseHeader":{}}')
+        ratelimit.set_limit(name='update', bytes=10, mode=BUDGET, budget=0.1)
+        command = stellr.UpdateCommand(HOST, name='update')
+        command.add_documents({'id': 1, 'text': 'x' * 100})
+        self.assertRaises(stellr.RateLimitError, command.execute)
+        self.assertEqual(0, pool.urlopen.call_count)
@@ -0,0 +1,132 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch, Mock
+import unittest
+import urllib3
+
+import stellr
+from stellr.retry import RetryPolicy
+
+HOSTS = ['http://replica1:8983', 'http://replica2:8983']
+TIMEOUT = stellr.StellrError('timeout', timeout=True)
+
+class RetryPolicyTest(unittest.TestCase):
+    """Perform tests on the retry module."""
+
+    def tearDown(self):
+        stellr.retry.set_policy(None)
+
+    @patch('stellr.retry.random')
+    def test_backoff(self, random):
+        """Test the delay doubles up to max_backoff, less the jitter."""
+        random.random.return_value = 0.5
+        p = RetryPolicy(backoff=0.1, max_backoff=0.3, jitter=0.5)
+        self.assertAlmostEqual(0.075, p.backoff_delay(0))
+        self.assertAlmostEqual(0.15, p.backoff_delay(1))
+        self.assertAlmostEqual(0.225, p.backoff_delay(2))
+
+    def test_retry_delay(self):
+        """Test which failures are retried."""
+        p = RetryPolicy(max_retries=2, backoff=0, min_budget=10)
+        start = 0
+        self.assertEqual(0, p.retry_delay(TIMEOUT, 0, start))
+        self.assertEqual(0, p.retry_delay(
+            stellr.StellrError('unavailable', status=503, response=''), 1,
+            start))
+        self.assertEqual(None, p.retry_delay(TIMEOUT, 2, start))
+        self.assertEqual(None, p.retry_delay(
+            stellr.StellrError('bad', status=400, response=''), 0, start))
+        self.assertEqual(2, p.retries)
+
+    def test_budget(self):
+        """Test retries stop once the budget is spent."""
+        p = RetryPolicy(backoff=0, budget=0.5, min_budget=1)
+        self.assertEqual(0, p.retry_delay(TIMEOUT, 0, 0))
+        self.assertEqual(None, p.retry_delay(TIMEOUT, 0, 0))
+        self.assertEqual(1, p.exhausted)
+        p.record_request()
+        p.record_request()
+        self.assertEqual(0, p.retry_delay(TIMEOUT, 0, 0))
+
+    @patch('stellr.retry.time')
+    def test_deadline(self, time):
+        """Test no retry is made that would pass the deadline."""
+        time.time.return_value = 100
+        p = RetryPolicy(backoff=1, jitter=0, deadline=5)
+        self.assertEqual(1, p.retry_delay(TIMEOUT, 0, 97))
+        self.assertEqual(None, p.retry_delay(TIMEOUT, 0, 96))
+        self.assertEqual(2, p.attempt_timeout(15, 97))
+        self.assertEqual(15, RetryPolicy().attempt_timeout(15, 97))
+
+    def test_idempotent(self):
+        """Test which commands are safe to retry."""
+        self.assertTrue(stellr.SelectCommand(HOSTS[0]).is_idempotent())
+        update = stellr.UpdateCommand(HOSTS[0])
+        update.add_documents([{'id': 1}, {'id': 2}])
+        update.add_delete_by_id(3)
+        self.assertTrue(update.is_idempotent())
+        update.add_commit()
+        self.assertFalse(update.is_idempotent())
+        update = stellr.UpdateCommand(HOSTS[0])
+        update.add_delete_by_query('id:1')
+        self.assertFalse(update.is_idempotent())
+        update = stellr.UpdateCommand(HOSTS[0])
+        update.add_documents({'id': 1}, overwrite=True)
+        self.assertTrue(update.is_idempotent())
+        update.add_documents({'id': 2}, overwrite=False)
+        self.assertFalse(update.is_idempotent())
+        update = stellr.UpdateCommand(HOSTS[0])
+        update._commands = [('add', '{"doc": {"id": 1}}'),
+                            ('delete', '{"query": "id:1"}')]
+        self.assertFalse(update.is_idempotent())
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_retries_other_host(self, pool):
+        """Test a failed command is retried on a different host."""
+        response = Mock(status=200, data='{"response": {}}')
+        pool.urlopen.side_effect = [urllib3.TimeoutError(), response]
+        stellr.retry.set_policy(RetryPolicy(backoff=0))
+        g = stellr.HostGroup(HOSTS, probe_interval=60)
+        self.assertEqual({'response': {}}, stellr.SelectCommand(g).execute())
+        hosts = [call[0][1].split('/solr')[0]
+                 for call in pool.urlopen.call_args_list]
+        self.assertEqual(set(HOSTS), set(hosts))
+        g.stop()
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_not_idempotent(self, pool):
+        """Test a command that is not idempotent is not retried."""
+        pool.urlopen.side_effect = urllib3.TimeoutError()
+        stellr.retry.set_policy(RetryPolicy(backoff=0))
+        command = stellr.UpdateCommand(HOSTS[0])
+        command.add_commit()
+        self.assertRaises(stellr.StellrError, command.execute)
+        self.assertEqual(1, pool.urlopen.call_count)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execute_gives_up(self, pool):
+        """Test the error is raised once the retries are used up."""
+        pool.urlopen.side_effect = urllib3.TimeoutError()
+        command = stellr.SelectCommand(HOSTS[0], timeout=3)
+        command.retry_policy = RetryPolicy(max_retries=2, backoff=0)
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertTrue(e.timeout)
+            self.assertEqual(3, pool.urlopen.call_count)
+            self.assertEqual(3, command.timeout)
+            return
+
+        self.assertFalse(True, 'Error should have been raised')
@@ -0,0 +1,126 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from mock import patch
+import unittest
+
+import stellr
+
+HOSTS = ['http://shard1:8983', 'tcp://shard2:9000']
+
+SHARD_RESPONSES = {
+    HOSTS[0]: {
+        'responseHeader': {'status': 0, 'QTime': 3},
+        'response': {'numFound': 10, 'start': 0, 'maxScore': 4.0,
+                     'docs': [{'id': 'a', 'score': 4.0},
+                              {'id': 'c', 'score': 2.0},
+                              {'id': 'e', 'score': 0.5}]},
+        'facet_counts': {'facet_queries': {'x:1': 2},
+                         'facet_fields': {'cat': ['books', 4, 'music', 1]}}},
+    HOSTS[1]: {
+        'responseHeader': {'status': 0, 'QTime': 7},
+        'response': {'numFound': 5, 'start': 0, 'maxScore': 3.0,
+                     'docs': [{'id': 'b', 'score': 3.0},
+                              {'id': 'd', 'score': 1.0}]},
+        'facet_counts': {'facet_queries': {'x:1': 1},
+                         'facet_fields': {'cat': ['music', 5, 'film', 2]}}},
+}
+
+class ShardedSelectCommandTest(unittest.TestCase):
+    """Perform tests on the sharding module."""
+
+    def setUp(self):
+        self.executed = {}
+        patcher = patch('stellr.stellr.SelectCommand.execute',
+                        autospec=True, side_effect=self._execute)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _execute(self, command, return_name=False):
+        self.executed[command.host] = command.handler
+        response = SHARD_RESPONSES[command.host]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def test_merge_by_score(self):
+        """Test merging a page of documents by score."""
+        c = stellr.ShardedSelectCommand(HOSTS)
+        c.add_param('q', 'test')
+        c.add_param('start', 1)
+        c.add_param('rows', 3)
+        data = c.execute()
+
+        for host in HOSTS:
+            self.assertEqual(self.executed[host],
+                '/solr/select?wt=json&q=test&start=0&rows=4&fl=%2A%2Cscore')
+        response = data['response']
+        self.assertEqual(['b', 'c', 'd'], [d['id'] for d in response['docs']])
+        self.assertEqual(15, response['numFound'])
+        self.assertEqual(1, response['start'])
+        self.assertEqual(4.0, response['maxScore'])
+        self.assertEqual(7, data['responseHeader']['QTime'])
+
+    def test_shard_settings(self):
+        """Test the settings of the command apply to each shard."""
+        policy = stellr.RetryPolicy()
+        cache = stellr.QueryCache()
+        c = stellr.ShardedSelectCommand(HOSTS)
+        c.accept_gzip = True
+        c.retry_policy = policy
+        c.cache = cache
+        for host in HOSTS:
+            shard = c._shard_command(host, 10, [])
+            self.assertTrue(shard.accept_gzip)
+            self.assertTrue(shard.retry_policy is policy)
+            self.assertTrue(shard.cache is cache)
+
+    def test_not_streamed(self):
+        """Test a sharded select cannot be streamed or paged."""
+        c = stellr.ShardedSelectCommand(HOSTS)
+        self.assertRaises(NotImplementedError, c.execute_stream)
+        self.assertRaises(ValueError, stellr.CursorIterator, c)
+
+    def test_merge_by_sort_field(self):
+        """Test merging documents by a sort field."""
+        c = stellr.ShardedSelectCommand(HOSTS)
+        c.add_param('sort', 'id asc')
+        c.add_param('fl', 'id')
+        data, name = c.execute(return_name=True)
+        self.assertEqual('select', name)
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+                         [d['id'] for d in data['response']['docs']])
+        self.assertTrue(self.executed[HOSTS[0]].endswith(
+            'sort=id+asc&fl=id&start=0&rows=10'))
+
+    def test_merge_facets(self):
+        """Test summing the facet counts of each shard."""
+        c = stellr.ShardedSelectCommand(HOSTS)
+        c.add_param('facet.limit', 2)
+        facets = c.execute()['facet_counts']
+        self.assertEqual({'x:1': 3}, facets['facet_queries'])
+        self.assertEqual(['music', 6, 'books', 4],
+                         facets['facet_fields']['cat'])
+
+    def test_shard_error(self):
+        """Test that the error of a failing shard is raised."""
+        error = stellr.StellrError('down', status=503)
+        with patch.dict(SHARD_RESPONSES, {HOSTS[1]: error}):
+            c = stellr.ShardedSelectCommand(HOSTS)
+            try:
+                c.execute()
+            except stellr.StellrError as e:
+                self.assertEqual(503, e.status)
+                return
+        self.assertFalse(True, 'Error should have been raised')
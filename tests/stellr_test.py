@@ -19,6 +19,7 @@ import gevent
 import simplejson as json
 import urllib3
 import unittest
+import zlib
 from gevent_zeromq import zmq
 
 import stellr
@@ -108,6 +109,18 @@ class StellrCommandTest(unittest.TestCase):
                          ('{"add": {"doc": {"a": 1}}'
                           ',"add": {"doc": {"b": 2}}}'))
 
+    def test_update_stream_body(self):
+        """Test generating the body of an UpdateCommand in chunks."""
+        u = stellr.UpdateCommand(TEST_HTTP, stream=True)
+        self.assertTrue(u.stream)
+        u.add_documents([{'a': 1}, {'b': 2}, {'c': 3}])
+        chunks = list(u.iter_body(chunk_size=20))
+        self.assertEqual(chunks, ['{"add": {"doc": {"a": 1}}',
+                                  ',"add": {"doc": {"b": 2}}',
+                                  ',"add": {"doc": {"c": 3}}', '}'])
+        self.assertEqual(''.join(chunks), u.body)
+        self.assertEqual([u.body], list(u.iter_body()))
+
     def test_update_with_document_boost(self):
         """Test the UpdateCommand with a document boost."""
         u = stellr.UpdateCommand(TEST_HTTP)
@@ -178,7 +191,7 @@ class StellrCommandTest(unittest.TestCase):
         self.assertTrue('optimize' in u._commands[0])
         self.assertEqual(u.body, '{"optimize": {}}')
 
-    @patch('stellr.stellr.http_pool')
+    @patch('stellr.client.StellrClient.http_pool')
     def test_execution_select_success(self, pool):
         """
         Test the execution of a select command that is successful.
@@ -210,6 +223,48 @@ class StellrCommandTest(unittest.TestCase):
         self.assertEqual(data['key'], 'value')
         self.assertEqual(data['number'], 42)
 
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_select_cached(self, pool):
+        """
+        Test that a cached select command only calls the host once.
+        """
+        cache = stellr.QueryCache()
+        response = self._create_execution_mocks(pool, 200)
+        command = stellr.SelectCommand(TEST_HTTP, cache=cache, cache_ttl=5)
+        command.add_param('q', 'a')
+        command.add_param('fq', 'b')
+        data = command.execute()
+        self.assertEqual(data['number'], 42)
+
+        other = stellr.SelectCommand(TEST_HTTP, cache=cache)
+        other.add_param('fq', 'b')
+        other.add_param('q', 'a')
+        self.assertEqual(command.cache_key, other.cache_key)
+        data, name = other.execute(return_name=True)
+        self.assertEqual(data['number'], 42)
+        self.assertEqual(name, 'select')
+        self.assertEqual(pool.urlopen.call_count, 1)
+        self.assertEqual(cache.hits, 1)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_host_cache(self, pool):
+        """
+        Test that a cache set for a host is used by select commands.
+        """
+        cache = stellr.QueryCache()
+        stellr.cache.set_host_cache(TEST_HTTP, cache)
+        try:
+            response = self._create_execution_mocks(pool, 200)
+            stellr.SelectCommand(TEST_HTTP).execute()
+            stellr.SelectCommand(TEST_HTTP).execute()
+            self.assertEqual(pool.urlopen.call_count, 1)
+
+            stellr.UpdateCommand(TEST_HTTP).execute()
+            stellr.UpdateCommand(TEST_HTTP).execute()
+            self.assertEqual(pool.urlopen.call_count, 3)
+        finally:
+            stellr.cache.set_host_cache(TEST_HTTP, None)
+
     @patch('stellr.pool.zmq_socket_pool')
     def test_zmq_execution_select_success(self, pool):
         """
@@ -221,7 +276,9 @@ class StellrCommandTest(unittest.TestCase):
         data = command.execute()
 
         # check the mocks
-        s.send.assert_called_once_with('/select?wt=json&fq=field%3Afilter')
+        s.send.assert_called_once_with('/select?wt=json&fq=field%3Afilter',
+                                       copy=False)
+        s.recv.assert_called_with(copy=False)
 
         self.assertEqual(len(data), 2)
         self.assertEqual(data['responseHeader']['status'], 0)
@@ -230,7 +287,7 @@ class StellrCommandTest(unittest.TestCase):
         data, name = command.execute(return_name=True)
         self.assertEqual(name, 'select')
 
-    @patch('stellr.stellr.http_pool')
+    @patch('stellr.client.StellrClient.http_pool')
     def test_execution_update_success(self, pool):
         """
         Test the execution of an update command that is successful.
@@ -250,6 +307,192 @@ class StellrCommandTest(unittest.TestCase):
             body='{"add": {"doc": {"id": 69, "value": "sixty-nine"}}}',
             headers=hdrs, timeout=15, assert_same_host=False)
 
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_update_stream(self, pool):
+        """
+        Test the execution of an update command with a streamed body.
+        """
+        conn_pool = Mock(num_requests=0)
+        conn = Mock()
+        pool.connection_from_url.return_value = conn_pool
+        conn_pool._get_conn.return_value = conn
+        httplib_response = Mock()
+        httplib_response.getheaders.return_value = []
+        httplib_response.status = 200
+        httplib_response.read.return_value = RESPONSE_DATA
+        conn.getresponse.return_value = httplib_response
+
+        command = stellr.UpdateCommand(TEST_HTTP, stream=True)
+        command.add_documents({'id': 69})
+        data = command.execute()
+        self.assertEqual(1, conn_pool.num_requests)
+
+        url = 'http://localhost:8983/solr/update/json?wt=json'
+        pool.connection_from_url.assert_called_once_with(url)
+        conn.putrequest.assert_called_once_with('POST', url,
+            skip_accept_encoding=True)
+        conn.putheader.assert_any_call('transfer-encoding', 'chunked')
+        body = '{"add": {"doc": {"id": 69}}}'
+        self.assertEqual([c[0][0] for c in conn.send.call_args_list],
+            ['%x\r\n%s\r\n' % (len(body), body), '0\r\n\r\n'])
+        self.assertEqual(pool.urlopen.call_count, 0)
+        self.assertEqual(data['number'], 42)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_update_gzip(self, pool):
+        """
+        Test an update body at or above the threshold is compressed.
+        """
+        registry = stellr.metrics.MetricsRegistry()
+        previous = stellr.metrics.set_registry(registry)
+        try:
+            self._create_execution_mocks(pool, 200)
+            command = stellr.UpdateCommand(TEST_HTTP, gzip_threshold=10)
+            command.add_documents({'id': 69, 'value': 'sixty-nine'})
+            command.execute()
+
+            body = '{"add": {"doc": {"id": 69, "value": "sixty-nine"}}}'
+            kwargs = pool.urlopen.call_args[1]
+            self.assertEqual('gzip', kwargs['headers']['content-encoding'])
+            self.assertEqual(body, zlib.decompress(kwargs['body'], 31))
+            self.assertFalse('content-encoding' in command.headers)
+            snapshot = registry.get('update', TEST_HTTP).snapshot()
+            compressed = snapshot['compressed_requests']
+            self.assertEqual(1, compressed['count'])
+            self.assertEqual(len(body), compressed['raw_bytes'])
+            self.assertEqual(len(kwargs['body']),
+                             compressed['compressed_bytes'])
+        finally:
+            stellr.metrics.set_registry(previous)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_update_gzip_threshold(self, pool):
+        """
+        Test an update body below the threshold is not compressed.
+        """
+        self._create_execution_mocks(pool, 200)
+        command = stellr.UpdateCommand(TEST_HTTP, gzip_threshold=1000)
+        command.add_documents({'id': 69})
+        command.execute()
+
+        kwargs = pool.urlopen.call_args[1]
+        self.assertEqual('{"add": {"doc": {"id": 69}}}', kwargs['body'])
+        self.assertFalse('content-encoding' in kwargs['headers'])
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_update_stream_gzip(self, pool):
+        """
+        Test a streamed update body is compressed as it is sent.
+        """
+        conn_pool = Mock(num_requests=0)
+        conn = Mock()
+        pool.connection_from_url.return_value = conn_pool
+        conn_pool._get_conn.return_value = conn
+        httplib_response = Mock()
+        httplib_response.getheaders.return_value = []
+        httplib_response.status = 200
+        httplib_response.read.return_value = RESPONSE_DATA
+        conn.getresponse.return_value = httplib_response
+
+        command = stellr.UpdateCommand(TEST_HTTP, stream=True,
+                                       gzip_threshold=0)
+        command.add_documents([{'id': 69}, {'id': 70}])
+        command.execute()
+
+        conn.putheader.assert_any_call('content-encoding', 'gzip')
+        sent = [c[0][0] for c in conn.send.call_args_list]
+        self.assertEqual('0\r\n\r\n', sent[-1])
+        data = ''
+        for chunk in sent[:-1]:
+            size, chunk = chunk.split('\r\n', 1)
+            self.assertEqual(int(size, 16), len(chunk) - 2)
+            data += chunk[:-2]
+        self.assertEqual(''.join(command.iter_body()),
+                         zlib.decompress(data, 31))
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_select_accept_gzip(self, pool):
+        """
+        Test a compressed response to a select is decompressed.
+        """
+        registry = stellr.metrics.MetricsRegistry()
+        previous = stellr.metrics.set_registry(registry)
+        try:
+            response = self._create_execution_mocks(pool, 200)
+            response.data = self._gzip(RESPONSE_DATA)
+            response.getheader.return_value = 'gzip'
+            command = stellr.SelectCommand(TEST_HTTP, accept_gzip=True)
+            data = command.execute()
+
+            self.assertEqual(42, data['number'])
+            kwargs = pool.urlopen.call_args[1]
+            self.assertEqual('gzip', kwargs['headers']['accept-encoding'])
+            self.assertFalse(kwargs['decode_content'])
+            response.getheader.assert_called_with('content-encoding')
+            snapshot = registry.get('select', TEST_HTTP).snapshot()
+            compressed = snapshot['compressed_responses']
+            self.assertEqual(len(RESPONSE_DATA), compressed['raw_bytes'])
+            self.assertEqual(len(RESPONSE_DATA), snapshot['response_bytes'])
+        finally:
+            stellr.metrics.set_registry(previous)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_select_corrupt_gzip(self, pool):
+        """
+        Test a compressed response that cannot be decompressed raises a
+        StellrError.
+        """
+        response = self._create_execution_mocks(pool, 200)
+        response.data = 'not gzip'
+        response.getheader.return_value = 'gzip'
+        command = stellr.SelectCommand(TEST_HTTP, accept_gzip=True)
+        try:
+            command.execute()
+            self.fail('A StellrError should have been raised')
+        except stellr.StellrError as e:
+            self.assertEqual('not gzip', e.response)
+            self.assertFalse(e.timeout)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_execution_update_stream_timeout(self, pool):
+        """
+        Test a streamed update that times out returns its connection slot.
+        """
+        conn_pool = Mock(num_requests=0)
+        conn = Mock()
+        pool.connection_from_url.return_value = conn_pool
+        conn_pool._get_conn.return_value = conn
+        conn.send.side_effect = stellr.stellr.socket.timeout()
+
+        command = stellr.UpdateCommand(TEST_HTTP, stream=True)
+        command.add_documents({'id': 69})
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertTrue(e.timeout)
+            self.assertEqual(e.body, None)
+            conn.close.assert_called_once_with()
+            conn_pool._put_conn.assert_called_once_with(None)
+            return
+
+        self.assertFalse(True, 'Error should have been raised')
+
+    @patch('stellr.pool.zmq_socket_pool')
+    def test_zmq_execution_update_stream(self, pool):
+        """
+        Test the execution of an update command with a streamed body.
+        """
+        s, c = self._create_zmq_execution_mocks(pool)
+
+        command = stellr.UpdateCommand(TEST_ZMQ, stream=True)
+        command.add_documents({'id': 69})
+        data = command.execute()
+
+        self.assertEqual(s.send.call_args_list,
+            [(('/update/json?wt=json', zmq.SNDMORE), {'copy': False}),
+             (('{"add": {"doc": {"id": 69}}}',), {'copy': False})])
+        self.assertEqual(data['responseHeader']['status'], 0)
+
     @patch('stellr.pool.zmq_socket_pool')
     def test_zmq_execution_update_success(self, pool):
         """
@@ -262,9 +505,10 @@ class StellrCommandTest(unittest.TestCase):
         data = command.execute()
 
         # check the mocks
-        s.send.assert_called_once_with(
-            ('/update/json?wt=json '
-             '{"add": {"doc": {"id": 69, "value": "sixty-nine"}}}'))
+        self.assertEqual(s.send.call_args_list,
+            [(('/update/json?wt=json', zmq.SNDMORE), {'copy': False}),
+             (('{"add": {"doc": {"id": 69, "value": "sixty-nine"}}}',),
+              {'copy': False})])
 
         self.assertEqual(len(data), 2)
         self.assertEqual(data['responseHeader']['status'], 0)
@@ -273,7 +517,7 @@ class StellrCommandTest(unittest.TestCase):
         data, name = command.execute(return_name=True)
         self.assertEqual(name, 'update')
 
-    @patch('stellr.stellr.http_pool')
+    @patch('stellr.client.StellrClient.http_pool')
     def test_execution_error(self, pool):
         """
         Test the execution of a command where Solr returns a non-200 response.
@@ -351,7 +595,7 @@ class StellrCommandTest(unittest.TestCase):
         try:
             data = command.execute()
         except stellr.StellrError as e:
-            pool.assert_called_once_with(TEST_ZMQ)
+            pool.assert_called_once_with(TEST_ZMQ, 15)
             self.assertFalse(e.timeout)
             self.assertEqual(e.status, 1)
             self.assertEqual(e.url, '/select?wt=json&fq=field%3Afilter')
@@ -383,6 +627,54 @@ class StellrCommandTest(unittest.TestCase):
 
         self.assertFalse(True, 'Error should have been raised')
 
+    @patch('stellr.pool.zmq_socket_pool')
+    def test_zmq_execution_pool_timeout(self, pool):
+        """
+        Test the execution of a command that times out waiting for a socket.
+        """
+        s, c = self._create_zmq_execution_mocks(pool)
+        c.__enter__.side_effect = stellr.pool.PoolTimeout('no socket')
+
+        command = stellr.SelectCommand(TEST_ZMQ, timeout=3)
+        try:
+            data = command.execute()
+        except stellr.StellrError as e:
+            pool.assert_called_once_with(TEST_ZMQ, 3)
+            self.assertTrue(e.timeout)
+            self.assertEqual(e.url, '/select?wt=json')
+            self.assertEqual(str(e), 'no socket')
+            return
+
+        self.assertFalse(True, 'Error should have been raised')
+
+    @patch('stellr.pool.zmq_socket_pool')
+    @patch('stellr.pool.zmq_dealer_pool')
+    def test_zmq_execution_multiplexed(self, dealer, pool):
+        """
+        Test the execution of a command against a multiplexed host.
+        """
+        dealer.is_multiplexed.return_value = True
+        dealer.request.return_value = ZMQ_RESPONSE
+        command = stellr.SelectCommand(TEST_ZMQ, timeout=3)
+        command.add_param('fq', 'field:filter')
+        data = command.execute()
+
+        dealer.is_multiplexed.assert_called_once_with(TEST_ZMQ)
+        dealer.request.assert_called_once_with(
+            TEST_ZMQ, ['/select?wt=json&fq=field%3Afilter'], 3)
+        self.assertEqual(0, pool.call_count)
+        self.assertEqual(data['responseHeader']['status'], 0)
+
+        # no reply within the timeout
+        dealer.request.return_value = None
+        try:
+            command.execute()
+        except stellr.StellrError as e:
+            self.assertTrue(e.timeout)
+            return
+
+        self.assertFalse(True, 'Error should have been raised')
+
     @patch('stellr.pool.zmq_socket_pool')
     def test_zmq_execution_general_error(self, pool):
         """
@@ -406,7 +698,7 @@ class StellrCommandTest(unittest.TestCase):
 
         self.assertFalse(True, 'Error should have been raised')
 
-    @patch('stellr.stellr.http_pool')
+    @patch('stellr.client.StellrClient.http_pool')
     def test_execution_invalid_response_data(self, pool):
         """
         Test the execution of a command where Solr returns a non-200 response.
@@ -429,7 +721,7 @@ class StellrCommandTest(unittest.TestCase):
 
         self.assertFalse(True, 'Error should have been raised')
 
-    @patch('stellr.stellr.http_pool')
+    @patch('stellr.client.StellrClient.http_pool')
     def test_execution_timeout(self, pool):
         """
         Test the execution of a command where Solr returns a non-200 response.
@@ -465,6 +757,10 @@ class StellrCommandTest(unittest.TestCase):
             pool.urlopen.side_effect = side
         return response
 
+    def _gzip(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
     def _create_zmq_execution_mocks(self, patch, side=None, valid=True,
                                     response=ZMQ_ERROR_RESPONSE):
         socket = Mock()
@@ -475,9 +771,9 @@ class StellrCommandTest(unittest.TestCase):
         context.__exit__.return_value = valid
         patch.return_value = context
         if valid:
-            socket.recv.return_value = ZMQ_RESPONSE
+            socket.recv.return_value = Mock(bytes=ZMQ_RESPONSE)
         else:
-            socket.recv.return_value = response
+            socket.recv.return_value = Mock(bytes=response)
         if side:
             socket.recv.side_effect = side
         return socket, context
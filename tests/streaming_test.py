@@ -0,0 +1,190 @@
+#   Copyright 2011-2012 Michael Garski (mgarski@mac.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from cStringIO import StringIO
+from mock import patch, Mock
+from nose.tools import raises
+import unittest
+import zlib
+
+import stellr
+from stellr.streaming import StreamingResponse
+
+RESPONSE = ('{"responseHeader": {"status": 0, "QTime": 12},\n'
+            ' "response": {"numFound": 1234, "start": 0, "docs": [\n'
+            '   {"id": "a", "price": 10.5, "tags": ["x", "y"]},\n'
+            '   {"id": "b", "price": 123456789},\n'
+            '   {"id": "c", "price": null}\n'
+            ' ], "maxScore": 1.5},\n'
+            ' "facet_counts": {"facet_fields": {"tags": ["x", 1]}}}')
+
+DOCS = [{'id': 'a', 'price': 10.5, 'tags': ['x', 'y']},
+        {'id': 'b', 'price': 123456789},
+        {'id': 'c', 'price': None}]
+
+TEST_HTTP = 'http://localhost:8983'
+TEST_ZMQ = 'tcp://localhost:9000'
+
+class StreamingResponseTest(unittest.TestCase):
+    """Perform tests on the streaming module."""
+
+    def _response(self, data=RESPONSE, read_size=7):
+        close = Mock()
+        return StreamingResponse(StringIO(data).read, close,
+                                 read_size=read_size), close
+
+    def test_iterate_docs(self):
+        """Test that every document is yielded when read in small chunks."""
+        for size in (1, 3, 7, 64, 4096):
+            r, close = self._response(read_size=size)
+            self.assertEqual(DOCS, list(r))
+            self.assertEqual(1234, r.num_found)
+            self.assertEqual({'facet_counts':
+                                  {'facet_fields': {'tags': ['x', 1]}},
+                              'response': {'maxScore': 1.5}}, r.extra)
+            close.assert_called_once_with()
+
+    def test_lazy_values(self):
+        """Test values before the docs are parsed without consuming docs."""
+        r, close = self._response()
+        self.assertEqual({'status': 0, 'QTime': 12}, r.header)
+        self.assertEqual(1234, r.num_found)
+        self.assertEqual(0, r.start)
+        self.assertEqual(0, len(r._docs))
+        docs = iter(r)
+        self.assertEqual(DOCS[0], next(docs))
+        self.assertFalse(close.called)
+
+    def test_docs_before_values(self):
+        """Test docs passed over while finding a value are still yielded."""
+        r, close = self._response(
+            '{"response": {"docs": [{"id": 1}], "numFound": 1}}')
+        self.assertEqual(1, r.num_found)
+        self.assertEqual(None, r.header)
+        self.assertEqual([{'id': 1}], list(r))
+
+    def test_close(self):
+        """Test closing the response stops reading it."""
+        with self._response()[0] as r:
+            next(iter(r))
+        self.assertEqual([], list(r))
+
+    @raises(stellr.StellrError)
+    def test_truncated(self):
+        """Test a truncated response raises an error."""
+        r, close = self._response(RESPONSE[:120])
+        list(r)
+
+    @raises(stellr.StellrError)
+    def test_invalid(self):
+        """Test an invalid response raises an error."""
+        r, close = self._response('{"response": [1]}')
+        list(r)
+
+class ExecuteStreamTest(unittest.TestCase):
+    """Perform tests on SelectCommand.execute_stream."""
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_http(self, pool):
+        """Test streaming a response over http."""
+        response = Mock()
+        response.status = 200
+        response.read = StringIO(RESPONSE).read
+        pool.urlopen.return_value = response
+        command = stellr.SelectCommand(TEST_HTTP)
+        command.add_param('q', '*:*')
+        r = command.execute_stream()
+        self.assertEqual(DOCS, list(r))
+        url = TEST_HTTP + '/solr/select?wt=json&q=%2A%3A%2A'
+        pool.urlopen.assert_called_once_with('GET', url, body=None,
+            headers=command.headers, timeout=15, assert_same_host=False,
+            preload_content=False)
+        response.release_conn.assert_called_once_with()
+        self.assertEqual(url, r.url)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_http_gzip(self, pool):
+        """Test streaming a compressed response over http."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        data = compressor.compress(RESPONSE) + compressor.flush()
+        response = Mock()
+        response.status = 200
+        response.read = StringIO(data).read
+        response.getheader.return_value = 'gzip'
+        pool.urlopen.return_value = response
+        command = stellr.SelectCommand(TEST_HTTP, accept_gzip=True)
+        r = command.execute_stream()
+        self.assertEqual(DOCS, list(r))
+        kwargs = pool.urlopen.call_args[1]
+        self.assertEqual('gzip', kwargs['headers']['accept-encoding'])
+        self.assertFalse(kwargs['decode_content'])
+        self.assertTrue(kwargs['preload_content'] is False)
+
+    def test_http_client_release(self):
+        """Test a streamed response holds its connection until closed."""
+        client = stellr.StellrClient(patch=False, http_size=1, block=False)
+        client._http_pool = Mock()
+        response = Mock()
+        response.status = 200
+        response.read = StringIO(RESPONSE).read
+        client._http_pool.urlopen.return_value = response
+        r = client.execute_stream(stellr.SelectCommand(TEST_HTTP))
+        self.assertRaises(stellr.pool.PoolTimeout, client.acquire,
+                          TEST_HTTP, 1)
+        self.assertEqual(DOCS, list(r))
+        response.release_conn.assert_called_once_with()
+        client.acquire(TEST_HTTP, 1)
+
+    @patch('stellr.client.StellrClient.http_pool')
+    def test_http_error(self, pool):
+        """Test a streamed request that fails."""
+        response = Mock()
+        response.status = 500
+        response.data = 'oops'
+        pool.urlopen.return_value = response
+        try:
+            stellr.SelectCommand(TEST_HTTP).execute_stream()
+        except stellr.StellrError as e:
+            self.assertEqual(500, e.status)
+            self.assertEqual('oops', e.response)
+            return
+        self.assertFalse(True, 'Error should have been raised')
+
+    @patch('stellr.pool.zmq_socket_pool')
+    def test_zmq(self, pool):
+        """Test streaming a response over ZeroMQ."""
+        socket = Mock()
+        socket.recv.return_value = Mock(bytes=RESPONSE)
+        context = pool.return_value
+        context.__enter__ = Mock(return_value=socket)
+        context.__exit__ = Mock(return_value=False)
+        r = stellr.SelectCommand(TEST_ZMQ).execute_stream()
+        socket.send.assert_called_once_with('/select?wt=json', copy=False)
+        self.assertEqual(DOCS, list(r))
+
+    @patch('stellr.pool.zmq_socket_pool')
+    def test_zmq_error(self, pool):
+        """Test streaming a response over ZeroMQ with an error status."""
+        socket = Mock()
+        socket.recv.return_value = Mock(bytes=(
+            '{"responseHeader": {"status": 400}, "error": {"msg": "bad"}}'))
+        context = pool.return_value
+        context.__enter__ = Mock(return_value=socket)
+        context.__exit__ = Mock(return_value=False)
+        try:
+            stellr.SelectCommand(TEST_ZMQ).execute_stream()
+        except stellr.StellrError as e:
+            self.assertEqual(400, e.status)
+            return
+        self.assertFalse(True, 'Error should have been raised')